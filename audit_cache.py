@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import copy
+from functools import wraps
+import shelve
+import threading
+import mongo_audit
+
+## Cache mongo_audit query results while the collection stays the same.
+# Results are keyed on the function, its arguments, and a fingerprint of the
+# collection: its document count and write generation. The write helpers in
+# mongo_audit (update_states, fix_mismatched_refs, write_ref_docs) and
+# clean_and_write (load_map, apply_changes) bump the generation, so their
+# changes invalidate cached results on their own. After
+# writing by other means, call mongo_audit.bump_generation or AuditCache.clear.
+# Cache the functions that return data (e.g. find_bike_services), not the ones
+# that print it.
+
+
+def get_fingerprint(coll):
+    '''Get a cheap fingerprint of a collection's state.
+
+    Parameters:
+        coll: (MongoDB collection) Collection.
+    Returns:
+        fingerprint: (tuple) (full name, estimated document count, generation)
+    '''
+    return (coll.full_name, coll.estimated_document_count(),
+            mongo_audit.get_generation(coll))
+
+
+class AuditCache:
+    '''LRU cache of audit results, in memory and optionally on disk.
+
+    Parameters:
+        maxsize: (int) Results kept in memory.
+        path: (str) Filepath of a shelve file to also keep results in, across
+            sessions. Memory only if None.
+    '''
+    def __init__(self, maxsize = 128, path = None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _get_key(self, func, coll, kwargs):
+        return repr((func.__module__, func.__qualname__, get_fingerprint(coll),
+                     sorted(kwargs.items())))
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return True, self._results[key]
+            if self.path is not None:
+                with shelve.open(self.path) as shelf:
+                    if key in shelf:
+                        result = shelf[key]
+                        self._put(key, result, disk=False)
+                        return True, result
+        return False, None
+
+    def _put(self, key, result, disk = True):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+            if disk and self.path is not None:
+                with shelve.open(self.path) as shelf:
+                    shelf[key] = result
+        return
+
+    def call(self, func, coll, **kwargs):
+        '''Get func's result for coll and kwargs, from the cache if the
+        collection hasn't changed since it was stored.
+
+        Parameters:
+            func: (function) Audit function from mongo_audit, taking coll.
+            coll: (MongoDB collection) Collection to audit.
+            **kwargs: Other arguments to func.
+        Returns:
+            result: A copy of func's result. Cursors are listed.
+        '''
+        key = self._get_key(func, coll, kwargs)
+        found, result = self._get(key)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not found:
+            result = func(coll=coll, **kwargs)
+            # Cursors can only be read once.
+            if hasattr(result, "next"):
+                result = mongo_audit.list_query(result)
+            self._put(key, result)
+        # Callers may change what they get.
+        return copy.deepcopy(result)
+
+    def wrap(self, func):
+        '''Get a cached version of an audit function.'''
+        @wraps(func)
+        def cached(coll, **kwargs):
+            return self.call(func, coll, **kwargs)
+        return cached
+
+    def clear(self):
+        '''Drop all cached results, in memory and on disk.'''
+        with self._lock:
+            self._results.clear()
+            if self.path is not None:
+                with shelve.open(self.path, flag="n"):
+                    pass
+        return
+
+    def info(self):
+        '''Get hit and miss counts.
+
+        Returns:
+            info: (dict) { "hits" : <n>, "misses" : <n>, "size" : <n>,
+                           "maxsize" : <n> }
+        '''
+        return { "hits" : self.hits, "misses" : self.misses,
+                 "size" : len(self._results), "maxsize" : self.maxsize }
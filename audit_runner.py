@@ -0,0 +1,152 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import time
+from pymongo.errors import ExecutionTimeout
+import mongo_audit
+import mongo_indexes
+
+## Run independent mongo_audit reads concurrently.
+# PyMongo clients are thread-safe and pool their connections, so each audit
+# gets a thread and the queries run side by side on the server. Total time
+# approaches the slowest audit instead of the sum.
+
+# Result of one audit.
+# name: (str) Audit name.
+# result: What the audit function returned, with cursors listed. None if it
+#   failed.
+# seconds: (float) Run time.
+# error: (Exception or None) What it raised, if anything.
+# timed_out: (bool) Whether the server stopped it at the timeout.
+AuditResult = namedtuple("AuditResult",
+                         ["name", "result", "seconds", "error", "timed_out"])
+
+# Audits by name. (function, keyword arguments other than coll). A "coll_str"
+# of None is filled with the audited collection's name.
+AUDITS_MAP = {
+    "unique_users" : (mongo_audit.get_unique_users, dict()),
+    "doc_counts" : (mongo_audit.check_doc_counts_by,
+                    { "doc_type_lst" : ["node", "way", "relation"],
+                      "count_k" : "_id", "group_k" : "doc_type" }),
+    "ref_types" : (mongo_audit.get_ref_types, { "coll_str" : None }),
+    "doctype_mismatches" : (mongo_audit.find_doctype_mismatches,
+                            { "coll_str" : None }),
+    "bike_services" : (mongo_audit.find_bike_services, dict()),
+    "most_refd" : (mongo_audit.get_most_refd,
+                   { "field" : "service", "limit" : 3 })
+}
+
+
+class TimeoutCollection:
+    '''Collection wrapper that gives each find and aggregate a server-side
+    time limit (maxTimeMS) of whatever remains of a shared budget. Everything
+    else passes through to the collection.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to wrap.
+        deadline: (float) time.monotonic() by which all queries must finish.
+    '''
+    def __init__(self, coll, deadline):
+        self._coll = coll
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        return getattr(self._coll, name)
+
+    @property
+    def database(self):
+        return TimeoutDatabase(self._coll.database, self._deadline)
+
+    def _get_ms(self):
+        ms = int((self._deadline - time.monotonic()) * 1000)
+        if ms <= 0:
+            raise ExecutionTimeout("Audit ran out of time.", code=50)
+        return ms
+
+    def aggregate(self, pipeline, **kwargs):
+        return self._coll.aggregate(pipeline, maxTimeMS=self._get_ms(), **kwargs)
+
+    def find(self, *args, **kwargs):
+        return self._coll.find(*args, max_time_ms=self._get_ms(), **kwargs)
+
+
+class TimeoutDatabase:
+    '''Database wrapper handing out TimeoutCollections.'''
+    def __init__(self, db, deadline):
+        self._db = db
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __getitem__(self, name):
+        return TimeoutCollection(self._db[name], self._deadline)
+
+
+def run_audit(coll, name, func, kwargs, timeout = None):
+    '''Run one audit function, catching what it raises.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to audit.
+        name: (str) Audit name.
+        func: (function) Audit function, taking coll.
+        kwargs: (dict) Other arguments to func.
+        timeout: (float) Seconds the audit's queries may take altogether. No
+            limit if None.
+    Returns:
+        result: (AuditResult)
+    '''
+    start = time.monotonic()
+    if timeout is not None:
+        coll = TimeoutCollection(coll, start + timeout)
+    kwargs = { k : (coll.name if k == "coll_str" and v is None else v)
+               for k, v in kwargs.items() }
+    result = None
+    error = None
+    try:
+        result = func(coll=coll, **kwargs)
+        # Cursors run lazily; list them here so the work stays in this thread.
+        if hasattr(result, "next"):
+            result = mongo_audit.list_query(result)
+    except Exception as exc:
+        error = exc
+    return AuditResult(name, result, time.monotonic() - start, error,
+                       isinstance(error, ExecutionTimeout))
+
+
+def run_audits(coll, audit_lst = None, workers = None, timeout = None,
+               indexes = True):
+    '''Run audits concurrently over coll's client connection pool.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to audit.
+        audit_lst: (list) Audits to run. Names from AUDITS_MAP, or
+            (name, function, kwargs) tuples. All of AUDITS_MAP if None.
+        workers: (int) Threads. One per audit if None. Keep it within the
+            client's maxPoolSize.
+        timeout: (float or dict) Seconds each audit may take, or a dict of
+            seconds by audit name. No limit if None (or missing from the dict).
+        indexes: (bool) Ensure the indexes the audits need before running
+            them. See mongo_indexes.ensure_indexes.
+    Returns:
+        results: (dict) AuditResults by name, in the order given.
+        seconds: (float) Total run time.
+    '''
+    if audit_lst is None:
+        audit_lst = list(AUDITS_MAP)
+    audit_lst = [ (audit,) + AUDITS_MAP[audit] if isinstance(audit, str)
+                  else tuple(audit) for audit in audit_lst ]
+    if not isinstance(timeout, dict):
+        timeout = { name : timeout for name, _, _ in audit_lst }
+    if workers is None:
+        workers = max(1, len(audit_lst))
+
+    start = time.monotonic()
+    if indexes:
+        mongo_indexes.ensure_indexes(coll, [ func for _, func, _ in audit_lst ])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [ executor.submit(run_audit, coll, name, func, kwargs,
+                                    timeout.get(name))
+                    for name, func, kwargs in audit_lst ]
+        results = { future.result().name : future.result()
+                    for future in futures }
+    return results, time.monotonic() - start
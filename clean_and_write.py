@@ -1,8 +1,45 @@
 import re
-from functools import lru_cache
+from functools import lru_cache, partial
+from collections import namedtuple
 import codecs
+import glob
 import json
 import xml.etree.ElementTree as ET
+import multiprocessing as mp
+import os
+import time
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from osm_parsers import DOC_TYPES_LST, DOC_TYPES_SET, is_pbf, \
+    iter_changes, iter_elements, iter_parts, iter_positioned_parts
+
+# Optional faster JSON encoder.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# PBF input needs numpy.
+try:
+    import osm_pbf
+    from ref_index import RefIndex
+except ImportError:
+    osm_pbf = None
+
+# Way geometry needs numpy.
+try:
+    from node_locations import NodeLocations
+except ImportError:
+    NodeLocations = None
+
+# Only needed for loading straight into MongoDB.
+try:
+    import pymongo
+    import mongo_audit
+except ImportError:
+    pymongo = None
 
 
 # Using global constants rather than passing values around.
@@ -29,6 +66,19 @@ IS_IN_MAP = {"is_in": ["USA", "WA", "Whatcom County", "Bellingham"],
 
 CREATED_LST = ["version", "changeset", "timestamp", "user", "uid"]
 
+CREATED_SET = frozenset(CREATED_LST)
+
+# Creation info stored as integers in the compact schema. See compact_doc.
+CREATED_INT_LST = ["version", "changeset", "uid"]
+
+# process_map checkpoint file extension, and default elements between them.
+CHECKPOINT_STR = ".ckpt"
+CHECKPOINT_EVERY = 100000
+
+# Keys of closed ways that are loops rather than areas, unless tagged area=yes.
+# See is_area.
+LINEAR_KEYS_SET = frozenset(["highway", "barrier", "railway", "waterway"])
+
 # Exceptions mapped to acceptable street type formats.
 # Also other address abbreviations.
 STREET_TYPE_MAP = {"Ave": "Avenue", "Ave.": "Avenue", "Blvd": "Boulevard",
@@ -62,6 +112,21 @@ SUBDIVIDE_LST = ["addr", "cost", "fire_hydrant", "fuel", "payment",
 
 BAD_CHARS_LST = ["\"", "\'"]
 
+# Values to replace for a given key. {key: {old_value: new_value}}
+VAL_EDIT_MAP = {"shop": {"Cannabis": "cannabis",
+                         "Parcel_Shipping": "parcel_shipping"},
+                "inscription": {
+                    "Inscriptions too long to input, see Description.":
+                    "Inscription's too long to input; see description."},
+                "denomination": {"Non-denominational": "nondenominational"},
+                "access": {"privatem": "private"},
+                "kerb": {"rised": "rasied"},
+                "width": {"10'": "10 feet"},
+                "office": {"Whatcom_Educational_Credit_Union": "credit_union"}}
+
+# Tag key prefixes left unedited.
+RAW_PREFIX_LST = ["tiger", "gnis", "nist"]
+
 
 def clean_street_type(street):
     unit = None
@@ -165,6 +230,14 @@ def get_lstkeydict():
             "website": list()}
 
 
+# Keys that should have lists of values, and their output order.
+LIST_KEYS_IDX = {k: idx for idx, k in enumerate(get_lstkeydict())}
+LIST_KEYS_SET = frozenset(LIST_KEYS_IDX)
+
+# Keys to store as integers, for constant-time lookup.
+TO_INT_SET = frozenset(TO_INT_LST)
+
+
 def handle_list_keys(v):
     '''
     Assumes values in this field only use semicolons for separators.
@@ -192,191 +265,313 @@ def handle_bools(v):
     return v
 
 
-def misc_val_edits(k, v):
-    if k == "shop" and v in ["Cannabis",
-                             "Parcel_Shipping"]:
-        v = v.lower()
-    elif k == "inscription" and v == \
-    "Inscriptions too long to input, see Description.":
-        v = "Inscription's too long to input; see description."
+def _replace_val(vmap):
+    return lambda v: vmap.get(v, v) if isinstance(v, str) else v
+
+
+def _to_int(v):
+    return int(float(v))
+
+
+def _clean_maxheight(v):
+    if not any(bad_char in v for bad_char in BAD_CHARS_LST):
+        v = float(v)
+    return v
+
+
+def _clean_building_levels(v):
+    if v == "3s":
+        v = 3
+    return v
+
+
+@lru_cache(maxsize=None)
+def get_val_edit(k):
+    '''Get the value edit for a tag key, compiled once per key.
+    
+    Parameters:
+        k: (str) Cleaned tag key.
+    Returns:
+        val_edit: (function or None) value -> edited value. None if values of
+            this key are kept as is.
+    '''
+    val_edit = None
+    if k in VAL_EDIT_MAP:
+        val_edit = _replace_val(VAL_EDIT_MAP[k])
     elif k == "designation":
-        v = "_".join(v.lower().split())
-    elif k == "denomination" and v == "Non-denominational":
-        v = "nondenominational"
-    elif k == "access" and v == "privatem":
-        v = "private"
-    elif k == "kerb" and v == "rised":
-        v = "rasied"
-    elif k == "width" and v == "10'":
-        v = "10 feet"
-    elif k == "type":
-        v == v.lower()
-    elif k == "office" and v == "Whatcom_Educational_Credit_Union":
-        v = "credit_union"
-    elif k[:6] == "is_in" and k in IS_IN_MAP.keys():
-        v = IS_IN_MAP[k]
-    elif k in TO_INT_LST:
-        v = int(float(v))
-    elif k in TO_FLOAT_LST:
-        if k == "building:levels" and v == "3s":
-            v = 3
-        if k == "maxheight" and \
-        not any(bad_char in v for bad_char in BAD_CHARS_LST):
-            v = float(v)
+        val_edit = lambda v: "_".join(v.lower().split())
+    elif k == "is_in":
+        val_edit = lambda v: IS_IN_MAP["is_in"]
+    elif k in TO_INT_SET:
+        val_edit = _to_int
+    elif k == "building:levels":
+        val_edit = _clean_building_levels
+    elif k == "maxheight":
+        val_edit = _clean_maxheight
+
+    return val_edit
+
+
+def misc_val_edits(k, v):
+    val_edit = get_val_edit(k)
+    if val_edit:
+        v = val_edit(v)
     
     return v
-             
+
+
+# Precompiled handling of a tag key. See get_tag_rule.
+TagRule = namedtuple("TagRule", ["kind", "k", "k_split", "drop_v", "list_key",
+                                 "phone", "to_bool", "subdiv", "addr_k",
+                                 "val_edit"])
+
+
+@lru_cache(maxsize=None)
+def get_tag_rule(k):
+    '''Compile the cleaning rules that apply to a tag key, so each tag only
+    costs a cache lookup plus its value transforms. Memoized per distinct key.
     
+    Parameters:
+        k: (str) Raw tag key ("k" attribute).
+    Returns:
+        rule: (TagRule or None) None if the key has problem characters.
+            kind: "skip" (dropped), "raw" (written unedited unless value is
+                drop_v), or "clean".
+            k: Cleaned key.
+            k_split: Raw key split on ":".
+            drop_v: Value for which a raw tag is dropped.
+            list_key: Value is a semicolon-separated list.
+            phone: List values are phone numbers.
+            to_bool: Value is a yes/no boolean.
+            subdiv: Subdocument to write to, or None.
+            addr_k: Address subkey to audit, if subdiv is "addr". Address keys
+                with more than one subkey are dropped.
+            val_edit: Value edit for scalar keys. See get_val_edit.
+    '''
+    if PROBLEMCHARS.search(k):
+        return None
+
+    k_split = k.split(":")
+    rule = dict(kind="clean", k=k, k_split=k_split, drop_v=None,
+                list_key=False, phone=False, to_bool=False, subdiv=None,
+                addr_k=None, val_edit=None)
+    if k == "gnis:ST_alph":
+        rule["kind"] = "skip"
+    elif k == "gnis:County_num":
+        rule.update(kind="raw", drop_v="73")
+    elif k_split[0] in RAW_PREFIX_LST:
+        rule["kind"] = "raw"
+    else:
+        # Fix keys.
+        if k_split[0] == "contact":
+            k = ":".join(k_split[1:])
+        if SUBNUM_RE.search(k[-2:]):
+            k = k[:-2]
+        # Must happen before making subdocs ("wiki").
+        k = WRONG_KEY_MAP.get(k, k)
+        rule["k"] = k
+        if k in LIST_KEYS_SET:
+            rule["list_key"] = True
+            rule["phone"] = k in ["phone", "fax"]
+        rule["to_bool"] = k_split[0] in BOOL_TAGS_LST
+        if len(k_split) > 1 and k_split[0] in SUBDIVIDE_LST:
+            rule["subdiv"] = k_split[0]
+            if k_split[0] == "addr" and len(k_split) == 2:
+                rule["addr_k"] = k_split[1]
+        # List values are never edited.
+        elif not rule["list_key"]:
+            rule["val_edit"] = get_val_edit(k)
+
+    return TagRule(**rule)
+
+
+def shape_attribs(tag, attrib):
+    '''Shape the attributes of a top-level element into a new document.'''
+    doc_dict = {"doc_type": tag}
+    lat = None
+    lon = None
+    # Subdoc for creation info.
+    created_dict = dict()
+    for att_k, att_v in attrib.items():
+        if att_k == "id":
+            doc_dict["_id"] = att_v
+        elif att_k in CREATED_SET:
+            created_dict[att_k] = att_v
+        elif att_k == "lat":
+            lat = float(att_v)
+        elif att_k == "lon":
+            lon = float(att_v)
+        else:
+            doc_dict[att_k] = att_v
+    if lat is not None and lon is not None:
+        # Vector for lat/lon.
+        doc_dict["pos"] = [lat, lon]
+    if created_dict:
+        doc_dict["created"] = created_dict
+
+    return doc_dict
+
+
+# RunStats the pipeline reports to while instrumented. See instrument.
+_stats = None
+
+
+def report_anomaly(kind, example):
+    '''Count an anomaly in the instrumented run's stats, or print it.'''
+    if _stats is None:
+        print(kind + ":", example)
+    else:
+        _stats.anomaly(kind, example)
+    return
+
+
+def validate_doc(doc_dict):
+    '''Print documents missing required subdocs or holding the wrong ones.
+    All node documents should include a position, and not include node
+    references nor members. All way documents should include node references
+    but neither a position nor members. All relation documents should include
+    members, no position, and no node references.
+    '''
+    doc_type = doc_dict["doc_type"]
+    if doc_type == "node":
+        if "node_refs" in doc_dict or "members" in doc_dict \
+        or "pos" not in doc_dict:
+            report_anomaly("Invalid document", doc_dict)
+    elif doc_type == "way":
+        if "pos" in doc_dict or "members" in doc_dict \
+        or "node_refs" not in doc_dict:
+            report_anomaly("Invalid document", doc_dict)
+    elif doc_type == "relation":
+        if "pos" in doc_dict or "node_refs" in doc_dict \
+        or "members" not in doc_dict:
+            report_anomaly("Invalid document", doc_dict)
+    else:
+        report_anomaly("Document without type", doc_dict)
+    return
+
+
 def shape_element(element):
     doc_dict = dict()
 # Ignore outer elements.
-    if element.tag in ["node", "way", "relation"]:
+    if element.tag not in DOC_TYPES_SET:
+        return doc_dict
+    if not len(element):
+        return shape_parts(element.tag, element.attrib, ())
+    return shape_parts(element.tag, element.attrib,
+                       [(sub_el.tag, sub_el.attrib) for sub_el in element])
+
+
+def shape_parts(tag, attrib, sub_els):
+    '''Shape a top-level element given as parts, as from
+    osm_parsers.iter_parts.
+    
+    Parameters:
+        tag: (str) Element type ("node", "way", "relation").
+        attrib: (dict) Element attributes.
+        sub_els: (list(tuple)) Subelements. [(sub_tag, sub_attrib), ...]
+    Returns:
+        doc_dict: (dict) Shaped document.
+    '''
 # Get attributes.
-        doc_dict.update({"doc_type": element.tag})
-        # Vector for lat/lon.
-        pos_lst = [None,None]
-        # Subdoc for creation info.
-        created_dict = dict()
-        for att_k, att_v in element.attrib.items():
-            if att_k == "id":
-                doc_dict["_id"] = att_v
-            elif att_k in CREATED_LST:
-                created_dict.update({att_k: att_v})
-            elif att_k == "lat":
-                pos_lst[0] = float(att_v)
-            elif att_k == "lon":
-                pos_lst[1] = float(att_v)
-            else:
-                doc_dict[att_k] = att_v
-        if pos_lst[0] is not None and pos_lst[1] is not None:
-            doc_dict["pos"] = pos_lst
-        if created_dict:
-            doc_dict["created"] = created_dict
+    doc_dict = shape_attribs(tag, attrib)
+    # Untagged elements (most nodes) have nothing more to shape.
+    if not sub_els:
+        validate_doc(doc_dict)
+        return doc_dict
 
 # Get subelements.
-        # nd elements found in way elements.
-        node_refs = set()
-        # member elements in relation elements.
-        members = list()
-        # Keys that should have lists of values.
-        list_keys_dict = get_lstkeydict()
-        # is_in is a special case.
-        is_in = set()
-        # Subdocs for subdivided keys.
-        subdoc_dict = dict()
-        
-        # Handle subelements.
-        for sub_el in element.iter():
-            # Handle nd elements.
-            if sub_el.tag == "nd":
-                node_refs.add(sub_el.attrib["ref"])
-            # Handle member elements.
-            elif sub_el.tag == "member":
-                members.append({"type": sub_el.attrib["type"],
-                                "ref": sub_el.attrib["ref"],
-                                "role": sub_el.attrib["role"]})
-            # Handle tag elements.
-            elif sub_el.tag == "tag":
-                k = sub_el.attrib["k"]
-                v = sub_el.attrib["v"]
-                # Don't write tags with keys with problem characters.
-                if not PROBLEMCHARS.search(k):
-                    k_split = k.split(":")
-                    if k == "gnis:ST_alph":
-                        k = "gnis:ST_alpha"
-                    elif k == "gnis:County_num" and v == "73":
-                        v = "073"
-                    # Other than that, don't edit tiger, gnis, nist tags.
-                    elif k_split[0] not in ["tiger", "gnis", "nist"]:
-                # Fix keys.
-                        if k_split[0] == "contact":
-                            k = ":".join(k_split[1:])
-                        if SUBNUM_RE.search(k[-2:]):
-                            k = k[:-2]
-                            
-                        # Must happen before making subdocs ("wiki").
-                        if k in WRONG_KEY_MAP.keys():
-                            k = WRONG_KEY_MAP[k]
-                        if k in list_keys_dict.keys():
-                            v = handle_list_keys(v)
-                            # Format phone and fax within list creation.
-                            if k in ["phone", "fax"]:
-                                v = [format_phone(ph) for ph in v]
-                            list_keys_dict[k].extend(v)
-                        if k_split[0] in BOOL_TAGS_LST:
-                                v = handle_bools(v)
-                            
-                # Handle subdivided keys.   
-                        # Must happen after mapping wrong keys ("wiki").
-                        if len(k_split) > 1 \
-                        and k_split[0] in SUBDIVIDE_LST:
-                        # Log if overwriting scalar.
-                            if k_split[0] not in subdoc_dict.keys() \
-                            and k_split[0] in doc_dict.keys():
-                                print("Scalar over_written by subdoc:",
-                                      k_split)
-                            # addr is a special case.
-                            if k_split[0] == "addr":
-                                # Lose addr keys with more than one subkey.
-                                # Handle street cleanup.
-                                if len(k_split) == 2:
-                                    v, unit = audit_addr(k_split[1], v)
-                                    if unit:
-                                        subdoc_dict["addr"].\
-                                        update({"unit": unit})
-                                    subdoc_dict = subdiv_key(k, v,
-                                                             subdoc_dict)
-                            else:
-#                                 k = k + "_sub"
-                                subdoc_dict = (subdiv_key(k, v,
-                                                              subdoc_dict))
-                        # Log if overwriting subdoc.
-                        elif k_split[0] in subdoc_dict.keys():
-                            print("Subdoc over-written by scalar:",
-                                  k_split)
-                        else:    
-                            v = misc_val_edits(k, v)
-                            doc_dict[k] = v
+    # Containers are only made once a subelement needs them.
+    # nd elements found in way elements.
+    node_refs = None
+    # member elements in relation elements.
+    members = None
+    # Keys that should have lists of values.
+    list_keys_dict = None
+    # Subdocs for subdivided keys.
+    subdoc_dict = dict()
+
+    # Handle subelements.
+    for sub_tag, sub_attrib in sub_els:
+        # Handle nd elements.
+        if sub_tag == "nd":
+            if node_refs is None:
+                node_refs = set()
+            node_refs.add(sub_attrib["ref"])
+        # Handle member elements.
+        elif sub_tag == "member":
+            if members is None:
+                members = list()
+            members.append({"type": sub_attrib["type"],
+                            "ref": sub_attrib["ref"],
+                            "role": sub_attrib["role"]})
+        # Handle tag elements.
+        elif sub_tag == "tag":
+            v = sub_attrib["v"]
+            rule = get_tag_rule(sub_attrib["k"])
+            # Don't write tags with keys with problem characters.
+            if rule is None:
+                report_anomaly("Problem characters in", sub_attrib)
+            elif rule.kind == "raw":
+                # Don't edit tiger, gnis, nist tags.
+                if v != rule.drop_v:
+                    doc_dict[rule.k] = v
+            elif rule.kind == "clean":
+                k = rule.k
+                if rule.list_key:
+                    v = handle_list_keys(v)
+                    # Format phone and fax within list creation.
+                    if rule.phone:
+                        v = [format_phone(ph) for ph in v]
+                    if list_keys_dict is None:
+                        list_keys_dict = dict()
+                    if k in list_keys_dict:
+                        list_keys_dict[k].extend(v)
+                    else:
+                        list_keys_dict[k] = v
+                if rule.to_bool:
+                    v = handle_bools(v)
+
+            # Handle subdivided keys.
+                if rule.subdiv:
+                # Log if overwriting scalar.
+                    if rule.subdiv not in subdoc_dict \
+                    and rule.subdiv in doc_dict:
+                        report_anomaly("Scalar over_written by subdoc",
+                                       rule.k_split)
+                    # addr is a special case.
+                    if rule.subdiv == "addr":
+                        # Lose addr keys with more than one subkey.
+                        # Handle street cleanup.
+                        if rule.addr_k:
+                            v, unit = audit_addr(rule.addr_k, v)
+                            if unit:
+                                subdoc_dict["addr"].update({"unit": unit})
+                            subdiv_key(k, v, subdoc_dict)
                     else:
-                        doc_dict[k] = v
+                        subdiv_key(k, v, subdoc_dict)
+                # Log if overwriting subdoc.
+                elif rule.k_split[0] in subdoc_dict:
+                    report_anomaly("Subdoc over-written by scalar",
+                                   rule.k_split)
                 else:
-                    print("Problem characters in:", sub_el)
-                    
-        # Add list keys and subdocs/
-        if node_refs:
-            doc_dict["node_refs"] = sorted(list(node_refs))
-        if members:
-            doc_dict["members"] = members
-        if is_in:
-            doc_dict["is_in"] = sorted(list(is_in))
-        for key, lst in list_keys_dict.items():
-            if len(lst) > 0:
-                doc_dict[key] = lst
-        for subdoc_k in subdoc_dict.keys():
-            doc_dict[subdoc_k] = subdoc_dict[subdoc_k]
+                    if rule.val_edit:
+                        v = rule.val_edit(v)
+                    doc_dict[k] = v
+                
+    # Add list keys and subdocs.
+    if node_refs:
+        doc_dict["node_refs"] = sorted(node_refs)
+    if members:
+        doc_dict["members"] = members
+    if list_keys_dict:
+        # Keep the order of get_lstkeydict.
+        for key in sorted(list_keys_dict, key=LIST_KEYS_IDX.__getitem__):
+            doc_dict[key] = list_keys_dict[key]
+    for subdoc_k in subdoc_dict.keys():
+        doc_dict[subdoc_k] = subdoc_dict[subdoc_k]
             
-        # Validate.
-#         All node documents should include a position, and not include node
-#         references nor members. All way documents should include node
-#         references but neither a position nor members. All relation documents
-#         should include members, no position, and no node references.
-        if doc_dict["doc_type"] == "node":
-            if any(subdoc in ["node_refs", "members"] \
-                   for subdoc in doc_dict.keys()) \
-            or "pos" not in doc_dict.keys():
-                print("Invalid document:", doc_dict)
-        elif doc_dict["doc_type"] == "way":
-            if any(subdoc in ["pos", "members"] \
-                   for subdoc in doc_dict.keys()) \
-            or "node_refs" not in doc_dict.keys():
-                print("Invalid document:", doc_dict)
-        elif doc_dict["doc_type"] == "relation":
-            if any(subdoc in ["pos", "node_refs"] \
-                   for subdoc in doc_dict.keys()) \
-            or "members" not in doc_dict.keys():
-                print("Invalid document:", doc_dict)
-        else:
-            print("Document without type:", doc_dict)
+    # Validate.
+    validate_doc(doc_dict)
                 
     return doc_dict
 
@@ -410,6 +605,99 @@ def shape_element(element):
 # -width: 'Cedar Jumps Green Line' (caution about width?)
 
 
+def compact_doc(doc_dict, ts = False, ext_json = False):
+    '''Convert a shaped document to the compact schema, in place: _id,
+    node_refs, members.ref, and the CREATED_INT_LST creation info become
+    integers, so joins and indexes on them compare numbers instead of strings.
+    node_refs are re-sorted numerically.
+    
+    Parameters:
+        doc_dict: (dict) Shaped document.
+        ts: (bool) Also replace created.timestamp with created.ts, a date.
+        ext_json: (bool) Write ts as MongoDB extended JSON ({ "$date" : <str> })
+            for mongoimport, rather than a datetime for PyMongo.
+    Returns:
+        doc_dict: (dict) The same document.
+    '''
+    doc_dict["_id"] = int(doc_dict["_id"])
+    if "node_refs" in doc_dict:
+        doc_dict["node_refs"] = sorted(int(ref) for ref in doc_dict["node_refs"])
+    if "members" in doc_dict:
+        for member in doc_dict["members"]:
+            member["ref"] = int(member["ref"])
+    created_dict = doc_dict.get("created")
+    if created_dict:
+        for k in CREATED_INT_LST:
+            if k in created_dict:
+                created_dict[k] = int(created_dict[k])
+        if ts and "timestamp" in created_dict:
+            timestamp = created_dict.pop("timestamp")
+            if ext_json:
+                created_dict["ts"] = { "$date" : timestamp }
+            else:
+                # OSM timestamps are UTC, e.g. "2020-01-01T00:00:00Z".
+                created_dict["ts"] = datetime.fromisoformat(
+                    timestamp.replace("Z", "+00:00"))
+    return doc_dict
+
+
+def add_geojson(doc_dict):
+    '''Add loc, a GeoJSON Point, to a document with a pos. GeoJSON puts
+    longitude first, where pos has latitude first, and can be indexed with
+    2dsphere for spherical queries (see mongo_audit.get_radius_filter).
+    
+    Parameters:
+        doc_dict: (dict) Shaped document.
+    Returns:
+        doc_dict: (dict) The same document.
+    '''
+    pos = doc_dict.get("pos")
+    if pos:
+        doc_dict["loc"] = { "type" : "Point", "coordinates" : [pos[1], pos[0]] }
+    return doc_dict
+
+
+def _finish_doc(doc_dict, compact, ts, geojson, ext_json):
+    if compact:
+        compact_doc(doc_dict, ts=ts, ext_json=ext_json)
+    if geojson:
+        add_geojson(doc_dict)
+    return doc_dict
+
+
+def is_area(doc_dict):
+    '''Whether a closed way encloses an area, going by its area tag, else by
+    whether it has any LINEAR_KEYS_SET keys (e.g. a roundabout).'''
+    area = doc_dict.get("area")
+    if area is not None:
+        return area not in ("no", False)
+    return LINEAR_KEYS_SET.isdisjoint(doc_dict)
+
+
+def add_way_geometry(doc_dict, sub_els, node_locs):
+    '''Add geometry to a way document from its nodes' locations: line, bbox,
+    centroid, and loc, a GeoJSON LineString, or Polygon if an area. loc can
+    be indexed with nodes' loc (see add_geojson) for mongo_audit.find_within.
+    Other documents are left as they are.
+    
+    Parameters:
+        doc_dict: (dict) Shaped document.
+        sub_els: (list(tuple)) The element's subelements, for its nd elements
+            in way order. (node_refs are deduplicated and sorted.)
+        node_locs: (node_locations.NodeLocations) Index of node locations.
+    Returns:
+        doc_dict: (dict) The same document.
+    '''
+    if doc_dict.get("doc_type") != "way":
+        return doc_dict
+    refs = [int(sub_attrib["ref"]) for sub_tag, sub_attrib in sub_els
+            if sub_tag == "nd"]
+    geometry = node_locs.get_geometry(refs, area=is_area(doc_dict))
+    if geometry:
+        doc_dict.update(geometry)
+    return doc_dict
+
+
 def write_el(el, file_out, mode = "a", pretty = True):
     if pretty:
         with codecs.open(file_out, mode) as fo:
@@ -420,11 +708,884 @@ def write_el(el, file_out, mode = "a", pretty = True):
     return
 
 
-def process_map(file_in, fo_pre, pretty = True):
-    with codecs.open(fo_pre+".json", "a") as fo:
-        for _, element in ET.iterparse(file_in):
-                el = shape_element(element)
-                if el:
-                    write_el(el=el, file_out=fo_pre+".json")
+def get_encoder(encoder = "json", pretty = True):
+    '''Get a function that serializes a document to a line of JSON bytes.
+    
+    Parameters:
+        encoder: (str or function) "json" (stdlib), "orjson", or "auto" (orjson
+            if installed, else json). A function is used as is and must take a
+            document and return str or bytes.
+        pretty: (bool) Indent JSON output.
+    Returns:
+        encode: (function) document -> bytes, newline included.
+    '''
+    if encoder == "auto":
+        encoder = "orjson" if orjson else "json"
+    if encoder == "json":
+        indent = 2 if pretty else None
+        encode = lambda el: (json.dumps(el, indent=indent) + "\n").encode()
+    elif encoder == "orjson":
+        if orjson is None:
+            raise ImportError("orjson is not installed.")
+        option = orjson.OPT_APPEND_NEWLINE
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        encode = lambda el: orjson.dumps(el, option=option)
+    elif callable(encoder):
+        def encode(el):
+            line = encoder(el)
+            if isinstance(line, str):
+                line = line.encode()
+            return line + b"\n"
+    else:
+        raise ValueError("Unknown encoder: " + str(encoder))
+
+    return encode
+
+
+class JSONWriter:
+    '''Writes documents as JSON to a single open file, batching serialized
+    lines into large buffered writes. Use as a context manager, or call close().
+    
+    Parameters:
+        file_out: (str) Output filepath.
+        mode: (str) "a" to append, "w" to overwrite.
+        pretty: (bool) Indent JSON output.
+        encoder: (str or function) See get_encoder.
+        batch_size: (int) Number of documents to serialize per write.
+    '''
+    def __init__(self, file_out, mode = "a", pretty = True, encoder = "json",
+                 batch_size = 1000):
+        self.encode = get_encoder(encoder=encoder, pretty=pretty)
+        self.batch_size = batch_size
+        self.batch = list()
+        self.count = 0
+        self.fo = open(file_out, mode + "b", buffering=1024*1024)
+
+    def write(self, el):
+        self.batch.append(self.encode(el))
+        self.count += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return
+
+    def flush(self):
+        '''Write the batch into the file's buffer, which only goes out to
+        the OS when full, or on close.'''
+        if self.batch:
+            self.fo.write(b"".join(self.batch))
+            self.batch = list()
+        return
+
+    def close(self):
+        if not self.fo.closed:
+            self.flush()
+            self.fo.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# Functions timed as stages while instrumented. Times include the functions
+# they call: shape_parts includes tag handling, audit_addr clean_street_type.
+TIMED_FUNCS_LST = ["shape_parts", "audit_addr", "clean_street_type",
+                   "format_phone", "handle_list_keys", "compact_doc",
+                   "add_geojson", "add_way_geometry"]
+
+# What instrument replaced, to put back.
+_originals = dict()
+
+
+@lru_cache(maxsize=None)
+def get_rule_labels(k):
+    '''Name the cleaning rules a tag key hits, for counting.
+    
+    Parameters:
+        k: (str) Raw tag key.
+    Returns:
+        labels: (tuple(str)) e.g. ("clean", "subdiv:addr", "addr:street").
+    '''
+    rule = get_tag_rule.__wrapped__(k)
+    if rule is None:
+        return ("problem_chars",)
+    if rule.kind != "clean":
+        return (rule.kind,)
+    labels = ["clean"]
+    if rule.list_key:
+        labels.append("list_key")
+    if rule.phone:
+        labels.append("phone")
+    if rule.to_bool:
+        labels.append("to_bool")
+    if rule.subdiv:
+        labels.append("subdiv:" + rule.subdiv)
+    if rule.addr_k:
+        labels.append("addr:" + rule.addr_k)
+    if rule.val_edit:
+        labels.append("val_edit:" + rule.k)
+    return tuple(labels)
+
+
+def instrument(stats):
+    '''Gather timings and counts from the pipeline into stats, until
+    uninstrument is called. Wraps this module's functions, so the pipeline
+    costs nothing extra when not instrumented:
+        - TIMED_FUNCS_LST, JSON encoding ("encode"), and JSONWriter writes
+          ("write") are timed. Parsing is timed as "parse", or as "read" for
+          PBF blobs decoded by workers.
+        - Each shaped element counts toward progress.
+        - Each tag counts a hit for each rule it hits. See get_rule_labels.
+        - Anomalies are counted and sampled instead of printed.
+    Pool workers forked while instrumented send their stats back with their
+    results.
+    
+    Parameters:
+        stats: (run_stats.RunStats) Where to gather.
+    Returns:
+        None
+    '''
+    global _stats
+    uninstrument()
+    module_dict = globals()
+    for name in TIMED_FUNCS_LST:
+        _originals[name] = module_dict[name]
+        module_dict[name] = stats.timer(name, module_dict[name],
+                                        progress=(name == "shape_parts"))
+
+    rule_func = get_tag_rule
+    hits = stats.hits
+
+    def counted_rule(k):
+        for label in get_rule_labels(k):
+            hits[label] += 1
+        return rule_func(k)
+    counted_rule.__wrapped__ = rule_func.__wrapped__
+    _originals["get_tag_rule"] = rule_func
+    module_dict["get_tag_rule"] = counted_rule
+
+    encoder_func = get_encoder
+
+    def timed_encoder(*args, **kwargs):
+        return stats.timer("encode", encoder_func(*args, **kwargs))
+    _originals["get_encoder"] = encoder_func
+    module_dict["get_encoder"] = timed_encoder
+
+    _originals["JSONWriter.flush"] = JSONWriter.flush
+    JSONWriter.flush = stats.timer("write", JSONWriter.flush)
+    _stats = stats
+    return
+
+
+def uninstrument():
+    '''Put back what instrument wrapped.'''
+    global _stats
+    module_dict = globals()
+    for name, func in _originals.items():
+        if name == "JSONWriter.flush":
+            JSONWriter.flush = func
+        else:
+            module_dict[name] = func
+    _originals.clear()
+    _stats = None
+    return
+
+
+def _time_iter(name, iterable):
+    '''Time a stage that produces items, such as parsing, if instrumented.'''
+    if _stats is None:
+        return iterable
+    return _stats.time_iter(name, iterable)
+
+
+def iter_all_parts(file_in, stream = True, parser = "etree"):
+    '''Stream the top-level elements of an OSM doc as parts. See
+    osm_parsers.iter_parts.
+    
+    Parameters:
+        file_in: (str) Filepath to OSM XML or PBF.
+        stream: (bool) See process_map.
+        parser: (str) See process_map.
+    Yields:
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...])
+    '''
+    if stream or is_pbf(file_in):
+        return iter_parts(file_in, parser=parser)
+    return ((element.tag, element.attrib,
+             [(sub_el.tag, sub_el.attrib) for sub_el in element])
+            for _, element in ET.iterparse(file_in)
+            if element.tag in DOC_TYPES_SET)
+
+
+def iter_docs(file_in, stream = True, parser = "etree", compact = False,
+              ts = False, geojson = False, ext_json = False, node_locs = None):
+    '''Stream shaped documents from an OSM doc.
+    
+    Parameters:
+        file_in: (str) Filepath to OSM XML or PBF.
+        stream: (bool) See process_map.
+        parser: (str) See process_map.
+        compact: (bool) See process_map.
+        ts: (bool) See process_map.
+        geojson: (bool) See process_map.
+        ext_json: (bool) See compact_doc.
+        node_locs: (node_locations.NodeLocations) See process_map.
+    Yields:
+        el: (dict) Shaped document.
+    '''
+    parts_iter = _time_iter("parse", iter_all_parts(file_in, stream=stream,
+                                                    parser=parser))
+    if node_locs is not None:
+        parts_iter = _locate_parts(parts_iter, node_locs)
+    for parts in parts_iter:
+        el = shape_parts(*parts)
+        if el:
+            if node_locs is not None:
+                add_way_geometry(el, parts[2], node_locs)
+            if compact or geojson:
+                _finish_doc(el, compact, ts, geojson, ext_json)
+            yield el
+
+
+def pack_parts(parts):
+    '''Copy an element's parts so they can be kept and pickled and sent to
+    worker processes.
+    
+    Parameters:
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...])
+    Returns:
+        packed: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...])
+    '''
+    tag, attrib, sub_els = parts
+    return (tag, dict(attrib),
+            [(sub_tag, dict(sub_attrib)) for sub_tag, sub_attrib in sub_els])
+
+
+def _index_parts(elements, ref_index):
+    for parts in elements:
+        ref_index.add_parts(parts)
+        yield parts
+
+
+def _locate_parts(elements, node_locs):
+    '''Add nodes to node_locs, finishing it before the first other element
+    is passed on to be shaped, or at the end if there are none.'''
+    for parts in elements:
+        if parts[0] == "node":
+            node_locs.add_parts(parts)
+        elif not node_locs.finished:
+            node_locs.finish()
+        yield parts
+    node_locs.finish()
+
+
+def iter_batches(elements, batch_size):
+    '''Group element parts into lists of packed parts.'''
+    batch = list()
+    for parts in elements:
+        batch.append(pack_parts(parts))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+# Per-process settings for pool workers, set by _init_worker.
+_worker_state = dict()
+
+
+def _init_worker(encoder, pretty, fo_pre, shard_counter, finish_kw,
+                 index_refs = False, locs_path = None, in_pool = True):
+    _worker_state["encode"] = get_encoder(encoder=encoder, pretty=pretty)
+    _worker_state["encoder"] = encoder
+    _worker_state["pretty"] = pretty
+    # Options for _finish_doc, if any are set.
+    _worker_state["finish_kw"] = finish_kw if any(finish_kw.values()) else None
+    _worker_state["index_refs"] = index_refs
+    # Opened on the first way, once the main process has finished it.
+    _worker_state["locs_path"] = locs_path
+    _worker_state["node_locs"] = None
+    if in_pool and _stats is not None:
+        # Gather afresh for the main process, which merges what workers send
+        # back and reports progress itself.
+        _stats.progress_every = None
+        _stats.reset()
+    if shard_counter is not None:
+        with shard_counter.get_lock():
+            shard_n = shard_counter.value
+            shard_counter.value += 1
+        _worker_state["file_out"] = fo_pre + "_" + str(shard_n) + ".json"
+    return
+
+
+def _run_counted(func, arg):
+    '''Run a pool function, returning what this worker gathered with the
+    result.'''
+    if _stats is None:
+        return func(arg), None
+    return func(arg), _stats.pop()
+
+
+def _merge_counted(results):
+    for result, gathered in results:
+        if gathered is not None:
+            _stats.merge(gathered)
+        yield result
+
+
+def _pool_map(imap, func, iterable):
+    '''Call pool.imap or imap_unordered, merging the stats workers gather,
+    if instrumented.'''
+    if _stats is None:
+        return imap(func, iterable)
+    return _merge_counted(imap(partial(_run_counted, func), iterable))
+
+
+def _shape_packed(packed):
+    '''Shape a packed element with this worker's options.'''
+    el = shape_parts(*packed)
+    if el:
+        if _worker_state["locs_path"] and el["doc_type"] == "way":
+            if _worker_state["node_locs"] is None:
+                _worker_state["node_locs"] = NodeLocations(
+                    _worker_state["locs_path"], mode="r")
+            add_way_geometry(el, packed[2], _worker_state["node_locs"])
+        if _worker_state["finish_kw"]:
+            _finish_doc(el, ext_json=True, **_worker_state["finish_kw"])
+    return el
+
+
+def _shape_batch(batch):
+    '''Shape and serialize a batch of packed elements.'''
+    encode = _worker_state["encode"]
+    lines = list()
+    for packed in batch:
+        el = _shape_packed(packed)
+        if el:
+            lines.append(encode(el))
+    return b"".join(lines)
+
+
+def _clear_shards(fo_pre):
+    '''Remove shards, fo_pre + "_<n>.json", left by an earlier run. Workers
+    append each batch to their shard, so they'd otherwise be written twice.'''
+    shard_re = re.compile(re.escape(fo_pre) + r"_\d+\.json")
+    for file_out in glob.glob(glob.escape(fo_pre) + "_*.json"):
+        if shard_re.fullmatch(file_out):
+            os.remove(file_out)
+    return
+
+
+def _shape_batch_to_shard(batch):
+    '''Shape a batch of packed elements and append it to this worker's shard.'''
+    with JSONWriter(_worker_state["file_out"], mode="a",
+                    pretty=_worker_state["pretty"],
+                    encoder=_worker_state["encoder"]) as writer:
+        for packed in batch:
+            el = _shape_packed(packed)
+            if el:
+                writer.write(el)
+    return _worker_state["file_out"]
+
+
+def _index_blob(parts_lst):
+    '''Index a decoded PBF block, if this worker indexes references.'''
+    if not _worker_state["index_refs"]:
+        return None
+    blob_index = RefIndex()
+    for parts in parts_lst:
+        blob_index.add_parts(parts)
+    return blob_index
+
+
+def _shape_blob(blob):
+    '''Decode a PBF block, then shape and serialize it.'''
+    parts_lst = osm_pbf.parse_blob(blob)
+    return _shape_batch(parts_lst), _index_blob(parts_lst)
+
+
+def _shape_blob_to_shard(blob):
+    '''Decode a PBF block, and shape it into this worker's shard.'''
+    parts_lst = osm_pbf.parse_blob(blob)
+    return _shape_batch_to_shard(parts_lst), _index_blob(parts_lst)
+
+
+def _process_pbf(file_in, fo_pre, pretty, encoder, workers, ordered,
+                 ref_index, finish_kw, append):
+    '''process_map for PBF with workers: each worker decodes whole blocks
+    as well as shaping them, so the main process only reads raw blobs.'''
+    _, data_blobs = osm_pbf.iter_data_blobs(file_in)
+    data_blobs = _time_iter("read", data_blobs)
+    index_refs = ref_index is not None
+    if ordered:
+        with mp.Pool(workers, initializer=_init_worker,
+                     initargs=(encoder, pretty, fo_pre, None, finish_kw,
+                               index_refs)) as pool, \
+        open(fo_pre+".json", "ab" if append else "wb") as fo:
+            for lines, blob_index in _pool_map(pool.imap, _shape_blob,
+                                               data_blobs):
+                fo.write(lines)
+                if index_refs:
+                    ref_index.merge(blob_index)
+        return [fo_pre+".json"]
+
+    if not append:
+        _clear_shards(fo_pre)
+    shard_counter = mp.Value("i", 0)
+    files_out = set()
+    with mp.Pool(workers, initializer=_init_worker,
+                 initargs=(encoder, pretty, fo_pre, shard_counter, finish_kw,
+                           index_refs)) as pool:
+        for file_out, blob_index in _pool_map(pool.imap_unordered,
+                                              _shape_blob_to_shard, data_blobs):
+            files_out.add(file_out)
+            if index_refs:
+                ref_index.merge(blob_index)
+    return sorted(files_out)
+
+
+def read_checkpoint(fo_pre):
+    '''Read the checkpoint of a process_map run.
+    
+    Parameters:
+        fo_pre: (str) Output filepath without the ".json" extension.
+    Returns:
+        checkpoint: (dict or None) None if there isn't one. Holds the run's
+            input and options, and where it got to: "position" (see
+            osm_parsers.iter_positioned_parts) and "last" ([tag, id]) of the
+            last element written, "elements" written, "out_offset" (bytes of
+            output written), and whether the run is "done".
+    '''
+    try:
+        with open(fo_pre + CHECKPOINT_STR) as fi:
+            checkpoint = json.load(fi)
+    except FileNotFoundError:
+        return None
+    if isinstance(checkpoint["position"], list):
+        checkpoint["position"] = tuple(checkpoint["position"])
+    return checkpoint
+
+
+def _save_checkpoint(fo_pre, fo, checkpoint):
+    '''Sync the output, then replace the checkpoint with one pointing at its
+    end, so a checkpoint never points past what's on disk.'''
+    fo.flush()
+    os.fsync(fo.fileno())
+    checkpoint["out_offset"] = fo.tell()
+    temp_path = fo_pre + CHECKPOINT_STR + ".tmp"
+    with open(temp_path, "w") as fo_ckpt:
+        json.dump(checkpoint, fo_ckpt)
+        fo_ckpt.flush()
+        os.fsync(fo_ckpt.fileno())
+    os.replace(temp_path, fo_pre + CHECKPOINT_STR)
+    return
+
+
+def _iter_positioned_batches(elements, batch_size, meta):
+    '''Group positioned parts into lists of parts, noting each list's size,
+    and the position and [tag, id] of its last element, in meta.'''
+    batch = list()
+    for position, parts in elements:
+        batch.append(parts)
+        if len(batch) >= batch_size:
+            meta.append((len(batch), position, [parts[0], parts[1]["id"]]))
+            yield batch
+            batch = list()
+    if batch:
+        meta.append((len(batch), position, [parts[0], parts[1]["id"]]))
+        yield batch
+
+
+def _write_checkpointed(results, meta, fo_pre, checkpoint, every):
+    with open(fo_pre+".json", "ab") as fo:
+        since = 0
+        for lines in results:
+            fo.write(lines)
+            n, position, last = meta.popleft()
+            checkpoint["elements"] += n
+            checkpoint["position"] = position
+            checkpoint["last"] = last
+            since += n
+            if since >= every:
+                _save_checkpoint(fo_pre, fo, checkpoint)
+                since = 0
+        checkpoint["done"] = True
+        _save_checkpoint(fo_pre, fo, checkpoint)
+    return
+
+
+def _process_checkpointed(file_in, fo_pre, pretty, encoder, workers,
+                          batch_size, finish_kw, every, resume):
+    '''process_map with checkpoints, writing a single file in input order.'''
+    options = { "file_in" : os.path.abspath(file_in),
+                "size" : os.path.getsize(file_in), "pretty" : pretty,
+                "encoder" : encoder if isinstance(encoder, str)
+                            else encoder.__name__ }
+    options.update(finish_kw)
+    checkpoint = read_checkpoint(fo_pre) if resume else None
+    if checkpoint is None:
+        checkpoint = dict(options, position=None, last=None, elements=0,
+                          out_offset=0, done=False)
+        with open(fo_pre+".json", "wb") as fo:
+            _save_checkpoint(fo_pre, fo, checkpoint)
+    elif any(checkpoint.get(k) != v for k, v in options.items()):
+        raise ValueError("Checkpoint is for another input or other options: "
+                         + fo_pre + CHECKPOINT_STR)
+    if checkpoint["done"]:
+        return [fo_pre+".json"]
+
+    # Drop output written after the checkpoint.
+    os.truncate(fo_pre+".json", checkpoint["out_offset"])
+    elements = iter_positioned_parts(file_in, checkpoint["position"])
+    elements = _time_iter("parse", elements)
+    if checkpoint["position"] is not None:
+        # Resume after the last element written.
+        _, parts = next(elements, (None, None))
+        if parts is None or [parts[0], parts[1]["id"]] != checkpoint["last"]:
+            raise ValueError("Checkpoint doesn't match the input: "
+                             + fo_pre + CHECKPOINT_STR)
+    meta = deque()
+    batches = _iter_positioned_batches(elements, batch_size, meta)
+    if workers == 1:
+        # Shape in this process, with the workers' code.
+        _init_worker(encoder, pretty, fo_pre, None, finish_kw, in_pool=False)
+        _write_checkpointed(map(_shape_batch, batches), meta, fo_pre,
+                            checkpoint, every)
+    else:
+        with mp.Pool(workers, initializer=_init_worker,
+                     initargs=(encoder, pretty, fo_pre, None,
+                               finish_kw)) as pool:
+            _write_checkpointed(_pool_map(pool.imap, _shape_batch, batches),
+                                meta, fo_pre, checkpoint, every)
+    return [fo_pre+".json"]
+
+
+def process_map(file_in, fo_pre, pretty = True, stream = True,
+                encoder = "json", workers = 1, batch_size = 1000,
+                ordered = True, parser = "etree", ref_index = None,
+                compact = False, ts = False, geojson = False,
+                node_locs = None, checkpoint = None, resume = False,
+                stats = None, append = False):
+    '''Clean an OSM doc and write it to JSON.
+    
+    Parameters:
+        file_in: (str) Filepath to OSM XML, or to OSM PBF (".pbf").
+        fo_pre: (str) Output filepath without the ".json" extension.
+        pretty: (bool) Indent JSON output.
+        stream: (bool) Free each element once it's shaped, keeping memory
+            constant. If False, builds the whole tree in memory.
+        encoder: (str or function) JSON encoder. See get_encoder. Functions must
+            be defined at module level to be used with workers.
+        workers: (int) Number of processes shaping elements. 1 runs serially;
+            None uses all CPUs.
+        batch_size: (int) Number of elements sent to a worker at a time. PBF
+            is sent a whole block (up to 8000 elements) at a time instead.
+        ordered: (bool) With workers, write a single file in input order,
+            identical to a serial run. If False, each worker writes its own
+            shard, fo_pre + "_<n>.json", in no particular order.
+        parser: (str) Streaming parser backend: "etree", "expat", "lxml", or
+            "auto". See osm_parsers.get_parser.
+        ref_index: (ref_index.RefIndex) Index to add each document's id and
+            references to, for auditing references without MongoDB.
+        compact: (bool) Write the compact schema, with integer ids, references,
+            and creation info. See compact_doc.
+        ts: (bool) With compact, replace created.timestamp with a created.ts
+            date.
+        geojson: (bool) Give nodes a GeoJSON Point, loc, as well as pos. See
+            add_geojson.
+        node_locs: (node_locations.NodeLocations) New index to add node
+            locations to, for adding geometry to ways. See add_way_geometry.
+            Nodes must come before ways, as in OSM files. With workers, PBF
+            blocks are decoded in the main process.
+        checkpoint: (int) Record progress in fo_pre + ".ckpt" about every
+            this many elements, so an interrupted run can be resumed. The
+            output is overwritten rather than appended to. XML is parsed with
+            expat (see osm_parsers.iter_positioned_parts). Needs ordered
+            output, and can't be used with ref_index or node_locs.
+        resume: (bool) Pick up an interrupted run from its checkpoint, with
+            the same input and options, truncating output written after it.
+            The result is identical to an uninterrupted run. Starts over if
+            there is no checkpoint. Checkpoints every CHECKPOINT_EVERY
+            elements if checkpoint is None.
+        stats: (run_stats.RunStats) Gather stage timings, rule hits,
+            anomalies, and progress into stats for this run, instead of
+            printing anomalies. See instrument.
+        append: (bool) Append to the output of an earlier run, rather than
+            overwriting it (or removing its shards). Can't be used with
+            checkpoint or resume.
+    Returns:
+        files_out: (list(str)) Filepaths written.
+    '''
+    if stats is not None:
+        instrument(stats)
+        try:
+            return process_map(file_in, fo_pre, pretty=pretty, stream=stream,
+                               encoder=encoder, workers=workers,
+                               batch_size=batch_size, ordered=ordered,
+                               parser=parser, ref_index=ref_index,
+                               compact=compact, ts=ts, geojson=geojson,
+                               node_locs=node_locs, checkpoint=checkpoint,
+                               resume=resume, append=append)
+        finally:
+            uninstrument()
+    if workers is None:
+        workers = os.cpu_count()
+
+    if checkpoint or resume:
+        if append:
+            raise ValueError("Checkpointed output can't be appended to.")
+        if ref_index is not None or node_locs is not None:
+            raise ValueError("Checkpoints can't restore ref_index or node_locs.")
+        if workers > 1 and not ordered:
+            raise ValueError("Checkpoints need ordered output.")
+        return _process_checkpointed(
+            file_in, fo_pre, pretty, encoder, workers, batch_size,
+            { "compact" : compact, "ts" : ts, "geojson" : geojson },
+            checkpoint or CHECKPOINT_EVERY, resume)
+
+    if workers == 1:
+        with JSONWriter(fo_pre+".json", mode="a" if append else "w",
+                        pretty=pretty, encoder=encoder) as writer:
+            for el in iter_docs(file_in, stream=stream, parser=parser,
+                                compact=compact, ts=ts, geojson=geojson,
+                                ext_json=True, node_locs=node_locs):
+                writer.write(el)
+                if ref_index is not None:
+                    ref_index.add_doc(el)
+        files_out = [fo_pre+".json"]
+        return files_out
+
+    finish_kw = { "compact" : compact, "ts" : ts, "geojson" : geojson }
+    if is_pbf(file_in) and node_locs is None:
+        return _process_pbf(file_in, fo_pre, pretty, encoder, workers, ordered,
+                            ref_index, finish_kw, append)
+    elements = iter_all_parts(file_in, stream=stream, parser=parser)
+    elements = _time_iter("parse", elements)
+    if ref_index is not None:
+        elements = _index_parts(elements, ref_index)
+    locs_path = None
+    if node_locs is not None:
+        elements = _locate_parts(elements, node_locs)
+        locs_path = node_locs.path
+    if ordered:
+        with mp.Pool(workers, initializer=_init_worker,
+                     initargs=(encoder, pretty, fo_pre, None,
+                               finish_kw, False, locs_path)) as pool, \
+        open(fo_pre+".json", "ab" if append else "wb") as fo:
+            for lines in _pool_map(pool.imap, _shape_batch,
+                                   iter_batches(elements, batch_size)):
+                fo.write(lines)
+        files_out = [fo_pre+".json"]
+    else:
+        if not append:
+            _clear_shards(fo_pre)
+        shard_counter = mp.Value("i", 0)
+        with mp.Pool(workers, initializer=_init_worker,
+                     initargs=(encoder, pretty, fo_pre, shard_counter,
+                               finish_kw, False, locs_path)) as pool:
+            files_out = set(_pool_map(pool.imap_unordered,
+                                      _shape_batch_to_shard,
+                                      iter_batches(elements, batch_size)))
+        files_out = sorted(files_out)
+
+    return files_out
+
+
+
+def _write_batch(coll, batch, upsert):
+    if upsert:
+        result = coll.bulk_write([pymongo.ReplaceOne({ "_id" : el["_id"] }, el,
+                                                     upsert=True)
+                                  for el in batch], ordered=False)
+        return result.upserted_count + result.matched_count
+    result = coll.insert_many(batch, ordered=False)
+    return len(result.inserted_ids)
+
+
+def load_map(file_in, coll, batch_size = 1000, in_flight = 2, upsert = False,
+             stream = True, parser = "etree", ref_index = None,
+             compact = False, ts = False, geojson = False, node_locs = None):
+    '''Clean an OSM doc and load it straight into a MongoDB collection,
+    without writing JSON to disk.
+    
+    Parameters:
+        file_in: (str) Filepath to OSM XML or PBF.
+        coll: (MongoDB collection) Collection to load into.
+        batch_size: (int) Number of documents per unordered insert_many or
+            bulk_write.
+        in_flight: (int) Number of batches sent to the server concurrently while
+            the next batch is shaped.
+        upsert: (bool) Replace documents by _id, inserting missing ones, so the
+            load can be rerun over an existing collection. Otherwise, insert
+            only; duplicate _ids raise pymongo.errors.BulkWriteError.
+        stream: (bool) See process_map.
+        parser: (str) See process_map.
+        ref_index: (ref_index.RefIndex) See process_map.
+        compact: (bool) See process_map.
+        ts: (bool) See process_map.
+        geojson: (bool) See process_map.
+        node_locs: (node_locations.NodeLocations) See process_map.
+    Returns:
+        stats: (dict) { "docs" : <shaped>, "written" : <inserted, upserted or
+            matched>, "seconds" : <elapsed>, "docs_per_sec" : <docs/seconds> }
+    '''
+    if upsert and pymongo is None:
+        raise ImportError("pymongo is required for upsert mode.")
+    start = time.perf_counter()
+    docs = 0
+    written = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=in_flight) as executor:
+        batch = list()
+        for el in iter_docs(file_in, stream=stream, parser=parser,
+                            compact=compact, ts=ts, geojson=geojson,
+                            node_locs=node_locs):
+            batch.append(el)
+            docs += 1
+            if ref_index is not None:
+                ref_index.add_doc(el)
+            if len(batch) >= batch_size:
+                # Wait on the oldest batch before exceeding the limit.
+                if len(pending) >= in_flight:
+                    written += pending.popleft().result()
+                pending.append(executor.submit(_write_batch, coll, batch,
+                                               upsert))
+                batch = list()
+        if batch:
+            pending.append(executor.submit(_write_batch, coll, batch, upsert))
+        while pending:
+            written += pending.popleft().result()
+    if pymongo is not None:
+        # Even a reload with the same count invalidates cached audits, and
+        # "ref_docs" needs rebuilding rather than refreshing.
+        mongo_audit.bump_generation(coll=coll)
+        mongo_audit.reset_ref_build(coll=coll)
+    seconds = time.perf_counter() - start
+
+    stats = { "docs" : docs, "written" : written, "seconds" : seconds,
+              "docs_per_sec" : docs / seconds if seconds else 0.0 }
+    return stats
+
+
+def _write_changes(coll, ops, stats, states, deleted_set):
+    '''Write a batch of changes, then fix states on the written documents.
+    Adds the _ids deleted to deleted_set, and drops the ones written.'''
+    result = coll.bulk_write(list(ops.values()), ordered=False)
+    stats["upserted"] += result.upserted_count
+    stats["replaced"] += result.matched_count
+    stats["deleted"] += result.deleted_count
+    written_ids = list()
+    for _id, op in ops.items():
+        if isinstance(op, pymongo.ReplaceOne):
+            written_ids.append(_id)
+            deleted_set.discard(_id)
+        else:
+            deleted_set.add(_id)
+    if states:
+        if written_ids:
+            stats["states"] += mongo_audit.update_changed_states(coll,
+                                                                 written_ids)
+    ops.clear()
+    return
+
+
+def apply_changes(file_in, coll, batch_size = 1000, ref_docs = True,
+                  states = True, compact = False, ts = False, geojson = False):
+    '''Apply OSM change files (.osc) to a collection, instead of reloading it.
+    Created and modified elements are shaped as by process_map and replace
+    their documents by _id and doc_type, inserting missing ones; deleted
+    elements' documents are removed. An element whose _id is taken by a
+    document of another type raises a BulkWriteError rather than replacing
+    it. Changes go out in unordered bulk writes, one batch at a time
+    and with one change per _id in a batch, so replaying a series of diffs
+    leaves the latest version of each element.
+    
+    Parameters:
+        file_in: (str or list(str)) Filepath(s) to osmChange XML, applied in
+            order. See osm_parsers.iter_changes.
+        coll: (MongoDB collection) Collection loaded from the same extract,
+            e.g. by load_map.
+        batch_size: (int) Number of documents per bulk_write.
+        ref_docs: (bool) Refresh the references of changed ways and relations
+            in "ref_docs", and remove deleted documents from it, if it's been
+            built. Changed referrers are logged either way, for a later
+            incremental mongo_audit.write_ref_docs.
+        states: (bool) Apply mongo_audit.update_states' fix-up to created and
+            modified documents.
+        compact: (bool) Shape documents as coll was loaded. See process_map.
+        ts: (bool) See process_map.
+        geojson: (bool) See process_map.
+    Returns:
+        stats: (dict) { "changes" : <read>, "upserted" : <inserted>,
+            "replaced" : <matched>, "deleted" : <removed>, "states" : <fixed>,
+            "referrers" : <ways and relations refreshed in "ref_docs">,
+            "unreferenced" : <deleted documents removed from "ref_docs">,
+            "seconds" : <elapsed>, "changes_per_sec" : <changes/seconds> }
+    '''
+    if pymongo is None:
+        raise ImportError("pymongo is required to apply changes.")
+    if isinstance(file_in, str):
+        file_in = [file_in]
+    start = time.perf_counter()
+    stats = { "changes" : 0, "upserted" : 0, "replaced" : 0, "deleted" : 0,
+              "states" : 0, "referrers" : 0, "unreferenced" : 0 }
+    # Ways and relations changed, whose references "ref_docs" holds.
+    referrer_set = set()
+    # Documents deleted, and not written again since.
+    deleted_set = set()
+    # Change per _id, in the order first seen.
+    ops = dict()
+    doc_types = dict()
+    for fi in file_in:
+        for action, parts in iter_changes(fi):
+            stats["changes"] += 1
+            tag, attrib, _ = parts
+            _id = int(attrib["id"]) if compact else attrib["id"]
+            # Elements of different types can share an _id. Keep their
+            # changes in order.
+            if doc_types.get(_id, tag) != tag:
+                _write_changes(coll, ops, stats, states, deleted_set)
+                doc_types.clear()
+            if action == "delete":
+                op = pymongo.DeleteOne({ "_id" : _id, "doc_type" : tag })
+            else:
+                el = shape_parts(*parts)
+                _finish_doc(el, compact, ts, geojson, ext_json=False)
+                op = pymongo.ReplaceOne({ "_id" : _id, "doc_type" : tag }, el,
+                                        upsert=True)
+            # A later change to an element replaces an earlier one.
+            ops[_id] = op
+            doc_types[_id] = tag
+            if tag != "node":
+                referrer_set.add(_id)
+            if len(ops) >= batch_size:
+                _write_changes(coll, ops, stats, states, deleted_set)
+                doc_types.clear()
+    if ops:
+        _write_changes(coll, ops, stats, states, deleted_set)
+
+    mongo_audit.record_referrers(coll, sorted(referrer_set))
+    # Only if "ref_docs" has been built from coll. Indexing it for the audits
+    # (see mongo_indexes) can create it empty.
+    if ref_docs and referrer_set \
+    and mongo_audit.get_changed_referrers(coll)[0] is not None:
+        mongo_audit.write_ref_docs(coll.database, coll, incremental=True)
+        stats["referrers"] = len(referrer_set)
+    # Whatever still refers to deleted documents, they're gone.
+    if ref_docs and deleted_set \
+    and mongo_audit.get_changed_referrers(coll)[0] is not None:
+        result = coll.database[mongo_audit.REF_DOCS_STR].delete_many(
+            { "_id" : { "$in" : sorted(deleted_set) } })
+        stats["unreferenced"] = result.deleted_count
+    if stats["changes"]:
+        mongo_audit.bump_generation(coll=coll)
+    seconds = time.perf_counter() - start
 
-    return
\ No newline at end of file
+    stats["seconds"] = seconds
+    stats["changes_per_sec"] = stats["changes"] / seconds if seconds else 0.0
+    return stats
@@ -1,9 +1,110 @@
 import pprint as pp
 import pandas as pd
 import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
 
 list_query = lambda cursor: [doc for doc in cursor]
 
+REF_DOCS_STR = "ref_docs"
+# Indexes on the reference collection: refer_count, which get_most_refd walks
+# down, and refers for incremental refreshes to find referrers.
+REF_DOCS_INDEXES_LST = [
+    [("refer_count", -1)],
+    [("refers", 1)]
+]
+# Collection of per-collection write generations, and ref_docs build markers.
+# See bump_generation and write_ref_docs.
+META_STR = "audit_meta"
+# Log of referrers changed since ref_docs was built. See record_referrers.
+REF_CHANGES_STR = "ref_changes"
+# Mean radius of the Earth, for $centerSphere.
+EARTH_RADIUS_KM = 6371.0
+# GeoJSON locations (see clean_and_write.add_geojson), and their index.
+LOC_STR = "loc"
+LOC_INDEX_LST = [(LOC_STR, "2dsphere")]
+# State fix-up (see update_states): every address with a postcode is in WA.
+STATE_FLTR_MAP = { "addr.postcode" : { "$exists" : True } }
+STATE_UPDATE_MAP = { "$set" : { "addr.state" : "WA" } }
+
+
+def get_generation(coll):
+    '''Get a collection's write generation, bumped by the write helpers here.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection.
+    Returns:
+        generation: (bson.ObjectId or None) None if never bumped.
+    '''
+    doc = coll.database[META_STR].find_one({ "_id" : coll.name })
+    return doc["generation"] if doc else None
+
+
+def bump_generation(coll):
+    '''Mark a collection as changed, so cached audit results (see
+    audit_cache) are no longer used. Call after writing to it by other means.
+    The generation is a new ObjectId each time rather than a count, so it
+    can't come back around after the database is dropped and reloaded.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection written to.
+    Returns:
+        None
+    '''
+    update = { "$set" : { "generation" : ObjectId() } }
+    coll.database[META_STR].update_one({ "_id" : coll.name }, update,
+                                       upsert=True)
+    return
+
+
+def get_id_type(coll):
+    '''Get the type of a collection's ids: str for documents shaped by
+    clean_and_write as is, int for the compact schema (see
+    clean_and_write.compact_doc). References share the type of ids.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection.
+    Returns:
+        id_type: (type) str or int. str if the collection is empty.
+    '''
+    doc = coll.find_one(dict(), { "_id" : 1 })
+    if doc is None or isinstance(doc["_id"], str):
+        return str
+    return int
+
+
+def get_storage_stats(coll):
+    '''Get a collection's storage sizes from collStats.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection.
+    Returns:
+        stats: (dict) { "count" : <n>, "size" : <bytes>, "avgObjSize" : <bytes>,
+                        "storageSize" : <bytes>, "totalIndexSize" : <bytes> }
+    '''
+    stats = coll.database.command("collStats", coll.name)
+    return { k : stats.get(k, 0) for k in ["count", "size", "avgObjSize",
+                                           "storageSize", "totalIndexSize"] }
+
+
+def compare_storage(coll, compact_coll):
+    '''Compare the storage of the same data in two schemas, e.g. as loaded
+    with and without clean_and_write's compact option.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection in the original schema.
+        compact_coll: (MongoDB collection) Collection in the compact schema.
+    Returns:
+        storage_df: (pandas.DataFrame) Sizes in bytes per collection, and the
+            reduction as a fraction of the original.
+    '''
+    storage_df = pd.DataFrame({ "Original" : get_storage_stats(coll),
+                                "Compact" : get_storage_stats(compact_coll) })
+    storage_df["Reduction"] = 1 - storage_df["Compact"] / storage_df["Original"]
+    storage_df.index.name = "Stat"
+    return storage_df
+
+
 def get_unique_users(coll):
     pipeline = [
         { "$group" : { "_id" : "$created.uid" } },
@@ -12,37 +113,101 @@ def get_unique_users(coll):
     return coll.aggregate(pipeline)
 
 
+def get_addr_counts(coll):
+    '''Count documents with addresses, postcodes, and states in one round trip.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to count.
+    Returns:
+        counts: (dict) { "zip" : <n>, "state" : <n>, "addr" : <n>,
+                         "zip_no_state" : <n> }
+    '''
+    count_facet = lambda fltr: [ { "$match" : fltr }, { "$count" : "n" } ]
+    pipeline = [
+        # Every other count is a subset of documents with addresses.
+        { "$match" : { "addr" : { "$exists" : 1 } } },
+        {
+            "$facet" :
+            {
+                "zip" : count_facet({ "addr.postcode" : { "$exists" : 1 } }),
+                "state" : count_facet({ "addr.state" : { "$exists" : 1 } }),
+                "addr" : [ { "$count" : "n" } ],
+                "zip_no_state" : count_facet({
+                    "addr.postcode" : { "$exists" : 1 },
+                    "addr.state" : { "$exists" : 0 } })
+            }
+        }
+    ]
+    facets = next(coll.aggregate(pipeline), dict())
+    # Empty facets have no count document.
+    counts = { k : (facets[k][0]["n"] if facets.get(k) else 0)
+               for k in ["zip", "state", "addr", "zip_no_state"] }
+    return counts
+
+
 def get_counts(coll):
-    zip_ct = len(list_query(coll.find( { "addr.postcode" : { "$exists" : 1 } } ) ) )
-    st_ct = len(list_query(coll.find( { "addr.state" : { "$exists" : 1 } } ) ) )
-    addr_ct = len(list_query(coll.find( { "addr" : { "$exists" : 1 } } ) ) )
-    return zip_ct, st_ct, addr_ct
+    counts = get_addr_counts(coll=coll)
+    return counts["zip"], counts["state"], counts["addr"]
 
 
 def update_states(coll):
+    '''Set addr.state to "WA" on every document with a postcode, and tabulate
+    address key counts before and after. Takes two round trips to the
+    collection: the counts after the update follow from the counts before and
+    the update result. If documents changed, a third, small write bumps the
+    collection's generation (see bump_generation).
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to update.
+    Returns:
+        results_df: (pandas.DataFrame) Counts of Zip, State, and Address keys
+            Pre_update and Post_update, and documents Matched and Modified.
+    '''
     print("Updating states:")
     results_df = pd.DataFrame({"Zip": np.zeros(4), "State": np.zeros(4),
                                "Address": np.zeros(4)},
                                index= ["Pre_update", "Matched", "Modified", "Post_update"])
     results_df.columns.name = "Address Key"
     results_df.index.name = "Count"
-    zip_ct, st_ct, addr_ct = get_counts(coll=coll)
-    results_df.loc["Pre_update", "Zip"] = zip_ct
-    results_df.loc["Pre_update", "State"] = st_ct
-    results_df.loc["Pre_update", "Address"] = addr_ct
-    result = coll.update_many({ "addr.postcode" : { "$exists" : True } },
-                              { "$set" : { "addr.state" : "WA" } },
-                              upsert=True)
+    counts = get_addr_counts(coll=coll)
+    results_df.loc["Pre_update", "Zip"] = counts["zip"]
+    results_df.loc["Pre_update", "State"] = counts["state"]
+    results_df.loc["Pre_update", "Address"] = counts["addr"]
+    result = coll.update_many(STATE_FLTR_MAP, STATE_UPDATE_MAP, upsert=True)
     results_df.loc["Matched", "Zip"] = result.matched_count
     results_df.loc["Modified", "State"] = result.modified_count
-    zip_ct, st_ct, addr_ct = get_counts(coll=coll)
-    results_df.loc["Post_update", "Zip"] = zip_ct
-    results_df.loc["Post_update", "State"] = st_ct
-    results_df.loc["Post_update", "Address"] = addr_ct
+    # Every document with a postcode now has a state. With no postcodes to
+    # match, the upsert inserts one document with an address and a state.
+    upserted = 0 if result.upserted_id is None else 1
+    if result.modified_count or upserted:
+        bump_generation(coll=coll)
+    results_df.loc["Post_update", "Zip"] = counts["zip"]
+    results_df.loc["Post_update", "State"] = \
+        counts["state"] + counts["zip_no_state"] + upserted
+    results_df.loc["Post_update", "Address"] = counts["addr"] + upserted
         
     return results_df
 
 
+def update_changed_states(coll, changed_ids):
+    '''Apply update_states' fix-up to some documents only, e.g. those just
+    written by clean_and_write.apply_changes, without counting or printing.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to update.
+        changed_ids: (list) Ids of the documents to fix.
+    Returns:
+        modified: (int) Documents modified.
+    '''
+    to_id = get_id_type(coll)
+    fltr = dict(STATE_FLTR_MAP,
+                _id={ "$in" : [ to_id(_id) for _id in changed_ids ] })
+    result = coll.update_many(fltr, STATE_UPDATE_MAP)
+    if result.modified_count:
+        bump_generation(coll=coll)
+    return result.modified_count
+
+
 def count_docs_by(coll, doc_type, count_k, group_k):
     '''Find and count documents grouped by given key.
     
@@ -63,49 +228,164 @@ def count_docs_by(coll, doc_type, count_k, group_k):
 
 
 def check_doc_counts_by(coll, doc_type_lst, count_k, group_k):
-    '''Find and count documents grouped by given key.
+    '''Find and count documents grouped by given key. All document types, and
+    all keys to count, are counted in a single aggregation.
     
     Parameters:
         coll: (MongoDB collection) Collection to query.
         doc_type_lst: (list(str)) Document types to select.
-        count_k: (str) Key to count ("_id").
+        count_k: (str or list(str)) Key to count ("_id"), or several keys.
         group_k: (str) Key to group documents by for the count.
     Returns:
-        doc_count_lst: (list(dict)) Listed query results. [{ "_id" : group_k, "count" : <n> }, ...]
+        doc_count_lst: (list(dict)) Listed query results, by document type in the order given.
+            [{ "_id" : group_k, "count" : <n> }, ...]
+            If count_k is a list, a dict of these lists by count key instead.
     '''
-    doc_count_lst = []
-    for dt in doc_type_lst:
-        doc_count = list_query(count_docs_by(coll=coll, doc_type=dt, count_k=count_k, group_k=group_k))
-        doc_count_lst.extend(doc_count)
+    count_k_lst = [count_k] if isinstance(count_k, str) else list(count_k)
+    # A missing group key groups with null, as when grouping on it alone.
+    group_stage = { "$group" : { "_id" : { "doc_type" : "$doc_type",
+                                           "group" : { "$ifNull" : [ "$" + group_k,
+                                                                     None ] } },
+                                 "count" : { "$sum" : 1 } } }
+    # Facet names can't hold dots, so index them.
+    pipeline = [
+        { "$match" : { "doc_type" : { "$in" : doc_type_lst } } },
+        {
+            "$facet" :
+            {
+                "count_" + str(idx) : [
+                    { "$match" : { ck : { "$exists" : 1 } } },
+                    group_stage
+                ] for idx, ck in enumerate(count_k_lst)
+            }
+        }
+    ]
+    facets = next(coll.aggregate(pipeline), dict())
 
-    return doc_count_lst
+    doc_type_idx = { dt : idx for idx, dt in enumerate(doc_type_lst) }
+    doc_count_dict = dict()
+    for idx, ck in enumerate(count_k_lst):
+        groups = sorted(facets.get("count_" + str(idx), list()),
+                        key=lambda doc: doc_type_idx[doc["_id"]["doc_type"]])
+        doc_count_dict[ck] = [ { "_id" : doc["_id"].get("group"),
+                                 "count" : doc["count"] } for doc in groups ]
 
+    if isinstance(count_k, str):
+        return doc_count_dict[count_k]
+    return doc_count_dict
 
-def get_bike_services(coll):
-    print("Documents with bicycle services, shops, and/or bike repair stations:\n")
 
+def find_bike_services(coll, geo_filter = None):
+    '''Find documents with bicycle services, shops, and/or bike repair stations.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to query.
+        geo_filter: (dict) Only find documents in an area, e.g. within 5 km of
+            a point with get_radius_filter(lon, lat, 5). See find_within.
+    Returns:
+        service_lst: (list(dict)) Matching documents, with service-related keys.
+    '''
     query = { "$or" : [ { "service.bicycle" : { "$exists" : 1 } },
                         { "shop" : "bicycle" },
                         { "amenity" : "bicycle_repair_station" }] }
+    if geo_filter is not None:
+        query = { "$and" : [ geo_filter, query ] }
     projection = { "_id" : 1, "name" : 1, "note" : 1, "description" : 1,
                    "service" : 1, "shop" : 1, "amenity" : 1, "opening_hours" : 1,
                   "fee" : 1 }
-    pp.pprint(list_query(coll.find(query, projection)))
+    return list_query(coll.find(query, projection))
+
+
+def get_bike_services(coll, geo_filter = None):
+    print("Documents with bicycle services, shops, and/or bike repair stations:\n")
+    pp.pprint(find_bike_services(coll=coll, geo_filter=geo_filter))
     return
+
+
+def ensure_geo_index(coll):
+    '''Create the 2dsphere index on loc that the geo filters below use.
     
+    Parameters:
+        coll: (MongoDB collection) Collection loaded with GeoJSON locations.
+    Returns:
+        index_name: (str) Name of the index.
+    '''
+    return coll.create_index(LOC_INDEX_LST)
+
+
+def get_box_filter(min_lon, min_lat, max_lon, max_lat):
+    '''Get a filter for locations in a bounding box. Its edges are geodesics,
+    close to parallels for boxes the size of a city.
     
-def audit_ref_types(coll, coll_str):
-    '''Audit reference types. Node_refs expected to only point to nodes, but okay if not.
-    Member.type should match doc_type of document reference by member.ref. Print findings.
+    Parameters:
+        min_lon, min_lat, max_lon, max_lat: (float) Corners, in degrees.
+    Returns:
+        geo_filter: (dict) Query on loc.
+    '''
+    return get_polygon_filter([ [min_lon, min_lat], [max_lon, min_lat],
+                                [max_lon, max_lat], [min_lon, max_lat] ])
+
+
+def get_radius_filter(lon, lat, km):
+    '''Get a filter for locations within a distance of a point.
+    
+    Parameters:
+        lon, lat: (float) Center, in degrees.
+        km: (float) Radius, in kilometers.
+    Returns:
+        geo_filter: (dict) Query on loc.
+    '''
+    return { LOC_STR : { "$geoWithin" :
+                         { "$centerSphere" : [ [lon, lat], km / EARTH_RADIUS_KM ] } } }
+
+
+def get_polygon_filter(coords):
+    '''Get a filter for locations in a polygon.
+    
+    Parameters:
+        coords: (list) Outer ring. [[lon, lat], ...] Closed if it isn't already.
+    Returns:
+        geo_filter: (dict) Query on loc.
+    '''
+    ring = [ list(point) for point in coords ]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return { LOC_STR : { "$geoWithin" :
+                         { "$geometry" : { "type" : "Polygon",
+                                           "coordinates" : [ring] } } } }
+
+
+def find_within(coll, geo_filter, query = None, projection = None):
+    '''Find documents in an area, using the 2dsphere index on loc (see
+    ensure_geo_index).
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to query.
+        geo_filter: (dict) From get_box_filter, get_radius_filter, or
+            get_polygon_filter.
+        query: (dict) Other conditions.
+        projection: (dict) Keys to return.
+    Returns:
+        doc_lst: (list(dict)) Matching documents.
+    '''
+    if query:
+        geo_filter = { "$and" : [ geo_filter, query ] }
+    return list_query(coll.find(geo_filter, projection))
+    
+    
+def get_ref_types(coll, coll_str):
+    '''Find the types of documents ways and relations refer to, and the member
+    types relations refer to them as.
     
     Parameters:
         coll: (MongoDB collection) Collection to check.
         coll_str: (str) Collection name.
     Returns:
-        None
+        ref_types: (dict)
+            "way_ref_types": [{ "type" : [<doc_type>] }, ...]
+            "relation_ref_types": [{ "type" : [<doc_type>], "referred_as" : [<type>, ...] }, ...]
     '''
-    
-    print("Ways point to the following types:")
+    ref_types = dict()
     pipeline = [
         { "$match" : { "doc_type" : "way" } },
         { "$unwind" : "$node_refs" },
@@ -121,9 +401,8 @@ def audit_ref_types(coll, coll_str):
         { "$group" : { "_id" : "$refs.doc_type" } },
         { "$project" : { "_id" : 0, "type" : "$_id" } }
     ]
-    print(list_query(coll.aggregate(pipeline)))
+    ref_types["way_ref_types"] = list_query(coll.aggregate(pipeline))
 
-    print("Relations point to the following types, and refer to them as:")
     pipeline = [
         { "$match" : { "doc_type" : "relation" } },
         { "$unwind" : "$members" },
@@ -141,23 +420,44 @@ def audit_ref_types(coll, coll_str):
         { "$project" : { "_id" : 0, "type" : "$_id",
                          "referred_as" : "$member_type_set"}}
     ]
-    pp.pprint(list_query(coll.aggregate(pipeline)))
+    ref_types["relation_ref_types"] = list_query(coll.aggregate(pipeline))
+    return ref_types
+
+
+def audit_ref_types(coll, coll_str):
+    '''Audit reference types. Node_refs expected to only point to nodes, but okay if not.
+    Member.type should match doc_type of document reference by member.ref. Print findings.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to check.
+        coll_str: (str) Collection name.
+    Returns:
+        None
+    '''
+    ref_types = get_ref_types(coll=coll, coll_str=coll_str)
+    print("Ways point to the following types:")
+    print(ref_types["way_ref_types"])
+
+    print("Relations point to the following types, and refer to them as:")
+    pp.pprint(ref_types["relation_ref_types"])
     return
 
 
-def get_doctype_mismatches(coll, coll_str):
+def find_doctype_mismatches(coll, coll_str):
     '''Find ways with node_refs that don't match to elements that are nodes.
     Find relations with member types that don't match referenced types.
-    Print findings.
     
     Parameters:
         coll: (MongoDB collection) Collection to check.
         coll_str: (str) Collection name.
     Returns:
-        mismatched_members_lst: (list(dict)) Relations with mismatched referenced document types.
-            e.g. [{'_id': '2317217', 'members': {'ref': '37125674', 'role': 'forward', 'type': 'node'},
-                   'refs': {'_id': '37125674', 'doc_type': 'node'}}, ... ]
+        mismatches: (dict)
+            "way_mismatches": (list(dict)) Ways pointing to non-nodes, one per reference.
+            "mismatched_members_lst": (list(dict)) Relations with mismatched referenced document types.
+                e.g. [{'_id': '2317217', 'members': {'ref': '37125674', 'role': 'forward', 'type': 'node'},
+                       'refs': {'_id': '37125674', 'doc_type': 'node'}}, ... ]
     '''
+    mismatches = dict()
     
     # Find ways with node_refs that don't match to nodes.
     pipeline = [
@@ -183,10 +483,7 @@ def get_doctype_mismatches(coll, coll_str):
         },
         { "$match" : { "comp" : { "$ne" : 0 } } }
     ]
-    print("Ways pointing to non-nodes:")
-    for doc in coll.aggregate(pipeline):
-        pp.pprint(doc)
-    print("\n")
+    mismatches["way_mismatches"] = list_query(coll.aggregate(pipeline))
 
     # Find relations with member types that don't match referenced types.
     pipeline = [
@@ -224,15 +521,39 @@ def get_doctype_mismatches(coll, coll_str):
         { "$match" : { "comp" : { "$ne" : 0 } } },
         { "$project" : { "members" : 1, "refs._id" : 1, "refs.doc_type" : 1 } }
     ]
+    mismatches["mismatched_members_lst"] = list_query(coll.aggregate(pipeline))
     
-    mismatched_members_lst = list_query(coll.aggregate(pipeline))
+    return mismatches
+
+
+def get_doctype_mismatches(coll, coll_str):
+    '''Find ways with node_refs that don't match to elements that are nodes.
+    Find relations with member types that don't match referenced types.
+    Print findings.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection to check.
+        coll_str: (str) Collection name.
+    Returns:
+        mismatched_members_lst: (list(dict)) Relations with mismatched referenced document types.
+            e.g. [{'_id': '2317217', 'members': {'ref': '37125674', 'role': 'forward', 'type': 'node'},
+                   'refs': {'_id': '37125674', 'doc_type': 'node'}}, ... ]
+    '''
+    mismatches = find_doctype_mismatches(coll=coll, coll_str=coll_str)
+    print("Ways pointing to non-nodes:")
+    for doc in mismatches["way_mismatches"]:
+        pp.pprint(doc)
+    print("\n")
+
+    mismatched_members_lst = mismatches["mismatched_members_lst"]
     print("Relations with mismatched referenced document types:")
     pp.pprint(mismatched_members_lst)
     
     return mismatched_members_lst
     
     
-def fix_mismatched_refs(coll, mismatched_members_lst):
+def fix_mismatched_refs(coll, mismatched_members_lst, bulk = False,
+                        verify = False):
     '''Fix mismatched references (where relations point to elements that don't match their reference type).
     
     Parameters:
@@ -240,11 +561,23 @@ def fix_mismatched_refs(coll, mismatched_members_lst):
         mismatched_members_lst: (list(dict)) Relations with mismatched referenced document types.
             e.g. [{'_id': '2317217', 'members': {'ref': '37125674', 'role': 'forward', 'type': 'node'},
                    'refs': {'_id': '37125674', 'doc_type': 'node'}}, ... ]
+        bulk: (bool) Fix all members in one unordered bulk write and return a
+            summary, rather than updating and printing one member at a time.
+        verify: (bool) If bulk, read the fixed relations back in one query and
+            check each member's type.
     Return:
-        None
+        None, or if bulk, summary: (dict) See fix_mismatched_refs_bulk.
     '''
+    if bulk:
+        return fix_mismatched_refs_bulk(coll=coll,
+                                        mismatched_members_lst=mismatched_members_lst,
+                                        verify=verify)
     
+    # Lists from ref_index hold string ids, whatever the schema.
+    to_id = get_id_type(coll)
     for doc in mismatched_members_lst:
+        doc = dict(doc, _id=to_id(doc["_id"]),
+                   members=dict(doc["members"], ref=to_id(doc["members"]["ref"])))
         fltr = { "_id" : doc["_id"], "members.ref" : doc["members"]["ref"] }
         update = {
             "$set" :
@@ -265,18 +598,73 @@ def fix_mismatched_refs(coll, mismatched_members_lst):
         print("Referenced document:")
         print( coll.find_one( { "_id" : doc["members"]["ref"] },
                                   { "doc_type" : 1 } ), "\n" )
+    bump_generation(coll=coll)
     return
 
 
-def write_ref_docs(db, coll):
-    '''Create a reference collection for node references. Overwrites existing reference collection "ref_docs".
+def fix_mismatched_refs_bulk(coll, mismatched_members_lst, verify = False):
+    '''Fix mismatched references with one unordered bulk write. Each member is
+    matched by ref and role with arrayFilters, and only its type is set.
     
     Parameters:
-        db: (MongoDB) Database to add the reference collection "ref_docs".
-        coll: (MondoDB collection) Collection to create the reference collection for.
-        
+        coll: (MongoDB collection) Collection to be updated.
+        mismatched_members_lst: (list(dict)) See fix_mismatched_refs.
+        verify: (bool) Read the fixed relations back in one query and check
+            each member's type.
+    Return:
+        summary: (dict) { "matched" : <n>, "modified" : <n>,
+                          "relations" : [{ "_id" : <relation>, "ref" : <id>,
+                                           "role" : <role>, "type" : <type>,
+                                           "verified" : <bool or None> },
+                                         ... ] }
+    '''
+    requests = list()
+    relations = list()
+    # Lists from ref_index hold string ids, whatever the schema.
+    to_id = get_id_type(coll)
+    for doc in mismatched_members_lst:
+        member = doc["members"]
+        _id = to_id(doc["_id"])
+        ref = to_id(member["ref"])
+        requests.append(UpdateOne(
+            { "_id" : _id },
+            { "$set" : { "members.$[member].type" : member["type"] } },
+            array_filters=[ { "member.ref" : ref,
+                              "member.role" : member["role"] } ]))
+        relations.append({ "_id" : _id, "ref" : ref,
+                           "role" : member["role"], "type" : member["type"],
+                           "verified" : None })
+    summary = { "matched" : 0, "modified" : 0, "relations" : relations }
+    if not requests:
+        return summary
+
+    result = coll.bulk_write(requests, ordered=False)
+    bump_generation(coll=coll)
+    summary["matched"] = result.matched_count
+    summary["modified"] = result.modified_count
+
+    if verify:
+        ids = list(set(rel["_id"] for rel in relations))
+        members_by_id = { doc["_id"] : doc.get("members", list()) for doc in
+                          coll.find({ "_id" : { "$in" : ids } },
+                                    { "members" : 1 }) }
+        for rel in relations:
+            rel["verified"] = any(
+                member["ref"] == rel["ref"] and member["role"] == rel["role"]
+                and member["type"] == rel["type"]
+                for member in members_by_id.get(rel["_id"], list()))
+
+    return summary
+
+
+def get_ref_pipeline(changed_ids = None):
+    '''Get the pipeline grouping referrers (ways and relations) by the
+    documents they reference.
+    
+    Parameters:
+        changed_ids: (list) Only group these referrers. All if None.
     Returns:
-        ref_docs_coll: (MongoDB collection) Handle of "ref_docs" collection.
+        pipeline: (list(dict)) Aggregation pipeline.
     '''
     pipeline = [
         {
@@ -319,12 +707,159 @@ def write_ref_docs(db, coll):
                     "$push" : "$_id"
                 },
             }
-        }
+        },
+        { "$addFields" : { "refer_count" : { "$size" : "$refers" } } }
     ]
+    if changed_ids is not None:
+        pipeline.insert(0, { "$match" : { "_id" : { "$in" : changed_ids } } })
+    return pipeline
+
+
+def record_referrers(coll, ids):
+    '''Log ways and relations written to coll (inserted, modified, or
+    deleted), for the next incremental write_ref_docs to refresh.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection written to.
+        ids: (list) Ids of the referrers written.
+    Returns:
+        None
+    '''
+    if ids:
+        coll.database[REF_CHANGES_STR].insert_many(
+            [ { "coll" : coll.name, "referrer" : _id } for _id in ids ],
+            ordered=False)
+    return
+
+
+def reset_ref_build(coll):
+    '''Forget when "ref_docs" was built from coll, so the next incremental
+    write_ref_docs rebuilds it. Call after reloading coll wholesale.'''
+    coll.database[META_STR].update_one({ "_id" : coll.name },
+                                       { "$unset" : { "ref_docs_built" : "" } })
+    coll.database[REF_CHANGES_STR].delete_many({ "coll" : coll.name })
+    return
+
+
+def get_changed_referrers(coll):
+    '''Get the referrers logged by record_referrers since "ref_docs" was last
+    built from coll.
+    
+    Parameters:
+        coll: (MongoDB collection) Collection.
+    Returns:
+        changed_ids: (list or None) Ids, or None if "ref_docs" hasn't been
+            built from coll, or coll has been reloaded since.
+        marker: (bson.ObjectId) Log entries up to this one are included.
+    '''
+    changes_coll = coll.database[REF_CHANGES_STR]
+    last = changes_coll.find_one({ "coll" : coll.name }, { "_id" : 1 },
+                                 sort=[("_id", -1)])
+    marker = last["_id"] if last else ObjectId()
+    meta = coll.database[META_STR].find_one({ "_id" : coll.name })
+    if not meta or "ref_docs_built" not in meta:
+        return None, marker
+    fltr = { "coll" : coll.name,
+             "_id" : { "$gt" : meta["ref_docs_built"], "$lte" : marker } }
+    return sorted(changes_coll.distinct("referrer", fltr)), marker
+
+
+def write_ref_docs(db, coll, changed_ids = None, incremental = False):
+    '''Create a reference collection for node references, server-side. Each
+    referenced document gets the ids of the documents referring to it and
+    their count, indexed for get_most_refd.
+    
+    Overwrites existing reference collection "ref_docs", unless changed_ids is
+    given or incremental, and it exists, in which case only those referrers
+    are refreshed. Full and incremental builds are marked in "audit_meta", and
+    the referrers logged up to them (see record_referrers) dropped from
+    "ref_changes".
+    
+    Parameters:
+        db: (MongoDB) Database to add the reference collection "ref_docs".
+        coll: (MondoDB collection) Collection to create the reference collection for.
+        changed_ids: (list) Ids of documents inserted, modified, or deleted in
+            coll since "ref_docs" was last written. None rewrites "ref_docs".
+        incremental: (bool) Refresh the referrers logged since the last
+            build, instead of changed_ids. Rewrites "ref_docs" if it was never
+            built, or coll was reloaded since.
+        
+    Returns:
+        ref_docs_coll: (MongoDB collection) Handle of "ref_docs" collection.
+    '''
+    ref_docs_col = db[REF_DOCS_STR]
+    if db.name == coll.database.name:
+        target = REF_DOCS_STR
+    else:
+        target = { "db" : db.name, "coll" : REF_DOCS_STR }
+
+    logged_ids, marker = get_changed_referrers(coll)
+    if incremental:
+        changed_ids = logged_ids
+    rebuild = changed_ids is None or \
+        REF_DOCS_STR not in db.list_collection_names()
+    if rebuild:
+        # $out replaces the collection only once the new one is complete.
+        pipeline = get_ref_pipeline()
+        pipeline.append({ "$out" : target })
+        coll.aggregate(pipeline)
+    else:
+        to_id = get_id_type(coll)
+        changed_ids = [ to_id(_id) for _id in changed_ids ]
+        # Take the changed referrers out,
+        ref_docs_col.update_many(
+            { "refers" : { "$in" : changed_ids } },
+            [
+                {
+                    "$set" :
+                    {
+                        "refers" :
+                        {
+                            "$filter" :
+                            {
+                                "input" : "$refers",
+                                "cond" : { "$not" : [ { "$in" : [ "$$this", changed_ids ] } ] }
+                            }
+                        }
+                    }
+                },
+                { "$set" : { "refer_count" : { "$size" : "$refers" } } }
+            ]
+        )
+        # put their current references back in,
+        pipeline = get_ref_pipeline(changed_ids)
+        pipeline.append({
+            "$merge" :
+            {
+                "into" : target,
+                "on" : "_id",
+                "whenMatched" : [
+                    {
+                        "$set" :
+                        {
+                            "refers" : { "$concatArrays" : [ "$refers", "$$new.refers" ] }
+                        }
+                    },
+                    { "$set" : { "refer_count" : { "$size" : "$refers" } } }
+                ],
+                "whenNotMatched" : "insert"
+            }
+        })
+        coll.aggregate(pipeline)
+        # and drop documents no longer referenced.
+        ref_docs_col.delete_many({ "refer_count" : 0 })
 
-    db.drop_collection("ref_docs")
-    ref_docs_col = db.create_collection("ref_docs")
-    ref_docs_col.insert_many(list_query(coll.aggregate(pipeline)))
+    for keys in REF_DOCS_INDEXES_LST:
+        ref_docs_col.create_index(keys)
+    # Referrers logged but left out of given changed_ids are still to refresh.
+    if rebuild or incremental:
+        coll.database[META_STR].update_one(
+            { "_id" : coll.name }, { "$set" : { "ref_docs_built" : marker } },
+            upsert=True)
+        coll.database[REF_CHANGES_STR].delete_many(
+            { "coll" : coll.name, "_id" : { "$lte" : marker } })
+    # get_most_refd results on coll depend on "ref_docs".
+    bump_generation(coll=coll)
     
     return ref_docs_col
     
@@ -340,35 +875,22 @@ def get_by_field(coll, field):
     
 def get_most_refd(coll, field, limit):
 # Which service documents are referenced most, and who contributed them?
+# Walks ref_docs (see write_ref_docs) down the refer_count index, looking up
+# each referenced document by _id and keeping those with the field. The
+# pipeline streams, so it stops looking up once it has limit of them.
     pipeline = [
-        { "$match" : { field : { "$exists" : 1 } } },
-        {
-            "$lookup" :
-            {
-                "from" : "ref_docs",
-                "localField" : "_id",
-                "foreignField" : "_id",
-                "as" : "ref_doc"
-            }
-        },
-        { "$unwind" : "$ref_doc" },
-        {
-            "$project" :
-            {
-                "refer_count" : { "$size" : "$ref_doc.refers" }
-            }
-        },
         { "$sort" : { "refer_count" : -1 } },
-        { "$limit" : limit},
         {
             "$lookup" :
             {
-                "from" : "bham",
+                "from" : coll.name,
                 "localField" : "_id",
                 "foreignField" : "_id",
                 "as" : "full_ref_doc"
             }
         },
+        { "$match" : { "full_ref_doc." + field : { "$exists" : 1 } } },
+        { "$limit" : limit },
         {
             "$project" :
             {
@@ -378,4 +900,4 @@ def get_most_refd(coll, field, limit):
             }
         }
     ]
-    return coll.aggregate(pipeline)
\ No newline at end of file
+    return coll.database[REF_DOCS_STR].aggregate(pipeline)
\ No newline at end of file
@@ -0,0 +1,281 @@
+import time
+import pandas as pd
+import mongo_audit
+
+## Indexes for the mongo_audit queries, and explain reports on how they run.
+# Each audit function declares the indexes its queries can use, so they can be
+# built before the audits run instead of after. $lookup joins on _id already
+# have the default _id index.
+
+# Index options for $exists: true predicates. Regular indexes also hold
+# documents missing the field, so they'd be scanned whole.
+SPARSE_MAP = { "sparse" : True }
+
+# Indexes by audit function. [(collection, keys[, options]), ...]. A collection
+# of None is the audited collection. Queries that only $group (get_unique_users)
+# have none.
+INDEXES_MAP = {
+    # The facets run on what the leading $match on addr passes on.
+    "get_addr_counts" : [ (None, [("addr", 1)], SPARSE_MAP) ],
+    # Counts before the update, then update_many on STATE_FLTR_MAP.
+    "update_states" : [ (None, [("addr", 1)], SPARSE_MAP),
+                        (None, [("addr.postcode", 1)], SPARSE_MAP) ],
+    "count_docs_by" : [ (None, [("doc_type", 1)]) ],
+    "check_doc_counts_by" : [ (None, [("doc_type", 1)]) ],
+    # $or can only use indexes if every clause has one.
+    "find_bike_services" : [ (None, [("service.bicycle", 1)]),
+                             (None, [("shop", 1)]),
+                             (None, [("amenity", 1)]) ],
+    "find_within" : [ (None, mongo_audit.LOC_INDEX_LST) ],
+    "get_ref_types" : [ (None, [("doc_type", 1)]) ],
+    "find_doctype_mismatches" : [ (None, [("doc_type", 1)]) ],
+    "write_ref_docs" : [ (mongo_audit.REF_DOCS_STR, keys)
+                         for keys in mongo_audit.REF_DOCS_INDEXES_LST ],
+    # Walks ref_docs down refer_count.
+    "get_most_refd" : [ (mongo_audit.REF_DOCS_STR,
+                         mongo_audit.REF_DOCS_INDEXES_LST[0]) ]
+}
+
+# Functions that print what another function finds.
+INDEXES_MAP["get_bike_services"] = INDEXES_MAP["find_bike_services"]
+INDEXES_MAP["audit_ref_types"] = INDEXES_MAP["get_ref_types"]
+INDEXES_MAP["get_doctype_mismatches"] = INDEXES_MAP["find_doctype_mismatches"]
+
+# Pipeline stages that write, and can't be explained with executionStats.
+WRITE_STAGES_SET = frozenset(["$out", "$merge"])
+
+
+def get_index_specs(func_lst = None):
+    '''Get the distinct indexes needed by audit functions.
+
+    Parameters:
+        func_lst: (list(str or function)) Audit functions. All in INDEXES_MAP if None.
+    Returns:
+        spec_lst: (list(tuple)) [(collection, keys[, options]), ...], in
+            declared order.
+    '''
+    if func_lst is None:
+        func_lst = list(INDEXES_MAP)
+    spec_lst = list()
+    for func in func_lst:
+        func_str = func if isinstance(func, str) else func.__name__
+        for spec in INDEXES_MAP.get(func_str, list()):
+            if spec not in spec_lst:
+                spec_lst.append(spec)
+    return spec_lst
+
+
+def create_indexes(coll, spec_lst):
+    '''Create indexes, where there isn't already one on the same keys. An
+    existing index is kept even if its options differ (e.g. it isn't sparse),
+    since creating another on the same keys would fail.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to index.
+        spec_lst: (list(tuple)) [(collection, keys[, options]), ...]. See
+            INDEXES_MAP.
+    Returns:
+        index_lst: (list(tuple)) Indexes ensured. [(collection name, index name), ...]
+    '''
+    index_lst = list()
+    existing = dict()
+    for spec in spec_lst:
+        coll_str, keys = spec[:2]
+        options = spec[2] if len(spec) > 2 else dict()
+        target = coll if coll_str is None else coll.database[coll_str]
+        if target.name not in existing:
+            existing[target.name] = { tuple(info["key"]) : name for name, info
+                                      in target.index_information().items() }
+        name = existing[target.name].get(tuple(keys))
+        if name is None:
+            name = target.create_index(keys, **options)
+            existing[target.name][tuple(keys)] = name
+        index_lst.append((target.name, name))
+    return index_lst
+
+
+def ensure_indexes(coll, func_lst = None):
+    '''Create the indexes audit functions need, where missing. Called by
+    audit_runner.run_audits and explain_audits before they run the audits.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to be audited.
+        func_lst: (list(str or function)) Audit functions. All in INDEXES_MAP if None.
+    Returns:
+        index_lst: (list(tuple)) Indexes ensured. [(collection name, index name), ...]
+    '''
+    return create_indexes(coll, get_index_specs(func_lst))
+
+
+def _get_plan_indexes(plan, index_set):
+    '''Collect index names, and "COLLSCAN", from a query plan tree.'''
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            index_set.add("COLLSCAN")
+        if "indexName" in plan:
+            index_set.add(plan["indexName"])
+        for value in plan.values():
+            _get_plan_indexes(value, index_set)
+    elif isinstance(plan, list):
+        for value in plan:
+            _get_plan_indexes(value, index_set)
+    return index_set
+
+
+def summarize_explain(explain):
+    '''Summarize explain("executionStats") output of a find or aggregate.
+
+    Parameters:
+        explain: (dict) Explain output.
+    Returns:
+        summary: (dict) { "docs_examined" : <n>, "keys_examined" : <n>,
+                          "returned" : <n>, "indexes" : [<name>, ...],
+                          "millis" : <n> }
+            indexes includes "COLLSCAN" for collection scans, and "$lookup"
+            counts and indexes are included where the server reports them.
+    '''
+    summary = { "docs_examined" : 0, "keys_examined" : 0, "returned" : None,
+                "millis" : 0 }
+    index_set = set()
+    # Pipelines run wholly by the query engine explain like a find; others
+    # list their stages, the first being the $cursor that reads documents.
+    stage_lst = explain.get("stages", [ { "$cursor" : explain } ])
+    for stage in stage_lst:
+        if "$cursor" in stage:
+            cursor = stage["$cursor"]
+            stats = cursor.get("executionStats", dict())
+            summary["docs_examined"] += stats.get("totalDocsExamined", 0)
+            summary["keys_examined"] += stats.get("totalKeysExamined", 0)
+            summary["returned"] = stats.get("nReturned", summary["returned"])
+            summary["millis"] = stats.get("executionTimeMillis", summary["millis"])
+            _get_plan_indexes(cursor.get("queryPlanner", dict()).get("winningPlan"),
+                              index_set)
+        else:
+            summary["docs_examined"] += stage.get("totalDocsExamined", 0)
+            summary["keys_examined"] += stage.get("totalKeysExamined", 0)
+            if stage.get("collectionScans"):
+                index_set.add("COLLSCAN")
+            index_set.update(stage.get("indexesUsed", list()))
+            summary["millis"] = max(summary["millis"],
+                                    stage.get("executionTimeMillisEstimate", 0))
+        # Later stages report what they pass on.
+        summary["returned"] = stage.get("nReturned", summary["returned"])
+    summary["indexes"] = sorted(index_set)
+    return summary
+
+
+class ExplainCollection:
+    '''Collection wrapper that explains each find and aggregate with
+    executionStats before running it, and records the summaries. Explaining
+    with executionStats runs the query, so each summary also holds the
+    "explain_seconds" it took, for leaving out of run times. Everything else
+    passes through to the collection.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to wrap.
+        report_lst: (list) Where to append summaries (see summarize_explain),
+            with "collection" and "op" added.
+    '''
+    def __init__(self, coll, report_lst):
+        self._coll = coll
+        self._report_lst = report_lst
+
+    def __getattr__(self, name):
+        return getattr(self._coll, name)
+
+    @property
+    def database(self):
+        return ExplainDatabase(self._coll.database, self._report_lst)
+
+    def _record(self, op, get_explain):
+        start = time.perf_counter()
+        summary = summarize_explain(get_explain())
+        summary["explain_seconds"] = time.perf_counter() - start
+        summary["collection"] = self._coll.name
+        summary["op"] = op
+        self._report_lst.append(summary)
+        return
+
+    def aggregate(self, pipeline, **kwargs):
+        if not (pipeline and WRITE_STAGES_SET.intersection(pipeline[-1])):
+            self._record("aggregate", lambda: self._coll.database.command(
+                "explain",
+                { "aggregate" : self._coll.name, "pipeline" : pipeline,
+                  "cursor" : dict() },
+                verbosity="executionStats"))
+        return self._coll.aggregate(pipeline, **kwargs)
+
+    def find(self, *args, **kwargs):
+        cursor = self._coll.find(*args, **kwargs)
+        # Explain a copy, leaving the cursor returned unread.
+        self._record("find", cursor.clone().explain)
+        return cursor
+
+
+class ExplainDatabase:
+    '''Database wrapper handing out ExplainCollections.'''
+    def __init__(self, db, report_lst):
+        self._db = db
+        self._report_lst = report_lst
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __getitem__(self, name):
+        return ExplainCollection(self._db[name], self._report_lst)
+
+
+def explain_audit(func, coll, **kwargs):
+    '''Run an audit function, explaining every query it makes.
+
+    Parameters:
+        func: (function) Audit function from mongo_audit, taking coll.
+        coll: (MongoDB collection) Collection to audit.
+        **kwargs: Other arguments to func.
+    Returns:
+        result: Whatever func returns. Cursors are listed.
+        report_df: (pandas.DataFrame) A row per query, with documents and keys
+            examined, documents returned, indexes used, and server
+            milliseconds. attrs["seconds"] holds the function's run time,
+            less the time spent explaining its queries.
+    '''
+    report_lst = list()
+    start = time.perf_counter()
+    result = func(coll=ExplainCollection(coll, report_lst), **kwargs)
+    # Cursors run lazily; list them so the time covers the whole query.
+    if hasattr(result, "next"):
+        result = mongo_audit.list_query(result)
+    seconds = time.perf_counter() - start - \
+        sum(summary["explain_seconds"] for summary in report_lst)
+    report_df = pd.DataFrame(report_lst, columns=["collection", "op", "docs_examined",
+                                                  "keys_examined", "returned",
+                                                  "indexes", "millis"])
+    report_df.insert(0, "function", func.__name__)
+    returned = pd.to_numeric(report_df["returned"])
+    report_df["examined_per_returned"] = \
+        report_df["docs_examined"] / returned.where(returned > 0)
+    report_df.attrs["seconds"] = seconds
+    return result, report_df
+
+
+def explain_audits(coll, call_lst, indexes = True):
+    '''Run audit functions, explaining every query they make.
+
+    Parameters:
+        coll: (MongoDB collection) Collection to audit.
+        call_lst: (list(tuple)) [(func, kwargs), ...] Audit functions and their
+            other arguments.
+        indexes: (bool) Ensure the indexes the functions need first (see
+            ensure_indexes). False explains them as the collection stands.
+    Returns:
+        report_df: (pandas.DataFrame) A row per query (see explain_audit),
+            with each function's run time in "seconds".
+    '''
+    if indexes:
+        ensure_indexes(coll, [ func for func, _ in call_lst ])
+    report_df_lst = list()
+    for func, kwargs in call_lst:
+        _, report_df = explain_audit(func, coll, **kwargs)
+        report_df["seconds"] = report_df.attrs["seconds"]
+        report_df_lst.append(report_df)
+    return pd.concat(report_df_lst, ignore_index=True)
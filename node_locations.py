@@ -0,0 +1,196 @@
+from array import array
+import os
+import numpy as np
+
+## Node locations on disk, for way geometry.
+# Node ids and coordinates are appended to flat files as nodes stream by, then
+# memory-mapped and binary searched with numpy, so ways can be located without
+# holding every node in memory. Coordinates are kept as 32-bit integers of
+# 1e-7 degrees, OSM's own precision: 16 bytes a node on disk.
+
+IDS_EXT = ".ids"
+LOCS_EXT = ".locs"
+# Stored units per degree.
+COORD_SCALE = 1e7
+
+
+class NodeLocations:
+    '''Sorted, memory-mapped index of node locations by id.
+
+    Add nodes in "w" mode, e.g. through clean_and_write.process_map, which
+    finishes the index where the nodes end: the files are flushed, sorted by
+    id if nodes came out of order, and mapped. Otherwise the first lookup
+    finishes it. Open a finished index with mode "r".
+
+    Parameters:
+        path: (str) Filepath prefix. Ids go to path + ".ids", locations to
+            path + ".locs".
+        mode: (str) "w" to build a new index, "r" to open a finished one.
+        buffer_size: (int) Nodes held in memory between writes.
+    '''
+    def __init__(self, path, mode = "w", buffer_size = 100000):
+        self.path = path
+        self.buffer_size = buffer_size
+        # Way references to nodes not in the index.
+        self.missing = 0
+        self.ids = None
+        self.locs = None
+        self._building = mode != "r"
+        self._in_order = True
+        if not self._building:
+            self._map()
+            return
+        self.count = 0
+        self._last_id = None
+        self._id_buf = array("q")
+        self._loc_buf = array("i")
+        self._ids_fo = open(path + IDS_EXT, "wb")
+        self._locs_fo = open(path + LOCS_EXT, "wb")
+
+    @property
+    def finished(self):
+        return self.ids is not None
+
+    def add(self, _id, lat, lon):
+        '''Add a node.
+
+        Parameters:
+            _id: (str or int) Node id.
+            lat, lon: (str or float) Location in degrees.
+        Returns:
+            None
+        '''
+        if not self._building:
+            raise ValueError("Nodes must come before the ways that use them.")
+        _id = int(_id)
+        if self._last_id is not None and _id < self._last_id:
+            self._in_order = False
+        self._last_id = _id
+        self._id_buf.append(_id)
+        self._loc_buf.append(round(float(lat) * COORD_SCALE))
+        self._loc_buf.append(round(float(lon) * COORD_SCALE))
+        self.count += 1
+        if len(self._id_buf) >= self.buffer_size:
+            self._flush()
+        return
+
+    def add_parts(self, parts):
+        '''Add a node given as parts (see osm_parsers.iter_parts). Nodes
+        without a location are skipped.'''
+        attrib = parts[1]
+        if "lat" in attrib and "lon" in attrib:
+            self.add(attrib["id"], attrib["lat"], attrib["lon"])
+        return
+
+    def _flush(self):
+        self._id_buf.tofile(self._ids_fo)
+        self._loc_buf.tofile(self._locs_fo)
+        self._id_buf = array("q")
+        self._loc_buf = array("i")
+        return
+
+    def _map(self):
+        count = os.path.getsize(self.path + IDS_EXT) // 8
+        self.count = count
+        if not count:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.locs = np.empty((0, 2), dtype=np.int32)
+            return
+        # Plain array views index faster than memmaps.
+        self.ids = np.memmap(self.path + IDS_EXT, dtype=np.int64, mode="r",
+                             shape=(count,)).view(np.ndarray)
+        self.locs = np.memmap(self.path + LOCS_EXT, dtype=np.int32, mode="r",
+                              shape=(count, 2)).view(np.ndarray)
+        return
+
+    def finish(self):
+        '''Write out the remaining nodes, sort by id if needed, and map the
+        files for lookups. Sorting out-of-order input loads the index into
+        memory; OSM files are normally sorted by id already.'''
+        if self.finished:
+            return self
+        if self._building:
+            self._building = False
+            self._flush()
+            self._ids_fo.close()
+            self._locs_fo.close()
+        if not self._in_order:
+            ids = np.fromfile(self.path + IDS_EXT, dtype=np.int64)
+            locs = np.fromfile(self.path + LOCS_EXT,
+                               dtype=np.int32).reshape(-1, 2)
+            # Stable, so the first of duplicate ids is found, as in RefIndex.
+            order = np.argsort(ids, kind="stable")
+            ids[order].tofile(self.path + IDS_EXT)
+            locs[order].tofile(self.path + LOCS_EXT)
+            del ids, locs, order
+            self._in_order = True
+        self._map()
+        return self
+
+    def lookup(self, refs):
+        '''Get node locations.
+
+        Parameters:
+            refs: (list(int)) Node ids.
+        Returns:
+            coords: (numpy.ndarray(float64)) [[lat, lon], ...] of the nodes
+                found, in the order given.
+            found: (numpy.ndarray(bool)) Whether each id was found.
+        '''
+        self.finish()
+        refs = np.asarray(refs, dtype=np.int64)
+        if not len(self.ids):
+            return np.empty((0, 2)), np.zeros(len(refs), dtype=bool)
+        pos = self.ids.searchsorted(refs)
+        np.minimum(pos, len(self.ids) - 1, out=pos)
+        found = self.ids[pos] == refs
+        return self.locs[pos[found]] / COORD_SCALE, found
+
+    def get_geometry(self, refs, area = True):
+        '''Get the geometry of a way from its node references. Nodes missing
+        from the index are left out, and counted in missing.
+
+        Parameters:
+            refs: (list(int)) Node ids, in way order.
+            area: (bool) Make closed ways Polygons rather than LineStrings.
+        Returns:
+            geometry: (dict or None) None if fewer than two distinct nodes
+                were found.
+                { "line" : [[lat, lon], ...],
+                  "bbox" : [min_lat, min_lon, max_lat, max_lon],
+                  "centroid" : [lat, lon],
+                  "loc" : { "type" : "LineString" or "Polygon",
+                            "coordinates" : <[lon, lat] as GeoJSON> } }
+                line, bbox and centroid put latitude first, as pos does. The
+                centroid is the mean of the vertices.
+        '''
+        coords, found = self.lookup(refs)
+        self.missing += len(found) - int(found.sum())
+        # Ways are short, so the rest is quicker in Python than numpy.
+        coords = coords.tolist()
+        # 2dsphere indexes reject repeated vertices.
+        line = [ coord for i, coord in enumerate(coords)
+                 if not i or coord != coords[i - 1] ]
+        if len(line) < 2:
+            return None
+        closed = len(line) >= 4 and line[0] == line[-1]
+        vertices = line[:-1] if closed else line
+        lats = [ lat for lat, _ in line ]
+        lons = [ lon for _, lon in line ]
+        lon_lat = [ [lon, lat] for lat, lon in line ]
+        if closed and area:
+            loc = { "type" : "Polygon", "coordinates" : [lon_lat] }
+        else:
+            loc = { "type" : "LineString", "coordinates" : lon_lat }
+        return { "line" : line,
+                 "bbox" : [min(lats), min(lons), max(lats), max(lons)],
+                 "centroid" : [sum(lat for lat, _ in vertices) / len(vertices),
+                               sum(lon for _, lon in vertices) / len(vertices)],
+                 "loc" : loc }
+
+    def close(self):
+        '''Finish the index and release the mapped files, which are kept.'''
+        self.finish()
+        self.ids = None
+        self.locs = None
+        return
@@ -0,0 +1,438 @@
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import re
+import os
+import gzip
+from contextlib import nullcontext
+
+# Optional faster parser.
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# PBF input needs numpy.
+try:
+    import osm_pbf
+except ImportError:
+    osm_pbf = None
+
+## Parser backends for OSM XML:
+# "etree": Python's xml.etree.ElementTree.iterparse. Builds an Element for
+#   every node, way, relation, nd, tag, and member.
+# "expat": Python's xml.parsers.expat, SAX-style. Builds plain tuples straight
+#   from the callbacks.
+# "lxml": lxml.etree.iterparse, if lxml is installed.
+# "pbf": osm_pbf, for .osm.pbf files. Always used for them.
+# "auto": lxml if installed, otherwise etree.
+PARSERS_LST = ["etree", "expat", "lxml", "pbf"]
+
+# Top-level elements that become documents.
+DOC_TYPES_LST = ["node", "way", "relation"]
+DOC_TYPES_SET = frozenset(DOC_TYPES_LST)
+
+# Action elements of osmChange docs (.osc), holding the elements they change.
+CHANGE_ACTIONS_LST = ["create", "modify", "delete"]
+CHANGE_ACTIONS_SET = frozenset(CHANGE_ACTIONS_LST)
+
+# Bytes fed to expat per call.
+READ_SIZE = 1024*1024
+
+# Start tag of a top-level element. "<" can't appear unescaped in attribute
+# values, so a match is always a real tag (barring comments and CDATA, which
+# OSM extracts don't use).
+DOC_START_RE = re.compile(rb'<(?:node|way|relation)[\s/>]')
+
+
+def is_pbf(file_in):
+    '''Whether a filepath names an OSM PBF file.'''
+    return isinstance(file_in, str) and file_in.endswith(".pbf")
+
+
+def get_parser(parser = "auto", file_in = None):
+    '''Resolve a parser backend name.
+
+    Parameters:
+        parser: (str) "auto", or one of PARSERS_LST.
+        file_in: (str or file) Input. The XML parsers can't read PBF, so .pbf
+            filepaths get "pbf" whatever parser is asked for.
+    Returns:
+        parser: (str) One of PARSERS_LST.
+    '''
+    if is_pbf(file_in):
+        parser = "pbf"
+    if parser == "auto":
+        parser = "lxml" if lxml_etree is not None else "etree"
+    if parser not in PARSERS_LST:
+        raise ValueError("Unknown parser: " + str(parser))
+    if parser == "lxml" and lxml_etree is None:
+        raise ImportError("lxml is not installed.")
+    if parser == "pbf" and osm_pbf is None:
+        raise ImportError("numpy is required to read PBF.")
+    return parser
+
+
+def _open_in(file_in):
+    '''Open a filepath for binary reading, or pass an open file through.'''
+    if isinstance(file_in, str):
+        return open(file_in, "rb")
+    return nullcontext(file_in)
+
+
+class RangeReader:
+    '''Binary file-like reader over a byte range of a file, with bytes added
+    before and after it. Lets the parsers read a slice of an OSM doc wrapped in
+    a root element.
+    
+    Parameters:
+        file_in: (str) Filepath.
+        start: (int) First byte of the range.
+        end: (int) Byte after the range.
+        prefix: (bytes) Read before the range.
+        suffix: (bytes) Read after the range.
+    '''
+    def __init__(self, file_in, start, end, prefix = b"", suffix = b""):
+        self.fi = open(file_in, "rb")
+        self.fi.seek(start)
+        self.remaining = end - start
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = len(self.prefix) + self.remaining + len(self.suffix)
+        data = self.prefix[:size]
+        self.prefix = self.prefix[len(data):]
+        if len(data) < size and self.remaining:
+            chunk = self.fi.read(min(size - len(data), self.remaining))
+            self.remaining = self.remaining - len(chunk) if chunk else 0
+            data += chunk
+        if len(data) < size and not self.remaining:
+            tail = self.suffix[:size - len(data)]
+            self.suffix = self.suffix[len(tail):]
+            data += tail
+        return data
+
+    def close(self):
+        self.fi.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def find_doc_start(file_in, offset):
+    '''Find the first top-level element (node, way, relation) starting at or
+    after a byte offset.
+    
+    Parameters:
+        file_in: (str) Filepath to OSM XML.
+        offset: (int) Byte offset to search from.
+    Returns:
+        start: (int or None) Byte offset of the element's "<". None if there
+            isn't one.
+    '''
+    with open(file_in, "rb") as fi:
+        fi.seek(offset)
+        # Keep the end of each block in case a tag spans two blocks.
+        tail = b""
+        while True:
+            block = fi.read(READ_SIZE)
+            if not block:
+                return None
+            data = tail + block
+            match = DOC_START_RE.search(data)
+            if match:
+                return offset - len(tail) + match.start()
+            offset += len(block)
+            tail = data[-16:]
+
+
+def get_chunk_ranges(file_in, n_chunks):
+    '''Split an OSM doc into byte ranges that start on top-level element
+    boundaries. The first range holds the XML declaration, the root's start
+    tag, and anything before the first node; the last holds the root's end tag.
+    
+    Parameters:
+        file_in: (str) Filepath to OSM XML.
+        n_chunks: (int) Number of ranges wanted. Small files may get fewer.
+    Returns:
+        ranges: (list(tuple)) [(start, end), ...] in file order.
+    '''
+    size = os.path.getsize(file_in)
+    bounds = {0, size}
+    first = find_doc_start(file_in, 0)
+    if first is not None:
+        bounds.add(first)
+        for i in range(1, n_chunks):
+            start = find_doc_start(file_in, max(first, size * i // n_chunks))
+            if start is not None:
+                bounds.add(start)
+    bounds = sorted(bounds)
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    # Keep the header with the first element.
+    if first is not None and len(ranges) > 1 and ranges[0][1] == first:
+        ranges[:2] = [(0, ranges[1][1])]
+    return ranges
+
+
+def iter_elements(file_in):
+    '''Stream the top-level elements (node, way, relation) of an OSM doc.
+    Each element is yielded complete on its end event, then cleared along with
+    the root's references to it, so memory stays flat regardless of file size.
+
+    Parameters:
+        file_in: (str) Filepath to OSM XML.
+    Yields:
+        element: (xml.etree.ElementTree.Element) Complete top-level element.
+            Only valid until the next element is requested.
+    '''
+    context = ET.iterparse(file_in, events=("start", "end"))
+    # The first event is the start of the root (osm) element.
+    _, root = next(context)
+    for event, element in context:
+        if event == "end" and element.tag in DOC_TYPES_SET:
+            yield element
+            element.clear()
+            # Drop the root's references to finished elements.
+            root.clear()
+
+
+def _iter_parts_etree(file_in):
+    for element in iter_elements(file_in):
+        yield (element.tag, element.attrib,
+               [(sub_el.tag, sub_el.attrib) for sub_el in element])
+
+
+def _iter_parts_expat(file_in, base = None):
+    # With base, yield (base + byte offset of the start tag, parts).
+    ready = list()
+    depth = 0
+    # Subelements of the open top-level element.
+    sub_els = None
+
+    def start(tag, attrib):
+        nonlocal depth, sub_els
+        depth += 1
+        if depth == 3:
+            if sub_els is not None:
+                sub_els.append((tag, attrib))
+        elif depth == 2 and tag in DOC_TYPES_SET:
+            sub_els = list()
+            if base is None:
+                ready.append((tag, attrib, sub_els))
+            else:
+                ready.append((base + expat_parser.CurrentByteIndex,
+                              (tag, attrib, sub_els)))
+        return
+
+    def end(tag):
+        nonlocal depth, sub_els
+        if depth == 2:
+            sub_els = None
+        depth -= 1
+        return
+
+    expat_parser = xml.parsers.expat.ParserCreate()
+    expat_parser.StartElementHandler = start
+    expat_parser.EndElementHandler = end
+    with _open_in(file_in) as fi:
+        chunk = True
+        while chunk:
+            chunk = fi.read(READ_SIZE)
+            expat_parser.Parse(chunk, not chunk)
+            # The last element may still be open; hold it for the next chunk.
+            if sub_els is not None:
+                yield from ready[:-1]
+                del ready[:-1]
+            else:
+                yield from ready
+                ready.clear()
+
+
+def _clear_lxml(element):
+    element.clear()
+    # Drop the root's references to finished elements.
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+    return
+
+
+def _iter_parts_lxml(file_in):
+    context = lxml_etree.iterparse(file_in, events=("end",),
+                                   tag=DOC_TYPES_LST, huge_tree=True)
+    for _, element in context:
+        # lxml attributes are proxies, and die with the element.
+        # Skip comments and processing instructions.
+        yield (element.tag, dict(element.attrib),
+               [(sub_el.tag, dict(sub_el.attrib)) for sub_el in element
+                if isinstance(sub_el.tag, str)])
+        _clear_lxml(element)
+
+
+def iter_parts(file_in, parser = "auto"):
+    '''Stream the top-level elements (node, way, relation) of an OSM doc as
+    lightweight tuples, in document order.
+
+    Parameters:
+        file_in: (str or file) Filepath to OSM XML or PBF, or binary file object
+            of OSM XML.
+        parser: (str) Parser backend. See get_parser.
+    Yields:
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...]). With the
+            etree backend, attrib dicts are only valid until the next element is
+            requested; copy them to keep them.
+    '''
+    parser = get_parser(parser, file_in)
+    if parser == "etree":
+        return _iter_parts_etree(file_in)
+    elif parser == "expat":
+        return _iter_parts_expat(file_in)
+    elif parser == "pbf":
+        return osm_pbf.iter_pbf_parts(file_in)
+    return _iter_parts_lxml(file_in)
+
+
+def iter_changes(file_in):
+    '''Stream the changes in an osmChange doc (.osc), as published in OSM
+    replication diffs, in document order.
+
+    Parameters:
+        file_in: (str or file) Filepath to osmChange XML, gzipped if it ends in
+            ".gz", or binary file object of osmChange XML.
+    Yields:
+        action: (str) "create", "modify", or "delete".
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...]), as
+            iter_parts yields them. Only valid until the next change is
+            requested; copy them to keep them.
+    '''
+    if isinstance(file_in, str) and file_in.endswith(".gz"):
+        # Closed however the stream ends: exhausted, raising, or abandoned.
+        with gzip.open(file_in, "rb") as fi:
+            yield from _iter_changes(fi)
+    else:
+        yield from _iter_changes(file_in)
+
+
+def _iter_changes(file_in):
+    context = ET.iterparse(file_in, events=("start", "end"))
+    # The first event is the start of the root (osmChange) element.
+    _, root = next(context)
+    action_el = None
+    for event, element in context:
+        if event == "start":
+            if element.tag in CHANGE_ACTIONS_SET:
+                action_el = element
+            continue
+        if element.tag in DOC_TYPES_SET and action_el is not None:
+            yield action_el.tag, (element.tag, element.attrib,
+                                  [(sub_el.tag, sub_el.attrib)
+                                   for sub_el in element])
+            # Drop the action's references to finished elements.
+            action_el.clear()
+        elif element.tag in CHANGE_ACTIONS_SET:
+            action_el = None
+            root.clear()
+
+
+def iter_positioned_parts(file_in, position = None):
+    '''Stream the top-level elements of an OSM doc as parts, with the
+    position of each, so the stream can be picked up again from any element.
+    XML is read with expat, whatever the parser used elsewhere.
+
+    Parameters:
+        file_in: (str) Filepath to OSM XML or PBF.
+        position: (int or tuple) Position of the first element to yield, from
+            an earlier stream. From the first element if None.
+    Yields:
+        position: (int or tuple) The byte offset of the element's start tag in
+            XML. (blob offset, index in block) in PBF; see
+            osm_pbf.iter_pbf_positioned_parts.
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...])
+    '''
+    if get_parser(file_in=file_in) == "pbf":
+        return osm_pbf.iter_pbf_positioned_parts(file_in, position)
+    first = find_doc_start(file_in, 0)
+    if first is None:
+        return iter(())
+    if position is None:
+        position = first
+    # Parse from the element on, after the declaration and root start tag.
+    with open(file_in, "rb") as fi:
+        header = fi.read(first)
+    reader = RangeReader(file_in, position, os.path.getsize(file_in),
+                         prefix=header)
+    return _iter_parts_expat(reader, base=position - len(header))
+
+
+def _iter_events_etree(file_in):
+    depth = 0
+    root = None
+    for event, element in ET.iterparse(file_in, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if root is None:
+                root = element
+            yield "start", element.tag, element.attrib
+        else:
+            depth -= 1
+            yield "end", element.tag, None
+            if depth == 1:
+                root.clear()
+
+
+def _iter_events_expat(file_in):
+    ready = list()
+    expat_parser = xml.parsers.expat.ParserCreate()
+    expat_parser.StartElementHandler = \
+        lambda tag, attrib: ready.append(("start", tag, attrib))
+    expat_parser.EndElementHandler = \
+        lambda tag: ready.append(("end", tag, None))
+    with _open_in(file_in) as fi:
+        chunk = True
+        while chunk:
+            chunk = fi.read(READ_SIZE)
+            expat_parser.Parse(chunk, not chunk)
+            yield from ready
+            ready.clear()
+
+
+def _iter_events_lxml(file_in):
+    depth = 0
+    for event, element in lxml_etree.iterparse(file_in,
+                                               events=("start", "end"),
+                                               huge_tree=True):
+        if event == "start":
+            depth += 1
+            yield "start", element.tag, element.attrib
+        else:
+            depth -= 1
+            yield "end", element.tag, None
+            if depth == 1:
+                _clear_lxml(element)
+
+
+def iter_events(file_in, parser = "auto"):
+    '''Stream start and end events for every element of an OSM doc, with
+    finished top-level elements freed as it goes.
+
+    Parameters:
+        file_in: (str or file) Filepath to OSM XML or PBF, or binary file object
+            of OSM XML.
+        parser: (str) Parser backend. See get_parser.
+    Yields:
+        event: (tuple) ("start", tag, attrib) or ("end", tag, None). attrib is
+            only valid until the next event is requested.
+    '''
+    parser = get_parser(parser, file_in)
+    if parser == "etree":
+        return _iter_events_etree(file_in)
+    elif parser == "expat":
+        return _iter_events_expat(file_in)
+    elif parser == "pbf":
+        return osm_pbf.iter_pbf_events(file_in)
+    return _iter_events_lxml(file_in)
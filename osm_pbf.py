@@ -0,0 +1,482 @@
+import struct
+import time
+import zlib
+import lzma
+import multiprocessing as mp
+import numpy as np
+
+## Reader for OSM PBF (.osm.pbf), the compressed binary format extracts are
+# usually downloaded in. A PBF file is a sequence of blobs, each a 4-byte
+# length, a BlobHeader, and a (usually zlib-compressed) Blob. The first blob
+# is an OSMHeader; the rest are OSMData primitive blocks of up to 8000
+# elements, which decode independently, so they can be decoded in parallel.
+# Elements come out as the same parts osm_parsers.iter_parts yields for XML,
+# with attributes as strings, as they'd read in XML.
+# Protocol buffers are decoded by hand; see
+# https://wiki.openstreetmap.org/wiki/PBF_Format for the message fields.
+
+# Features this reader can decode.
+FEATURES_SET = frozenset(["OsmSchema-V0.6", "DenseNodes",
+                          "HistoricalInformation"])
+# Relation member types, by enum value.
+MEMBER_TYPES_LST = ["node", "way", "relation"]
+# Packed varints shorter than this are decoded in plain Python, where numpy's
+# per-call overhead would cost more than it saves.
+NUMPY_MIN_BYTES = 64
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _parse_message(buf):
+    '''Split a protobuf message into its fields.
+
+    Parameters:
+        buf: (bytes or memoryview) Encoded message.
+    Returns:
+        fields: (dict) Values by field number, in order. Varints are ints,
+            length-delimited fields are memoryviews. [<value>, ...]
+    '''
+    buf = memoryview(buf)
+    fields = dict()
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type: " + str(wire_type))
+        fields.setdefault(key >> 3, list()).append(value)
+    return fields
+
+
+def _decode_varints(buf):
+    '''Decode packed varints to a uint64 array.'''
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    if len(arr) < NUMPY_MIN_BYTES:
+        values = list()
+        pos = 0
+        while pos < len(buf):
+            value, pos = _read_varint(buf, pos)
+            values.append(value)
+        return np.array(values, dtype=np.uint64)
+    ends = np.flatnonzero(arr < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # Each byte holds 7 bits, least significant group first.
+    shift = (np.arange(len(arr)) - np.repeat(starts, ends - starts + 1)) * 7
+    values = (arr & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+def _get_uints(fields, field_n):
+    '''Get a repeated integer field, packed or not, as a uint64 array.'''
+    arr_lst = [ _decode_varints(value) if isinstance(value, memoryview)
+                else np.array([value], dtype=np.uint64)
+                for value in fields.get(field_n, list()) ]
+    if not arr_lst:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(arr_lst)
+
+
+def _to_signed(arr):
+    '''int32/int64 fields: two's complement.'''
+    return arr.view(np.int64)
+
+
+def _to_zigzag(arr):
+    '''sint32/sint64 fields: zigzag encoding.'''
+    return (arr >> np.uint64(1)).view(np.int64) ^ -(arr & np.uint64(1)).view(np.int64)
+
+
+def _get_int(fields, field_n, default = None):
+    '''Get a scalar varint field as a signed int.'''
+    if field_n not in fields:
+        return default
+    value = fields[field_n][-1]
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _get_str(fields, field_n, default = None):
+    if field_n not in fields:
+        return default
+    return bytes(fields[field_n][-1]).decode("utf-8")
+
+
+def _format_coord(nano):
+    '''Nanodegrees to a decimal degree string that reads back as the same float.'''
+    return str(nano / 1e9)
+
+
+def iter_blobs(file_in, start = 0):
+    '''Read the raw blobs of a PBF file, without decompressing them.
+
+    Parameters:
+        file_in: (str) Filepath to OSM PBF.
+        start: (int) Byte offset of the first blob to read, from an earlier
+            read.
+    Yields:
+        offset: (int) Byte offset of the blob.
+        blob: (tuple) (blob type, encoded Blob message). Types are "OSMHeader"
+            and "OSMData".
+    '''
+    with open(file_in, "rb") as fi:
+        fi.seek(start)
+        offset = start
+        while True:
+            head = fi.read(4)
+            if not head:
+                return
+            if len(head) < 4:
+                raise ValueError("Truncated PBF blob header.")
+            header_size = struct.unpack(">I", head)[0]
+            header = _parse_message(fi.read(header_size))
+            blob_size = _get_int(header, 3, 0)
+            blob = fi.read(blob_size)
+            yield offset, (_get_str(header, 1), blob)
+            offset += 4 + header_size + blob_size
+
+
+def decompress_blob(blob):
+    '''Get the data in an encoded Blob message.'''
+    fields = _parse_message(blob)
+    if 1 in fields:
+        return bytes(fields[1][-1])
+    if 3 in fields:
+        return zlib.decompress(fields[3][-1])
+    if 4 in fields:
+        return lzma.decompress(fields[4][-1])
+    raise ValueError("Unsupported PBF blob compression.")
+
+
+def parse_header(blob):
+    '''Decode an OSMHeader blob.
+
+    Parameters:
+        blob: (bytes) Encoded Blob message.
+    Returns:
+        header: (dict) { "bbox" : { "minlat" : <str>, "minlon" : <str>,
+                                    "maxlat" : <str>, "maxlon" : <str> } or None,
+                         "required_features" : [<str>, ...],
+                         "writingprogram" : <str or None> }
+    '''
+    fields = _parse_message(decompress_blob(blob))
+    bbox = None
+    if 1 in fields:
+        bbox_fields = _parse_message(fields[1][-1])
+        left, right, top, bottom = [ _unzigzag(bbox_fields.get(n, [0])[-1])
+                                     for n in (1, 2, 3, 4) ]
+        bbox = { "minlat" : _format_coord(bottom), "minlon" : _format_coord(left),
+                 "maxlat" : _format_coord(top), "maxlon" : _format_coord(right) }
+    return { "bbox" : bbox,
+             "required_features" : [ bytes(value).decode("utf-8")
+                                     for value in fields.get(4, list()) ],
+             "writingprogram" : _get_str(fields, 16) }
+
+
+class _Block:
+    '''Settings and string table of a primitive block, for decoding its groups.'''
+    def __init__(self, fields):
+        self.strings = [ bytes(value).decode("utf-8") for value in
+                         _parse_message(fields[1][-1]).get(1, list()) ] \
+            if 1 in fields else list()
+        self.granularity = _get_int(fields, 17, 100)
+        self.date_granularity = _get_int(fields, 18, 1000)
+        self.lat_offset = _get_int(fields, 19, 0)
+        self.lon_offset = _get_int(fields, 20, 0)
+        self.timestamps = dict()
+
+    def format_timestamp(self, timestamp):
+        timestamp_str = self.timestamps.get(timestamp)
+        if timestamp_str is None:
+            seconds = timestamp * self.date_granularity // 1000
+            timestamp_str = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                          time.gmtime(seconds))
+            self.timestamps[timestamp] = timestamp_str
+        return timestamp_str
+
+    def get_tags(self, fields):
+        strings = self.strings
+        return [ ("tag", { "k" : strings[k], "v" : strings[v] })
+                 for k, v in zip(_get_uints(fields, 2).tolist(),
+                                 _get_uints(fields, 3).tolist()) ]
+
+    def add_info(self, attrib, fields):
+        '''Add attributes from an Info message, in XML's order.'''
+        if 4 not in fields:
+            return attrib
+        info = _parse_message(fields[4][-1])
+        if 6 in info:
+            attrib["visible"] = "true" if info[6][-1] else "false"
+        if 1 in info:
+            attrib["version"] = str(_get_int(info, 1))
+        if 3 in info:
+            attrib["changeset"] = str(_get_int(info, 3))
+        if 2 in info:
+            attrib["timestamp"] = self.format_timestamp(_get_int(info, 2))
+        if 5 in info:
+            attrib["user"] = self.strings[info[5][-1]]
+        if 4 in info:
+            attrib["uid"] = str(_get_int(info, 4))
+        return attrib
+
+
+def _decode_nodes(block, group_fields, parts_lst):
+    for node in group_fields.get(1, list()):
+        fields = _parse_message(node)
+        attrib = block.add_info({ "id" : str(_unzigzag(fields[1][-1])) }, fields)
+        attrib["lat"] = _format_coord(block.lat_offset + block.granularity
+                                      * _unzigzag(fields[8][-1]))
+        attrib["lon"] = _format_coord(block.lon_offset + block.granularity
+                                      * _unzigzag(fields[9][-1]))
+        parts_lst.append(("node", attrib, block.get_tags(fields)))
+    return
+
+
+def _decode_dense(block, dense, parts_lst):
+    fields = _parse_message(dense)
+    ids = np.cumsum(_to_zigzag(_get_uints(fields, 1))).tolist()
+    lats = (block.lat_offset + block.granularity
+            * np.cumsum(_to_zigzag(_get_uints(fields, 8)))).tolist()
+    lons = (block.lon_offset + block.granularity
+            * np.cumsum(_to_zigzag(_get_uints(fields, 9)))).tolist()
+    keys_vals = _get_uints(fields, 10).tolist()
+    strings = block.strings
+
+    info_lst = None
+    if 5 in fields:
+        info = _parse_message(fields[5][-1])
+        info_lst = [
+            _to_signed(_get_uints(info, 1)).tolist(),
+            np.cumsum(_to_zigzag(_get_uints(info, 3))).tolist(),
+            np.cumsum(_to_zigzag(_get_uints(info, 2))).tolist(),
+            np.cumsum(_to_zigzag(_get_uints(info, 5))).tolist(),
+            np.cumsum(_to_zigzag(_get_uints(info, 4))).tolist()
+        ]
+        visibles = _get_uints(info, 6).tolist()
+
+    # Tags of all nodes, each node's ended by a 0.
+    kv_pos = 0
+    for idx, _id in enumerate(ids):
+        attrib = { "id" : str(_id) }
+        if info_lst is not None:
+            if visibles:
+                attrib["visible"] = "true" if visibles[idx] else "false"
+            versions, changesets, timestamps, user_sids, uids = info_lst
+            if versions:
+                attrib["version"] = str(versions[idx])
+                attrib["changeset"] = str(changesets[idx])
+                attrib["timestamp"] = block.format_timestamp(timestamps[idx])
+                attrib["user"] = strings[user_sids[idx]]
+                attrib["uid"] = str(uids[idx])
+        attrib["lat"] = _format_coord(lats[idx])
+        attrib["lon"] = _format_coord(lons[idx])
+        sub_els = list()
+        if keys_vals:
+            while keys_vals[kv_pos]:
+                sub_els.append(("tag", { "k" : strings[keys_vals[kv_pos]],
+                                         "v" : strings[keys_vals[kv_pos + 1]] }))
+                kv_pos += 2
+            kv_pos += 1
+        parts_lst.append(("node", attrib, sub_els))
+    return
+
+
+def _decode_ways(block, group_fields, parts_lst):
+    for way in group_fields.get(3, list()):
+        fields = _parse_message(way)
+        attrib = block.add_info({ "id" : str(_get_int(fields, 1)) }, fields)
+        sub_els = [ ("nd", { "ref" : str(ref) }) for ref in
+                    np.cumsum(_to_zigzag(_get_uints(fields, 8))).tolist() ]
+        sub_els.extend(block.get_tags(fields))
+        parts_lst.append(("way", attrib, sub_els))
+    return
+
+
+def _decode_relations(block, group_fields, parts_lst):
+    strings = block.strings
+    for relation in group_fields.get(4, list()):
+        fields = _parse_message(relation)
+        attrib = block.add_info({ "id" : str(_get_int(fields, 1)) }, fields)
+        sub_els = [ ("member", { "type" : MEMBER_TYPES_LST[member_type],
+                                 "ref" : str(ref),
+                                 "role" : strings[role_sid] })
+                    for role_sid, ref, member_type in zip(
+                        _to_signed(_get_uints(fields, 8)).tolist(),
+                        np.cumsum(_to_zigzag(_get_uints(fields, 9))).tolist(),
+                        _get_uints(fields, 10).tolist()) ]
+        sub_els.extend(block.get_tags(fields))
+        parts_lst.append(("relation", attrib, sub_els))
+    return
+
+
+def parse_blob(blob):
+    '''Decode an OSMData blob into element parts, in file order.
+
+    Parameters:
+        blob: (bytes) Encoded Blob message.
+    Returns:
+        parts_lst: (list(tuple)) [(tag, attrib, [(sub_tag, sub_attrib), ...]),
+            ...]
+    '''
+    fields = _parse_message(decompress_blob(blob))
+    block = _Block(fields)
+    parts_lst = list()
+    for group in fields.get(2, list()):
+        group_fields = _parse_message(group)
+        _decode_nodes(block, group_fields, parts_lst)
+        if 2 in group_fields:
+            _decode_dense(block, group_fields[2][-1], parts_lst)
+        _decode_ways(block, group_fields, parts_lst)
+        _decode_relations(block, group_fields, parts_lst)
+    return parts_lst
+
+
+def read_header(blobs):
+    '''Read and check the OSMHeader from a stream of blobs (see iter_blobs).
+
+    Parameters:
+        blobs: (iterator) Blobs, the first being the header.
+    Returns:
+        header: (dict) See parse_header.
+    '''
+    _, (blob_type, blob) = next(blobs, (None, (None, None)))
+    if blob_type != "OSMHeader":
+        raise ValueError("PBF file doesn't start with an OSMHeader.")
+    header = parse_header(blob)
+    missing = set(header["required_features"]) - FEATURES_SET
+    if missing:
+        raise ValueError("Unsupported PBF features: " + ", ".join(sorted(missing)))
+    return header
+
+
+def iter_data_blobs(file_in):
+    '''Read the header and the OSMData blobs of a PBF file.
+
+    Parameters:
+        file_in: (str) Filepath to OSM PBF.
+    Returns:
+        header: (dict) See parse_header.
+        data_blobs: (iterator(bytes)) Encoded OSMData blobs, for parse_blob.
+    '''
+    blobs = iter_blobs(file_in)
+    header = read_header(blobs)
+    data_blobs = (blob for _, (blob_type, blob) in blobs
+                  if blob_type == "OSMData")
+    return header, data_blobs
+
+
+def _iter_blob_parts(data_blobs, workers):
+    if workers == 1:
+        for blob in data_blobs:
+            yield from parse_blob(blob)
+        return
+    with mp.Pool(workers) as pool:
+        for parts_lst in pool.imap(parse_blob, data_blobs):
+            yield from parts_lst
+
+
+def iter_pbf_parts(file_in, workers = 1):
+    '''Stream the elements of an OSM PBF as parts, in file order.
+
+    Parameters:
+        file_in: (str) Filepath to OSM PBF.
+        workers: (int) Number of processes decoding blocks. 1 runs serially;
+            None uses all CPUs.
+    Yields:
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...])
+    '''
+    _, data_blobs = iter_data_blobs(file_in)
+    yield from _iter_blob_parts(data_blobs, workers)
+
+
+def iter_pbf_positioned_parts(file_in, position = None):
+    '''Stream the elements of an OSM PBF as parts, with the position of each,
+    so the stream can be picked up again from any element.
+
+    Parameters:
+        file_in: (str) Filepath to OSM PBF.
+        position: (tuple) Position of the first element to yield, from an
+            earlier stream. From the first element if None.
+    Yields:
+        position: (tuple) (byte offset of the element's blob, index in block)
+        parts: (tuple) (tag, attrib, [(sub_tag, sub_attrib), ...])
+    '''
+    blobs = iter_blobs(file_in)
+    read_header(blobs)
+    if position is not None:
+        blobs.close()
+        blobs = iter_blobs(file_in, start=position[0])
+    first = 0 if position is None else position[1]
+    for offset, (blob_type, blob) in blobs:
+        if blob_type != "OSMData":
+            continue
+        parts_lst = parse_blob(blob)
+        for idx in range(first, len(parts_lst)):
+            yield (offset, idx), parts_lst[idx]
+        first = 0
+
+
+def iter_parts_events(parts_lst):
+    '''Turn element parts into events, as osm_parsers.iter_events yields.'''
+    for tag, attrib, sub_els in parts_lst:
+        yield "start", tag, attrib
+        for sub_tag, sub_attrib in sub_els:
+            yield "start", sub_tag, sub_attrib
+            yield "end", sub_tag, None
+        yield "end", tag, None
+
+
+def get_header_events(header, root_tag = "osm"):
+    '''Get the start events of the root element and its bounds, as in XML.'''
+    root_attrib = { "version" : "0.6" }
+    if header["writingprogram"]:
+        root_attrib["generator"] = header["writingprogram"]
+    events = [ ("start", root_tag, root_attrib) ]
+    if header["bbox"]:
+        events.extend([ ("start", "bounds", header["bbox"]),
+                        ("end", "bounds", None) ])
+    return events
+
+
+def iter_pbf_events(file_in, workers = 1):
+    '''Stream start and end events for every element of an OSM PBF, as
+    osm_parsers.iter_events does for XML, including an osm root element and
+    its bounds.
+
+    Parameters:
+        file_in: (str) Filepath to OSM PBF.
+        workers: (int) See iter_pbf_parts.
+    Yields:
+        event: (tuple) ("start", tag, attrib) or ("end", tag, None).
+    '''
+    header, data_blobs = iter_data_blobs(file_in)
+    yield from get_header_events(header)
+    yield from iter_parts_events(_iter_blob_parts(data_blobs, workers))
+    yield "end", "osm", None
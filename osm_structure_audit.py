@@ -1,84 +1,431 @@
-import xml.etree.ElementTree as ET
+from collections import Counter, defaultdict
+from functools import partial
+from hashlib import blake2b
+from itertools import chain
+import math
+import multiprocessing as mp
+import os
 import pandas as pd
 
+from osm_parsers import RangeReader, get_chunk_ranges, is_pbf, iter_events
+
+# PBF input needs numpy.
+try:
+    import osm_pbf
+except ImportError:
+    osm_pbf = None
+
 ## Elements and document structure:
 # How many of each kind of element do we have?
 # Which elements contain which?
 # And, what are their attributes?
-### Note: the osm element (i.e. the entire document) takes too much memory to
-### iterate through all of its subelements. It stops iteratinf after 105
-### subelements, so the list of its subelements is missing "way" and "relation".
+### Note: Subelements are tracked from the stack of open elements as the
+### document streams by, rather than by iterating each element's subtree. (That
+### stopped after 105 subelements of the osm element, so the list of its
+### subelements was missing "way" and "relation".)
 
 ## Tags and their keys and values:
 # What types of tags do we have?
 # (k attribute; "name", "service", "lanes", etc.)
 # What's their cardinality? (Count of unique v attributes per k attribute.)
 ### Note: In cases in which the dataset is too large to read the value sets into
-### memory, the code could be rewritten to just obtain the element and tag lists
-### and counts. The value sets could then be pulled as needed.
+### memory, use sketch mode. Unique counts are then estimated with HyperLogLog,
+### and the value sets are replaced by the most common values, so memory per
+### key is fixed.
+
+
+class HyperLogLog:
+    '''Estimates the number of distinct values added, in fixed memory of
+    2**precision bytes. Values are hashed with blake2b rather than hash(), so
+    sketches from different processes can be merged.
+    
+    Parameters:
+        precision: (int) Bits of the hash used to pick a register, 4 to 16.
+            Relative standard error is 1.04 / sqrt(2**precision).
+    '''
+    def __init__(self, precision = 12):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16.")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    @property
+    def rel_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, v):
+        x = int.from_bytes(blake2b(v.encode(), digest_size=8).digest(), "big")
+        idx = x >> (64 - self.precision)
+        w = x & ((1 << (64 - self.precision)) - 1)
+        # Position of the leftmost 1 bit in the remaining bits.
+        rank = 64 - self.precision - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+        return
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precision.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Small range correction (linear counting).
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class SpaceSaving:
+    '''Tracks the k most common values added, in fixed memory (Metwally et al.
+    space-saving). A value's count is over by at most its error.
+    
+    Parameters:
+        k: (int) Number of values tracked.
+    '''
+    def __init__(self, k = 20):
+        self.k = k
+        # {value: [count, error]}
+        self.counters = dict()
+
+    def add(self, v, count = 1, error = 0):
+        if v in self.counters:
+            self.counters[v][0] += count
+            self.counters[v][1] += error
+        elif len(self.counters) < self.k:
+            self.counters[v] = [count, error]
+        else:
+            # Replace the least common value, inheriting its count as error.
+            min_v = min(self.counters, key=lambda it: self.counters[it][0])
+            min_count = self.counters.pop(min_v)[0]
+            self.counters[v] = [min_count + count, min_count + error]
+        return
+
+    def merge(self, other):
+        for v, (count, error) in other.counters.items():
+            self.add(v, count, error)
+        return self
+
+    def top(self):
+        '''Returns: (list(tuple)) [(value, count, error), ...], most common
+        first.'''
+        return sorted(((v, count, error) for v, (count, error)
+                       in self.counters.items()),
+                      key=lambda it: it[1], reverse=True)
+
+
+class ValueSketch:
+    '''Approximate value set of one tag key. Counts exactly until there are
+    more than max_exact unique values, then switches to HyperLogLog. Keeps the
+    top_k most common values as a sample.
+    
+    Parameters:
+        precision: (int) HyperLogLog precision.
+        top_k: (int) Number of common values kept.
+        max_exact: (int) Unique values counted exactly before estimating.
+    '''
+    def __init__(self, precision = 12, top_k = 20, max_exact = 256):
+        self.precision = precision
+        self.max_exact = max_exact
+        self.exact = set()
+        self.hll = None
+        self.top_k = SpaceSaving(k=top_k)
+
+    def _to_hll(self):
+        self.hll = HyperLogLog(precision=self.precision)
+        for v in self.exact:
+            self.hll.add(v)
+        self.exact = None
+        return
+
+    def add(self, v):
+        if self.hll is None:
+            self.exact.add(v)
+            if len(self.exact) > self.max_exact:
+                self._to_hll()
+        else:
+            self.hll.add(v)
+        self.top_k.add(v)
+        return
+
+    def merge(self, other):
+        if self.hll is None and other.hll is None:
+            self.exact.update(other.exact)
+            if len(self.exact) > self.max_exact:
+                self._to_hll()
+        else:
+            if self.hll is None:
+                self._to_hll()
+            if other.hll is None:
+                for v in other.exact:
+                    self.hll.add(v)
+            else:
+                self.hll.merge(other.hll)
+        self.top_k.merge(other.top_k)
+        return self
+
+    @property
+    def is_exact(self):
+        return self.hll is None
+
+    @property
+    def rel_error(self):
+        return 0.0 if self.hll is None else self.hll.rel_error
+
+    def count(self):
+        return len(self.exact) if self.hll is None else self.hll.count()
+
+    def sample(self):
+        return set(v for v, _, _ in self.top_k.top())
 
-def get_eldf_tagdf(filename):
+
+class StructureAudit:
+    '''Partial results of the structure audit: counts of elements and tag
+    keys, and sets of subelements, attributes, and tag values. Partials from
+    different parts of a document merge into the result for the whole.
+    
+    Parameters:
+        sketch: (bool) Keep a ValueSketch per tag key instead of a value set.
+        precision: (int) HyperLogLog precision, if sketch.
+        top_k: (int) Values kept per key, if sketch.
+    '''
+    def __init__(self, sketch = False, precision = 12, top_k = 20):
+        self.sketch = sketch
+        self.top_k = top_k
+        # Count of each element type.
+        self.el_counts = Counter()
+        # Set of unique subelements types for each element type.
+        self.el_subels = defaultdict(set)
+        # Set of unique attributes for each element type.
+        self.el_attrs = defaultdict(set)
+        # Count of times tag key is used. (count per "k")
+        self.tag_counts = Counter()
+        # Set of unique tag values. (unique "v" per "k")
+        if sketch:
+            self.tag_vals = defaultdict(partial(ValueSketch,
+                                                precision=precision,
+                                                top_k=top_k))
+        else:
+            self.tag_vals = defaultdict(set)
+
+    def update(self, events, count_root = True):
+        '''Audit a stream of events, as from osm_parsers.iter_events.
+        
+        Parameters:
+            events: (iterable(tuple)) ("start", tag, attrib) or ("end", tag,
+                None).
+            count_root: (bool) Count the root element. False if the root was
+                added to wrap part of a document.
+        Returns:
+            self
+        '''
+        el_counts = self.el_counts
+        el_subels = self.el_subels
+        el_attrs = self.el_attrs
+        tag_counts = self.tag_counts
+        tag_vals = self.tag_vals
+        # Tags of the open elements.
+        tag_stack = list()
+        for event, tag, attrib in events:
+            if event == "end":
+                tag_stack.pop()
+                continue
+            if not tag_stack and not count_root:
+                tag_stack.append(tag)
+                continue
+        # Catalog/count the elements, and catalog their unique subelements
+            # and attributes.
+            el_counts[tag] += 1
+            el_attrs[tag].update(attrib)
+            for parent_tag in tag_stack:
+                if parent_tag != tag:
+                    el_subels[parent_tag].add(tag)
+            tag_stack.append(tag)
+        # Catalog/count tag keys, and catalog/count their unique values.
+            if tag == "tag":
+                tag_counts[attrib["k"]] += 1
+                tag_vals[attrib["k"]].add(attrib["v"])
+        return self
+
+    def merge(self, other):
+        '''Add another partial's results. Merge partials in document order to
+        keep the order elements and keys were first seen.'''
+        self.el_counts.update(other.el_counts)
+        for el_type, sub_els in other.el_subels.items():
+            self.el_subels[el_type].update(sub_els)
+        for el_type, attrs in other.el_attrs.items():
+            self.el_attrs[el_type].update(attrs)
+        self.tag_counts.update(other.tag_counts)
+        for k, vals in other.tag_vals.items():
+            if self.sketch:
+                self.tag_vals[k].merge(vals)
+            else:
+                self.tag_vals[k].update(vals)
+        return self
+
+    def get_dfs(self):
+        '''Returns: el_df, tag_df. See get_eldf_tagdf.'''
+        el_counts = self.el_counts
+        tag_counts = self.tag_counts
+        tag_vals = self.tag_vals
+
+        # Element dataframe.
+        el_types = list(el_counts)
+        el_df = pd.DataFrame({"count": pd.Series(el_counts, index=el_types,
+                                                 dtype="int"),
+                              "sub_els": pd.Series([self.el_subels[el_type]
+                                                    for el_type in el_types],
+                                                   index=el_types,
+                                                   dtype="object"),
+                              "attributes": pd.Series([self.el_attrs[el_type]
+                                                       for el_type in el_types],
+                                                      index=el_types,
+                                                      dtype="object")})
+        el_df.index.name = "element_type"
+
+        # Tag dataframe.
+        tag_keys = list(tag_counts)
+        if self.sketch:
+            val_sets = [tag_vals[k].sample() for k in tag_keys]
+        else:
+            val_sets = [tag_vals[k] for k in tag_keys]
+        tag_df = pd.DataFrame({"tag_use_count": pd.Series(tag_counts,
+                                                          index=tag_keys,
+                                                          dtype="int"),
+                               "val_set": pd.Series(val_sets, index=tag_keys,
+                                                    dtype="object")})
+        tag_df.index.name = "tag_key" # ("k")
+        # Get count of unique values. ("v")
+        if self.sketch:
+            tag_df["uniq_count"] = pd.Series([tag_vals[k].count()
+                                              for k in tag_keys],
+                                             index=tag_df.index, dtype="int")
+            # Estimated counts are within this relative error 68% of the time
+            # (one standard error); exact counts have none.
+            tag_df.attrs["uniq_count_rel_error"] = \
+                {k: tag_vals[k].rel_error for k in tag_keys}
+            tag_df.attrs["val_set_top_k"] = self.top_k
+        else:
+            tag_df["uniq_count"] = tag_df["val_set"].apply(len)
+        # Get ratio of unique values to tag uses.
+        tag_df["usage_per_uniq"] = \
+            tag_df["tag_use_count"] / tag_df["uniq_count"]
+
+        return el_df, tag_df
+
+
+def audit_range(filename, start, end, root_tag = "osm", parser = "auto",
+                sketch = False, precision = 12, top_k = 20):
+    '''Audit a byte range of an OSM doc, as from osm_parsers.get_chunk_ranges.
+    Ranges other than the first and last are wrapped in a stand-in root
+    element, which isn't counted.
+    
+    Parameters:
+        filename: (str) Filepath to OSM XML.
+        start: (int) First byte of the range.
+        end: (int) Byte after the range.
+        root_tag: (str) Tag of the document's root element.
+        parser, sketch, precision, top_k: See get_eldf_tagdf.
+    Returns:
+        range_audit: (StructureAudit) Results for the range.
+    '''
+    is_first = start == 0
+    is_last = end == os.path.getsize(filename)
+    prefix = b"" if is_first else ("<" + root_tag + ">").encode()
+    suffix = b"" if is_last else ("</" + root_tag + ">").encode()
+    range_audit = StructureAudit(sketch=sketch, precision=precision,
+                                 top_k=top_k)
+    with RangeReader(filename, start, end, prefix, suffix) as fi:
+        range_audit.update(iter_events(fi, parser=parser), count_root=is_first)
+    return range_audit
+
+
+def _audit_range_star(args):
+    return audit_range(*args)
+
+
+def audit_blob(blob, sketch = False, precision = 12, top_k = 20):
+    '''Audit a PBF data block, as from osm_pbf.iter_data_blobs, wrapped in a
+    stand-in root element, which isn't counted.
+    
+    Parameters:
+        blob: (bytes) Encoded PBF blob.
+        sketch, precision, top_k: See get_eldf_tagdf.
+    Returns:
+        blob_audit: (StructureAudit) Results for the block.
+    '''
+    events = osm_pbf.iter_parts_events(osm_pbf.parse_blob(blob))
+    blob_audit = StructureAudit(sketch=sketch, precision=precision,
+                                top_k=top_k)
+    blob_audit.update(chain([ ("start", "osm", dict()) ], events,
+                            [ ("end", "osm", None) ]), count_root=False)
+    return blob_audit
+
+
+def _audit_pbf(filename, sketch, precision, top_k, workers):
+    '''get_eldf_tagdf for PBF with workers: blocks are decoded and audited in
+    parallel, and merged after the header.'''
+    header, data_blobs = osm_pbf.iter_data_blobs(filename)
+    audit = StructureAudit(sketch=sketch, precision=precision, top_k=top_k)
+    audit.update(osm_pbf.get_header_events(header) + [ ("end", "osm", None) ])
+    with mp.Pool(workers) as pool:
+        # In order, so keys keep the order they were first seen.
+        for blob_audit in pool.imap(partial(audit_blob, sketch=sketch,
+                                            precision=precision, top_k=top_k),
+                                    data_blobs):
+            audit.merge(blob_audit)
+    return audit.get_dfs()
+
+
+def get_eldf_tagdf(filename, parser = "auto", sketch = False, precision = 12,
+                   top_k = 20, workers = 1, n_chunks = None):
     '''Given an OSM doc, gets dataframes of element counts and their subelements and attributes,
-    and of tag element keys and values and counts.
+    and of tag element keys and values and counts. Counts in plain dicts in a
+    single streaming pass, and builds the dataframes at the end. With workers,
+    byte ranges of the file are audited in parallel and merged.
     
     Parameters:
-        filename: (str) filepath to .
+        filename: (str) filepath to OSM XML, or OSM PBF (".pbf").
+        parser: (str) Parser backend. See osm_parsers.get_parser.
+        sketch: (bool) Use fixed memory per tag key. uniq_count is estimated
+            with HyperLogLog (exact up to 256 values), and val_set holds the
+            top_k most common values instead of all of them. tag_df.attrs
+            reports the error bounds.
+        precision: (int) HyperLogLog precision, if sketch. Relative standard
+            error of estimated counts is 1.04 / sqrt(2**precision).
+        top_k: (int) Values kept per key in val_set, if sketch.
+        workers: (int) Number of processes auditing byte ranges of the file in
+            parallel. 1 runs serially; None uses all CPUs. Results match the
+            serial run (except the sampled val_sets, if sketch).
+        n_chunks: (int) Number of byte ranges, if workers. Defaults to 4 per
+            worker. PBF is audited a block at a time instead.
         
     Returns:
         el_df: (pandas.DataFrame) elements.
         tag_df: (pandas.DataFrame) tags.
     '''
-    # Count of each element type.
-    el_count_ser = pd.Series(dtype="int", name="count")
-    # Set of unique subelements types for each element type.
-    el_subel_ser = pd.Series(dtype="object", name="sub_els")
-    # Set of unique attributes for each element type.
-    el_attr_ser = pd.Series(dtype="object", name="attributes")
-
-    # Count of times tag key is used. (count per "k")
-    count_ser = pd.Series(dtype="int", name="tag_use_count")
-    # Set of unique tag values. (unique "v" per "k")
-    set_ser = pd.Series(dtype="object", name="val_set")
-    # Count of unique tag values.
-    uniq_ser = pd.Series(dtype="int", name="uniq_count")
-    # Ratio of tag key's times used to tag's unique values.
-    # (count 'k' per count unique 'v')
-    ratio_ser = pd.Series(dtype="float", name="usage_per_uniq")
-
-#     osm_sub_count = 0
-    for _, el in ET.iterparse(source=filename, events=("start",)):
-    # Catalog/count the elements, and catalog their unique subelements
-        # and attributes.
-        if el.tag not in el_count_ser.index:
-            el_count_ser[el.tag] = 0
-            el_subel_ser[el.tag] = set()
-            el_attr_ser[el.tag] = set()
-        el_count_ser[el.tag] += 1
-        for att_k in el.attrib.keys():
-            el_attr_ser[el.tag].add(att_k)
-        for sub_el in el.iter():
-#             if el.tag == "osm":
-#                 osm_sub_count += 1
-            if el.tag != sub_el.tag:
-                el_subel_ser[el.tag].add(sub_el.tag)
-    # Catalog/count tag keys, and catalog/count their unique values.
-        if el.tag == "tag":
-            if el.attrib["k"] not in count_ser.index:
-                count_ser[el.attrib["k"]] = 0
-                set_ser[el.attrib["k"]] = set()
-            count_ser[el.attrib["k"]] += 1
-            set_ser[el.attrib["k"]].add(el.attrib["v"])
-
-    # Element dataframe.           
-    el_df = pd.concat([el_count_ser, el_subel_ser, el_attr_ser], axis=1)
-    el_df.index.name = "element_type"
-
-    # Tag dataframe.
-    tag_df = pd.concat([count_ser, set_ser, uniq_ser, ratio_ser], axis=1)
-    tag_df.index.name = "tag_key" # ("k")
-    # Get count of unique values. ("v")
-    tag_df["uniq_count"] = tag_df["val_set"].apply(len)
-    # Get ratio of unique values to tag uses.
-    tag_df["usage_per_uniq"] = tag_df["tag_use_count"] / tag_df["uniq_count"]
+    if workers is None:
+        workers = os.cpu_count()
+    if workers == 1:
+        audit = StructureAudit(sketch=sketch, precision=precision, top_k=top_k)
+        audit.update(iter_events(filename, parser=parser))
+        return audit.get_dfs()
+
+    if is_pbf(filename):
+        return _audit_pbf(filename, sketch, precision, top_k, workers)
+    if n_chunks is None:
+        n_chunks = 4 * workers
+    tasks = [(filename, start, end, "osm", parser, sketch, precision, top_k)
+             for start, end in get_chunk_ranges(filename, n_chunks)]
+    audit = None
+    with mp.Pool(workers) as pool:
+        # In order, so keys keep the order they were first seen.
+        for range_audit in pool.imap(_audit_range_star, tasks):
+            audit = range_audit if audit is None else audit.merge(range_audit)
     
-    return el_df, tag_df#, osm_sub_count
\ No newline at end of file
+    return audit.get_dfs()
@@ -0,0 +1,232 @@
+from array import array
+from collections import Counter
+import numpy as np
+
+## Referential integrity without MongoDB:
+# Which types of documents do ways and relations refer to?
+# Do relation member types match the documents they refer to?
+# Which references point outside the extract?
+# Ids and references are kept in compact int64 arrays as documents stream by,
+# then every reference is checked at once against the sorted ids. Results are
+# shaped like mongo_audit.audit_ref_types and get_doctype_mismatches.
+
+DOC_TYPES_LST = ["node", "way", "relation"]
+DOC_TYPE_IDX = {doc_type: idx for idx, doc_type in enumerate(DOC_TYPES_LST)}
+# Code for references to missing documents.
+MISSING = -1
+
+
+class RefIndex:
+    '''Index of document ids by type, and of the references ways and relations
+    make, built up one document at a time (e.g. by clean_and_write.process_map).
+    '''
+    def __init__(self):
+        # Ids per document type.
+        self.ids = {doc_type: array("q") for doc_type in DOC_TYPES_LST}
+        # Way node_refs. (referring way id, referenced id)
+        self.way_ids = array("q")
+        self.way_refs = array("q")
+        # Relation members. (referring relation id, referenced id, type, role)
+        self.rel_ids = array("q")
+        self.rel_refs = array("q")
+        self.rel_types = list()
+        self.rel_roles = list()
+
+    def add(self, doc_type, _id, node_refs = None, members = None):
+        '''Add a document.
+
+        Parameters:
+            doc_type: (str) "node", "way", or "relation".
+            _id: (str or int) Document id.
+            node_refs: (list(str or int)) Node references, if a way.
+            members: (list(dict)) Members, if a relation.
+                [{ "type" : <str>, "ref" : <id>, "role" : <str> }, ...]
+        Returns:
+            None
+        '''
+        _id = int(_id)
+        self.ids[doc_type].append(_id)
+        if node_refs:
+            self.way_ids.extend([_id] * len(node_refs))
+            self.way_refs.extend(int(ref) for ref in node_refs)
+        if members:
+            for member in members:
+                self.rel_ids.append(_id)
+                self.rel_refs.append(int(member["ref"]))
+                self.rel_types.append(member["type"])
+                self.rel_roles.append(member["role"])
+        return
+
+    def add_doc(self, doc):
+        '''Add a shaped document (see clean_and_write.shape_element).'''
+        self.add(doc["doc_type"], doc["_id"], doc.get("node_refs"),
+                 doc.get("members"))
+        return
+
+    def add_parts(self, parts):
+        '''Add an element given as parts (see osm_parsers.iter_parts), with
+        node_refs deduplicated and sorted as shape_element does.'''
+        tag, attrib, sub_els = parts
+        node_refs = sorted(set(sub_attrib["ref"]
+                               for sub_tag, sub_attrib in sub_els
+                               if sub_tag == "nd"))
+        members = [sub_attrib for sub_tag, sub_attrib in sub_els
+                   if sub_tag == "member"]
+        self.add(tag, attrib["id"], node_refs, members)
+        return
+
+    def merge(self, other):
+        '''Add another index's documents, e.g. one built in a worker process.'''
+        for doc_type in DOC_TYPES_LST:
+            self.ids[doc_type].extend(other.ids[doc_type])
+        self.way_ids.extend(other.way_ids)
+        self.way_refs.extend(other.way_refs)
+        self.rel_ids.extend(other.rel_ids)
+        self.rel_refs.extend(other.rel_refs)
+        self.rel_types.extend(other.rel_types)
+        self.rel_roles.extend(other.rel_roles)
+        return self
+
+    def _sort_ids(self):
+        '''Sort all ids, duplicates included, with their type indexes.
+        Stable, so an id used by more than one type comes first as the type
+        earliest in DOC_TYPES_LST.'''
+        ids = np.concatenate([np.frombuffer(self.ids[doc_type], dtype=np.int64)
+                              for doc_type in DOC_TYPES_LST])
+        types = np.concatenate([np.full(len(self.ids[doc_type]), idx,
+                                        dtype=np.int8)
+                                for idx, doc_type in enumerate(DOC_TYPES_LST)])
+        order = np.argsort(ids, kind="stable")
+        return ids[order], types[order]
+
+    @staticmethod
+    def _get_first(all_ids):
+        '''Mask of the first of each run of equal sorted ids.'''
+        keep = np.ones(len(all_ids), dtype=bool)
+        keep[1:] = all_ids[1:] != all_ids[:-1]
+        return keep
+
+    def get_lookup(self):
+        '''Sort all ids for lookups. An id used by more than one document
+        resolves to its type earliest in DOC_TYPES_LST, whatever the load order;
+        audit reports such ids.
+
+        Returns:
+            sorted_ids: (numpy.ndarray(int64)) All ids, sorted.
+            sorted_types: (numpy.ndarray(int8)) Type index (see DOC_TYPES_LST)
+                of each id.
+        '''
+        all_ids, all_types = self._sort_ids()
+        keep = self._get_first(all_ids)
+        return all_ids[keep], all_types[keep]
+
+    def lookup(self, refs, sorted_ids, sorted_types):
+        '''Get the type index of each referenced id, or MISSING.'''
+        refs = np.frombuffer(refs, dtype=np.int64)
+        if not len(sorted_ids):
+            return np.full(len(refs), MISSING, dtype=np.int8)
+        pos = np.searchsorted(sorted_ids, refs)
+        pos_in = np.minimum(pos, len(sorted_ids) - 1)
+        found = sorted_ids[pos_in] == refs
+        return np.where(found, sorted_types[pos_in], MISSING).astype(np.int8)
+
+    def audit(self, max_examples = 20):
+        '''Check every way and relation reference against the index.
+
+        Parameters:
+            max_examples: (int) Dangling references listed per kind.
+        Returns:
+            results: (dict)
+                "way_ref_types": Types ways point to, as audit_ref_types.
+                    [{ "type" : [<doc_type>] }, ...]
+                "relation_ref_types": Types relations point to, and the member
+                    types they call them, as audit_ref_types.
+                    [{ "type" : [<doc_type>], "referred_as" : [<type>, ...] },
+                     ...]
+                "way_mismatches": Ways pointing to non-nodes, as
+                    get_doctype_mismatches prints them (with only _id and
+                    doc_type of the referenced document).
+                "mismatched_members_lst": Relations with mismatched referenced
+                    document types, as get_doctype_mismatches returns.
+                "dangling_way_refs", "dangling_member_refs": (int) References
+                    to ids not in the index.
+                "dangling_way_examples", "dangling_member_examples":
+                    [(referrer id, referenced id), ...]
+                "role_counts": Member roles by member type.
+                    [{ "type" : <type>, "role" : <role>, "count" : <n> }, ...]
+                "duplicate_ids": (int) Ids used by more than one document, of
+                    the same type or not. References to them are checked
+                    against the type earliest in DOC_TYPES_LST (see
+                    get_lookup); MongoDB would keep one document per _id.
+                "duplicate_id_examples": [(id, [<doc_type>, ...]), ...]
+        '''
+        all_ids, all_types = self._sort_ids()
+        keep = self._get_first(all_ids)
+        sorted_ids, sorted_types = all_ids[keep], all_types[keep]
+        way_types = self.lookup(self.way_refs, sorted_ids, sorted_types)
+        rel_types = self.lookup(self.rel_refs, sorted_ids, sorted_types)
+        results = dict()
+
+        # Ways.
+        results["way_ref_types"] = [
+            { "type" : [DOC_TYPES_LST[idx]] }
+            for idx in np.unique(way_types[way_types != MISSING])]
+        way_ids = np.frombuffer(self.way_ids, dtype=np.int64)
+        way_refs = np.frombuffer(self.way_refs, dtype=np.int64)
+        mismatched = np.nonzero((way_types != MISSING)
+                                & (way_types != DOC_TYPE_IDX["node"]))[0]
+        results["way_mismatches"] = [
+            { "_id" : str(way_ids[i]), "doc_type" : "way",
+              "refs" : { "_id" : str(way_refs[i]),
+                         "doc_type" : DOC_TYPES_LST[way_types[i]] },
+              # Non-nodes sort after "node".
+              "comp" : 1 }
+            for i in mismatched]
+        dangling = np.nonzero(way_types == MISSING)[0]
+        results["dangling_way_refs"] = len(dangling)
+        results["dangling_way_examples"] = [
+            (str(way_ids[i]), str(way_refs[i])) for i in dangling[:max_examples]]
+
+        # Relations.
+        referred_as = dict()
+        mismatched_members_lst = list()
+        dangling_members = list()
+        role_counts = Counter()
+        for i, type_idx in enumerate(rel_types.tolist()):
+            member_type = self.rel_types[i]
+            role_counts[(member_type, self.rel_roles[i])] += 1
+            if type_idx == MISSING:
+                dangling_members.append((str(self.rel_ids[i]),
+                                         str(self.rel_refs[i])))
+                continue
+            doc_type = DOC_TYPES_LST[type_idx]
+            referred_as.setdefault(doc_type, set()).add(member_type)
+            if member_type != doc_type:
+                mismatched_members_lst.append({
+                    "_id" : str(self.rel_ids[i]),
+                    "members" : { "type" : doc_type,
+                                  "ref" : str(self.rel_refs[i]),
+                                  "role" : self.rel_roles[i] },
+                    "refs" : { "_id" : str(self.rel_refs[i]),
+                               "doc_type" : doc_type } })
+        results["relation_ref_types"] = [
+            { "type" : [doc_type], "referred_as" : sorted(referred_as[doc_type]) }
+            for doc_type in DOC_TYPES_LST if doc_type in referred_as]
+        results["mismatched_members_lst"] = mismatched_members_lst
+        results["dangling_member_refs"] = len(dangling_members)
+        results["dangling_member_examples"] = dangling_members[:max_examples]
+        results["role_counts"] = [
+            { "type" : member_type, "role" : role, "count" : count }
+            for (member_type, role), count in sorted(role_counts.items())]
+
+        # Duplicates.
+        dup_ids = np.unique(all_ids[~keep])
+        results["duplicate_ids"] = len(dup_ids)
+        starts = np.searchsorted(all_ids, dup_ids[:max_examples], side="left")
+        ends = np.searchsorted(all_ids, dup_ids[:max_examples], side="right")
+        results["duplicate_id_examples"] = [
+            (str(dup_ids[i]),
+             [DOC_TYPES_LST[idx] for idx in all_types[start:end].tolist()])
+            for i, (start, end) in enumerate(zip(starts, ends))]
+
+        return results
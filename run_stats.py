@@ -0,0 +1,205 @@
+from collections import Counter
+import copy
+import json
+import random
+import time
+
+## Timers, counters, and anomaly samples for a cleaning run.
+# A RunStats only collects what it's handed. clean_and_write.instrument hooks
+# one up to the pipeline by wrapping module functions, so nothing is timed or
+# counted, and no time is spent checking, unless a run asks for it.
+
+# Examples kept per anomaly kind.
+SAMPLES_PER_KIND = 5
+# Elements between progress checks of the clock.
+PROGRESS_CHECK_EVERY = 1000
+
+
+class RunStats:
+    '''Stage timers, hit counters, and sampled anomalies for a run.
+
+    Parameters:
+        progress_every: (float) Seconds between progress reports. No reports
+            if None.
+        report: (function) Takes a progress line. print by default.
+        samples: (int) Examples kept per anomaly kind, sampled evenly across
+            the run (reservoir sampling, seeded so reruns keep the same ones).
+    '''
+    def __init__(self, progress_every = None, report = print,
+                 samples = SAMPLES_PER_KIND):
+        self.progress_every = progress_every
+        self.report = report
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        '''Zero everything and restart the clock.'''
+        self.start = time.perf_counter()
+        self.elements = 0
+        # Cleared in place, since timers hold on to them.
+        if hasattr(self, "seconds"):
+            for counter in (self.seconds, self.calls, self.hits, self.anomalies):
+                counter.clear()
+        else:
+            self.seconds = Counter()
+            self.calls = Counter()
+            self.hits = Counter()
+            self.anomalies = Counter()
+        self.examples = dict()
+        self._rng = random.Random(0)
+        self._next_check = PROGRESS_CHECK_EVERY
+        self._last_report = self.start
+        return
+
+    def _tick(self, n = 1):
+        self.elements += n
+        if self.progress_every is not None and self.elements >= self._next_check:
+            self._next_check = self.elements + PROGRESS_CHECK_EVERY
+            now = time.perf_counter()
+            if now - self._last_report >= self.progress_every:
+                self._last_report = now
+                self.report(self.get_progress_str())
+        return
+
+    def timer(self, name, func, progress = False):
+        '''Wrap a function to add its run time and calls to a stage.
+
+        Parameters:
+            name: (str) Stage name.
+            func: (function) Function to time. Time includes functions it
+                calls.
+            progress: (bool) Count each call as an element done.
+        Returns:
+            timed: (function) Wrapped function.
+        '''
+        seconds = self.seconds
+        calls = self.calls
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds[name] += clock() - start
+                calls[name] += 1
+                if progress:
+                    self._tick()
+        timed.__wrapped__ = func
+        return timed
+
+    def time_iter(self, name, iterable):
+        '''Time a stage that produces items, such as parsing.'''
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds[name] += clock() - start
+                return
+            self.seconds[name] += clock() - start
+            self.calls[name] += 1
+            yield item
+
+    def hit(self, name, n = 1):
+        '''Count a hit of a rule or event.'''
+        self.hits[name] += n
+        return
+
+    def anomaly(self, kind, example):
+        '''Count an anomaly, sampling an example of it.
+
+        Parameters:
+            kind: (str) What's wrong, e.g. "Invalid document".
+            example: What it's wrong with. Copied if kept.
+        Returns:
+            None
+        '''
+        self.anomalies[kind] += 1
+        count = self.anomalies[kind]
+        examples = self.examples.setdefault(kind, list())
+        if count <= self.samples:
+            examples.append(copy.deepcopy(example))
+        else:
+            idx = self._rng.randrange(count)
+            if idx < self.samples:
+                examples[idx] = copy.deepcopy(example)
+        return
+
+    def pop(self):
+        '''Get everything gathered so far as a dict for merge, and reset.
+        Used to send a worker process's stats back with its results.'''
+        gathered = { "elements" : self.elements,
+                     "seconds" : dict(self.seconds), "calls" : dict(self.calls),
+                     "hits" : dict(self.hits),
+                     "anomalies" : dict(self.anomalies),
+                     "examples" : self.examples }
+        self.reset()
+        return gathered
+
+    def merge(self, gathered):
+        '''Add stats from pop, e.g. from a worker process.'''
+        self.seconds.update(gathered["seconds"])
+        self.calls.update(gathered["calls"])
+        self.hits.update(gathered["hits"])
+        for kind, examples in gathered["examples"].items():
+            # Keep the first examples of kinds seen here too.
+            kept = self.examples.setdefault(kind, list())
+            kept.extend(examples[:self.samples - len(kept)])
+        self.anomalies.update(gathered["anomalies"])
+        self._tick(gathered["elements"])
+        return
+
+    def get_progress_str(self):
+        '''Get a line on elements done and throughput so far.'''
+        seconds = time.perf_counter() - self.start
+        rate = self.elements / seconds if seconds else 0.0
+        return "{:,} elements in {:.1f} s ({:,.0f}/s)".format(
+            self.elements, seconds, rate)
+
+    def to_dict(self):
+        '''Get everything gathered, ready for JSON.
+
+        Returns:
+            stats: (dict) { "elements" : <n>, "seconds" : <wall clock>,
+                "elements_per_sec" : <n>,
+                "stages" : { <name> : { "seconds" : <total>, "calls" : <n>,
+                                        "us_per_call" : <mean> }, ... },
+                "hits" : { <name> : <n>, ... },
+                "anomalies" : { <kind> : { "count" : <n>,
+                                           "examples" : [...] }, ... } }
+            Stages are sorted by time spent, hits and anomalies by count.
+        '''
+        seconds = time.perf_counter() - self.start
+        stages = dict()
+        for name, total in self.seconds.most_common():
+            calls = self.calls[name]
+            stages[name] = { "seconds" : total, "calls" : calls,
+                             "us_per_call" : total / calls * 1e6 if calls
+                                             else None }
+        return { "elements" : self.elements, "seconds" : seconds,
+                 "elements_per_sec" : self.elements / seconds if seconds
+                                      else 0.0,
+                 "stages" : stages,
+                 "hits" : dict(self.hits.most_common()),
+                 "anomalies" : { kind : { "count" : count,
+                                          "examples" : self.examples.get(kind,
+                                                                         list()) }
+                                 for kind, count in self.anomalies.most_common() } }
+
+    def to_json(self, file_out = None, indent = 2):
+        '''Export to_dict as JSON, to a file if given.
+
+        Parameters:
+            file_out: (str) Filepath to write to.
+            indent: (int) JSON indent.
+        Returns:
+            stats_json: (str)
+        '''
+        stats_json = json.dumps(self.to_dict(), indent=indent, default=str)
+        if file_out is not None:
+            with open(file_out, "w") as fo:
+                fo.write(stats_json + "\n")
+        return stats_json
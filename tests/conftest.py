@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+
+import pytest
+
+# The modules live at the top of the repo, not in a package.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import osm_fixture
+
+# Nodes in the shared extract: enough for several worker batches and PBF
+# blocks, small enough to clean in about a second.
+FIXTURE_NODES = 5000
+
+
+@pytest.fixture(scope="session")
+def osm_xml(tmp_path_factory):
+    '''Generated OSM XML extract shared by the tests.'''
+    file_out = str(tmp_path_factory.mktemp("osm") / "fixture.osm")
+    return osm_fixture.write_osm(file_out, FIXTURE_NODES)
+
+
+@pytest.fixture(scope="session", params=[True, False], ids=["dense", "nodes"])
+def osm_pbf(request, tmp_path_factory):
+    '''The shared extract as OSM PBF, with DenseNodes and with plain nodes.'''
+    file_out = str(tmp_path_factory.mktemp("osm") / "fixture.osm.pbf")
+    return osm_fixture.write_pbf(file_out, FIXTURE_NODES, dense=request.param)
+
+
+@pytest.fixture
+def fo_pre(tmp_path):
+    '''Output filepath prefix in a fresh directory.'''
+    return str(tmp_path / "out")
+
+
+def time_best(func, repeats = 3):
+    '''Time the fastest of several calls, for the benchmarks.
+
+    Parameters:
+        func: (function) Called with no arguments.
+        repeats: (int) Number of calls.
+    Returns:
+        seconds: (float) Fastest call.
+        result: What the last call returned.
+    '''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+# Set to a MongoDB URI, e.g. mongodb://localhost:27017, to run the
+# benchmarks that need a real server. They're skipped otherwise.
+MONGO_URI_ENV = "OSM_TEST_MONGO_URI"
+
+
+@pytest.fixture
+def mongod_db():
+    '''Scratch database on the server at OSM_TEST_MONGO_URI, dropped after.'''
+    uri = os.environ.get(MONGO_URI_ENV)
+    if not uri:
+        pytest.skip(MONGO_URI_ENV + " is not set")
+    pymongo = pytest.importorskip("pymongo")
+    client = pymongo.MongoClient(uri)
+    db = client["osm_wrangling_test"]
+    client.drop_database(db.name)
+    yield db
+    client.drop_database(db.name)
+    client.close()
+
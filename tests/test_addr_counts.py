@@ -0,0 +1,116 @@
+import time
+
+import pandas as pd
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import clean_and_write
+import mongo_audit
+import osm_fixture
+
+# Ops that go to the server for documents.
+QUERY_OPS_LST = ["find", "find_one", "aggregate", "count_documents",
+                 "update_one", "update_many"]
+# Nodes in the extract benchmarked on a real server.
+BENCH_NODES = 200000
+
+
+class CountingCollection:
+    '''Collection wrapper counting queries.'''
+    def __init__(self, coll):
+        self._coll = coll
+        self.queries = list()
+
+    def __getattr__(self, name):
+        attr = getattr(self._coll, name)
+        if name in QUERY_OPS_LST:
+            self.queries.append(name)
+        return attr
+
+
+def baseline_counts(coll):
+    '''Counts as get_counts used to take them: every match pulled over.'''
+    count = lambda fltr: len(list(coll.find(fltr)))
+    return (count({ "addr.postcode" : { "$exists" : 1 } }),
+            count({ "addr.state" : { "$exists" : 1 } }),
+            count({ "addr" : { "$exists" : 1 } }))
+
+
+def baseline_update_states(coll):
+    '''update_states as it was: counts, update, counts again.'''
+    results_df = pd.DataFrame(0.0, columns=["Zip", "State", "Address"],
+                              index=["Pre_update", "Matched", "Modified",
+                                     "Post_update"])
+    results_df.loc["Pre_update"] = baseline_counts(coll)
+    result = coll.update_many({ "addr.postcode" : { "$exists" : True } },
+                              { "$set" : { "addr.state" : "WA" } },
+                              upsert=True)
+    results_df.loc["Matched", "Zip"] = result.matched_count
+    results_df.loc["Modified", "State"] = result.modified_count
+    results_df.loc["Post_update"] = baseline_counts(coll)
+    return results_df
+
+
+def load(osm_xml, coll):
+    clean_and_write.load_map(osm_xml, coll)
+    # Some states already set, so not every postcode is modified.
+    coll.update_many({ "_id" : { "$in" : ["1", "2", "3", "4", "5"] } },
+                     { "$set" : { "addr.state" : "WA" } })
+    return coll
+
+
+@pytest.fixture(scope="module")
+def osm_xml(tmp_path_factory):
+    file_out = str(tmp_path_factory.mktemp("counts") / "counts.osm")
+    return osm_fixture.write_osm(file_out, 2000)
+
+
+def test_counts_match_baseline(osm_xml):
+    coll = load(osm_xml, mongomock.MongoClient().db.bham)
+    counting = CountingCollection(coll)
+    assert mongo_audit.get_counts(counting) == baseline_counts(coll)
+    assert counting.queries == ["aggregate"]
+
+
+@pytest.mark.parametrize("loaded", [True, False])
+def test_update_states_matches_baseline(osm_xml, loaded):
+    colls = [ mongomock.MongoClient().db.bham for _ in range(2) ]
+    if loaded:
+        colls = [ load(osm_xml, coll) for coll in colls ]
+    counting = CountingCollection(colls[0])
+    results_df = mongo_audit.update_states(counting)
+    pd.testing.assert_frame_equal(results_df, baseline_update_states(colls[1]),
+                                  check_names=False)
+    assert counting.queries == ["aggregate", "update_many"]
+    # Upserted documents get new ObjectIds.
+    list_docs = lambda coll: list(coll.find(projection={ "_id" : 0 })
+                                  .sort("_id"))
+    assert list_docs(colls[0]) == list_docs(colls[1])
+
+
+def test_update_states_bumps_generation_on_change(osm_xml):
+    coll = load(osm_xml, mongomock.MongoClient().db.bham)
+    generation = mongo_audit.get_generation(coll)
+    mongo_audit.update_states(coll)
+    assert mongo_audit.get_generation(coll) != generation
+    # Nothing left to fix, so nothing to invalidate.
+    generation = mongo_audit.get_generation(coll)
+    results_df = mongo_audit.update_states(coll)
+    assert results_df.loc["Modified", "State"] == 0
+    assert mongo_audit.get_generation(coll) == generation
+
+
+def test_bench_counts(mongod_db, tmp_path):
+    osm_xml = osm_fixture.write_osm(str(tmp_path / "bench.osm"), BENCH_NODES)
+    coll = load(osm_xml, mongod_db.bham)
+    timings = dict()
+    for name, func in [("find and len", baseline_counts),
+                       ("$facet", mongo_audit.get_counts)]:
+        start = time.perf_counter()
+        counts = func(coll)
+        timings[name] = time.perf_counter() - start
+    print("address counts {}: {:.3f} s pulling every match, {:.3f} s with one "
+          "$facet".format(counts, timings["find and len"], timings["$facet"]))
+    assert counts == baseline_counts(coll)
+    assert timings["$facet"] < timings["find and len"]
@@ -0,0 +1,63 @@
+import tracemalloc
+
+import pytest
+
+import clean_and_write
+import osm_fixture
+
+# Nodes of each kind measured.
+BENCH_NODES = 1000
+
+
+@pytest.fixture(scope="module")
+def nodes():
+    node_lst = [ parts for parts in osm_fixture.iter_elements(10000, seed=2)
+                 if parts[0] == "node" ]
+    untagged = [ parts for parts in node_lst if not parts[2] ]
+    tagged = [ parts for parts in node_lst if parts[2] ]
+    return untagged[:BENCH_NODES], tagged[:BENCH_NODES]
+
+
+def get_peak_bytes(func, args_lst):
+    '''Mean bytes allocated at the peak of each call, including what the
+    call returns.'''
+    total = 0
+    tracemalloc.start()
+    try:
+        for args in args_lst:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            result = func(*args)
+            total += tracemalloc.get_traced_memory()[1] - before
+            del result
+    finally:
+        tracemalloc.stop()
+    return total / len(args_lst)
+
+
+def test_bench_node_allocations(nodes):
+    untagged, tagged = nodes
+    # Warm the rule caches, so rules compiled once aren't counted.
+    for parts in tagged:
+        clean_and_write.shape_parts(*parts)
+    lstkeydict_bytes = get_peak_bytes(clean_and_write.get_lstkeydict,
+                                      [()] * BENCH_NODES)
+    untagged_bytes = get_peak_bytes(clean_and_write.shape_parts, untagged)
+    tagged_bytes = get_peak_bytes(clean_and_write.shape_parts, tagged)
+    print("peak bytes per node: {:,.0f} untagged, {:,.0f} tagged; "
+          "get_lstkeydict() alone, which every element used to build: {:,.0f}"
+          .format(untagged_bytes, tagged_bytes, lstkeydict_bytes))
+    # Untagged nodes shape in less than the old per-element overhead.
+    assert untagged_bytes < lstkeydict_bytes
+    assert untagged_bytes < tagged_bytes
+
+
+def test_untagged_nodes_skip_tag_handling(nodes):
+    untagged, _ = nodes
+    tag, attrib, sub_els = untagged[0]
+    doc = clean_and_write.shape_parts(tag, attrib, sub_els)
+    assert doc == { "doc_type" : "node", "_id" : attrib["id"],
+                    "visible" : "true",
+                    "created" : { k : attrib[k] for k
+                                  in clean_and_write.CREATED_LST },
+                    "pos" : [float(attrib["lat"]), float(attrib["lon"])] }
@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+
+import pytest
+
+import clean_and_write
+import osm_fixture
+from conftest import FIXTURE_NODES
+
+# Elements between checkpoints, and per batch.
+CHECKPOINT_EVERY = 500
+BATCH_SIZE = 100
+# Documents encoded, in each process, before the run is interrupted.
+CRASH_AFTER = 2345
+
+# Documents left to encode before crashing, or None. Worker processes fork
+# with the value set in the test.
+_docs_left = None
+
+
+class Crash(Exception):
+    pass
+
+
+def encode_until_crash(el):
+    '''Encode as the "json" encoder does, raising once _docs_left runs out.'''
+    global _docs_left
+    if _docs_left is not None:
+        if _docs_left == 0:
+            raise Crash()
+        _docs_left -= 1
+    return json.dumps(el, indent=2)
+
+
+@pytest.fixture(params=["xml", "pbf"])
+def file_in(request, osm_xml, tmp_path):
+    if request.param == "xml":
+        return osm_xml
+    return osm_fixture.write_pbf(str(tmp_path / "in.osm.pbf"), FIXTURE_NODES)
+
+
+@pytest.fixture
+def expected(file_in, tmp_path):
+    return osm_fixture.read_bytes(clean_and_write.process_map(
+        file_in, str(tmp_path / "expected")))
+
+
+def run(file_in, fo_pre, workers, resume = False):
+    return clean_and_write.process_map(file_in, fo_pre, workers=workers,
+                                       encoder=encode_until_crash,
+                                       batch_size=BATCH_SIZE,
+                                       checkpoint=CHECKPOINT_EVERY,
+                                       resume=resume)
+
+
+def interrupt(file_in, fo_pre, workers, monkeypatch):
+    monkeypatch.setattr(sys.modules[__name__], "_docs_left", CRASH_AFTER)
+    with pytest.raises(Crash):
+        run(file_in, fo_pre, workers)
+    monkeypatch.setattr(sys.modules[__name__], "_docs_left", None)
+    checkpoint = clean_and_write.read_checkpoint(fo_pre)
+    assert 0 < checkpoint["elements"] and not checkpoint["done"]
+    return checkpoint
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_resume_matches_uninterrupted(file_in, fo_pre, expected, workers,
+                                      monkeypatch):
+    interrupt(file_in, fo_pre, workers, monkeypatch)
+    # Output cut off partway through a document, after the checkpoint.
+    with open(fo_pre + ".json", "ab") as fo:
+        fo.write(b'{\n  "doc_type": "no')
+    files_out = run(file_in, fo_pre, workers, resume=True)
+    assert osm_fixture.read_bytes(files_out) == expected
+    assert clean_and_write.read_checkpoint(fo_pre)["done"]
+
+
+def test_rerun_without_resume_starts_over(osm_xml, fo_pre, monkeypatch):
+    interrupt(osm_xml, fo_pre, 1, monkeypatch)
+    files_out = run(osm_xml, fo_pre, 1)
+    first = osm_fixture.read_bytes(files_out)
+    # Resuming a finished run leaves it as it is.
+    assert osm_fixture.read_bytes(run(osm_xml, fo_pre, 1, resume=True)) == first
+    assert first.count(b'"doc_type"') == \
+        sum(1 for _ in osm_fixture.iter_elements(FIXTURE_NODES))
+
+
+def test_resume_needs_same_options(osm_xml, fo_pre, monkeypatch):
+    interrupt(osm_xml, fo_pre, 1, monkeypatch)
+    with pytest.raises(ValueError):
+        clean_and_write.process_map(osm_xml, fo_pre, encoder=encode_until_crash,
+                                    checkpoint=CHECKPOINT_EVERY, resume=True,
+                                    geojson=True)
+    assert os.path.getsize(fo_pre + ".json") > 0
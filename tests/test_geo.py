@@ -0,0 +1,80 @@
+import math
+
+import pytest
+
+import clean_and_write
+import mongo_audit
+import osm_fixture
+from conftest import time_best
+
+# Nodes in the extract queried on a real server.
+BENCH_NODES = 200000
+# Query center, within the generated bounds, and radius.
+CENTER_LON, CENTER_LAT = -122.45, 48.75
+RADIUS_KM = 0.5
+# Repeats per timing.
+BENCH_REPEATS = 20
+
+
+def get_km(lon_a, lat_a, lon_b, lat_b):
+    '''Haversine distance.'''
+    lon_a, lat_a, lon_b, lat_b = map(math.radians, [lon_a, lat_a, lon_b, lat_b])
+    hav = math.sin((lat_b - lat_a) / 2) ** 2 + \
+        math.cos(lat_a) * math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * mongo_audit.EARTH_RADIUS_KM * math.asin(math.sqrt(hav))
+
+
+def test_geojson_points(osm_xml):
+    docs = list(clean_and_write.iter_docs(osm_xml, geojson=True))
+    nodes = [ doc for doc in docs if doc["doc_type"] == "node" ]
+    assert nodes
+    for doc in nodes:
+        assert doc["loc"] == { "type" : "Point",
+                               "coordinates" : [doc["pos"][1], doc["pos"][0]] }
+    assert not any("loc" in doc for doc in docs if doc["doc_type"] != "node")
+    assert not any("loc" in doc for doc in clean_and_write.iter_docs(osm_xml))
+
+
+def test_filters():
+    box = mongo_audit.get_box_filter(-122.5, 48.7, -122.4, 48.8)
+    ring = box["loc"]["$geoWithin"]["$geometry"]["coordinates"][0]
+    assert ring == [[-122.5, 48.7], [-122.4, 48.7], [-122.4, 48.8],
+                    [-122.5, 48.8], [-122.5, 48.7]]
+    center, radians = mongo_audit.get_radius_filter(
+        CENTER_LON, CENTER_LAT, RADIUS_KM)["loc"]["$geoWithin"]["$centerSphere"]
+    assert center == [CENTER_LON, CENTER_LAT]
+    assert radians * mongo_audit.EARTH_RADIUS_KM == pytest.approx(RADIUS_KM)
+
+
+@pytest.fixture
+def geo_coll(mongod_db, tmp_path):
+    osm_xml = osm_fixture.write_osm(str(tmp_path / "geo.osm"), BENCH_NODES)
+    coll = mongod_db.bham
+    clean_and_write.load_map(osm_xml, coll, geojson=True)
+    return coll
+
+
+def time_within(coll, geo_filter):
+    seconds, doc_lst = time_best(
+        lambda: mongo_audit.find_within(coll, geo_filter,
+                                        projection={ "loc" : 1 }),
+        repeats=BENCH_REPEATS)
+    return seconds, sorted(doc["_id"] for doc in doc_lst)
+
+
+def test_bench_within(geo_coll):
+    geo_filter = mongo_audit.get_radius_filter(CENTER_LON, CENTER_LAT,
+                                               RADIUS_KM)
+    scan_seconds, scan_ids = time_within(geo_coll, geo_filter)
+    mongo_audit.ensure_geo_index(geo_coll)
+    index_seconds, index_ids = time_within(geo_coll, geo_filter)
+    print("{} nodes within {} km: {:.1f} ms scanning, {:.1f} ms with 2dsphere"
+          .format(len(index_ids), RADIUS_KM, scan_seconds * 1000,
+                  index_seconds * 1000))
+    assert index_ids == scan_ids
+    # Compare with distances computed here, leaving out nodes on the edge.
+    expected = [ doc["_id"] for doc in geo_coll.find({ "loc" : { "$exists" : 1 } })
+                 if get_km(CENTER_LON, CENTER_LAT,
+                           *doc["loc"]["coordinates"]) < RADIUS_KM * 0.999 ]
+    assert set(expected) <= set(index_ids)
+    assert index_seconds < scan_seconds
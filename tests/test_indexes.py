@@ -0,0 +1,78 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import audit_runner
+import mongo_indexes
+
+
+@pytest.fixture
+def coll():
+    coll = mongomock.MongoClient().db.bham
+    coll.insert_many([ { "_id" : str(idx), "doc_type" : "node",
+                         "addr" : { "postcode" : "98225" } }
+                       for idx in range(10) ])
+    return coll
+
+
+def get_keys(coll):
+    return { tuple(info["key"]) : info.get("sparse", False)
+             for info in coll.index_information().values() }
+
+
+def test_ensure_indexes(coll):
+    mongo_indexes.ensure_indexes(coll, ["update_states", "count_docs_by"])
+    assert get_keys(coll) == { (("_id", 1),) : False,
+                               (("addr", 1),) : True,
+                               (("addr.postcode", 1),) : True,
+                               (("doc_type", 1),) : False }
+
+
+def test_existing_index_kept(coll):
+    # Not sparse, as declared. Creating the sparse one would conflict.
+    name = coll.create_index([("addr", 1)])
+    index_lst = mongo_indexes.ensure_indexes(coll, ["get_addr_counts"])
+    assert index_lst == [("bham", name)]
+    assert get_keys(coll)[(("addr", 1),)] is False
+
+
+def test_run_audits_ensures_indexes(coll):
+    results, _ = audit_runner.run_audits(coll, ["doc_counts"])
+    assert results["doc_counts"].error is None
+    assert (("doc_type", 1),) in get_keys(coll)
+    coll.drop_indexes()
+    audit_runner.run_audits(coll, ["doc_counts"], indexes=False)
+    assert (("doc_type", 1),) not in get_keys(coll)
+
+
+class FakeCursor:
+    def __init__(self, runs):
+        self.runs = runs
+
+    def clone(self):
+        return FakeCursor(self.runs)
+
+    def explain(self):
+        self.runs.append("explain")
+        return { "executionStats" : { "nReturned" : 0 } }
+
+
+class FakeCollection:
+    name = "bham"
+
+    def __init__(self):
+        self.runs = list()
+
+    def find(self, *args, **kwargs):
+        self.runs.append("find")
+        return FakeCursor(self.runs)
+
+
+def test_explained_find_builds_one_cursor():
+    fake = FakeCollection()
+    report_lst = list()
+    cursor = mongo_indexes.ExplainCollection(fake, report_lst).find({ "a" : 1 })
+    assert fake.runs == ["find", "explain"]
+    assert isinstance(cursor, FakeCursor)
+    assert report_lst[0]["op"] == "find"
+    assert report_lst[0]["explain_seconds"] >= 0
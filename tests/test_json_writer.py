@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+import clean_and_write
+import osm_fixture
+from conftest import time_best
+
+
+@pytest.fixture(scope="module")
+def docs(osm_xml):
+    return list(clean_and_write.iter_docs(osm_xml))
+
+
+def get_throughput(write_docs, docs):
+    '''Best of 3 docs/sec.'''
+    return len(docs) / time_best(lambda: write_docs(docs))[0]
+
+
+def test_bench_writer_vs_write_el(docs, tmp_path):
+    file_out = str(tmp_path / "docs.json")
+
+    def write_each(docs):
+        open(file_out, "w").close()
+        for el in docs:
+            clean_and_write.write_el(el=el, file_out=file_out)
+
+    def write_batched(docs):
+        with clean_and_write.JSONWriter(file_out, mode="w") as writer:
+            for el in docs:
+                writer.write(el)
+
+    each_rate = get_throughput(write_each, docs)
+    with open(file_out, "rb") as fi:
+        each_out = fi.read()
+    batched_rate = get_throughput(write_batched, docs)
+    with open(file_out, "rb") as fi:
+        batched_out = fi.read()
+    print("write_el: {:,.0f} docs/s, JSONWriter: {:,.0f} docs/s ({:.1f}x)"
+          .format(each_rate, batched_rate, batched_rate / each_rate))
+    assert batched_out == each_out
+    assert batched_rate > each_rate
+
+
+@pytest.mark.skipif(clean_and_write.orjson is None,
+                    reason="orjson is not installed")
+def test_orjson_matches_json(osm_xml, tmp_path):
+    outputs = dict()
+    for encoder in ["json", "orjson"]:
+        for pretty in [True, False]:
+            fo_pre = str(tmp_path / (encoder + str(pretty)))
+            outputs[encoder, pretty] = osm_fixture.read_bytes(
+                clean_and_write.process_map(osm_xml, fo_pre, encoder=encoder,
+                                            pretty=pretty))
+    # Indented output is byte-identical; compact output differs in spacing.
+    assert outputs["json", True] == outputs["orjson", True]
+    json_lines = outputs["json", False].splitlines()
+    orjson_lines = outputs["orjson", False].splitlines()
+    assert len(json_lines) == len(orjson_lines)
+    assert all(json.loads(a) == json.loads(b)
+               for a, b in zip(json_lines, orjson_lines))
+
+
+def test_encoder_function(docs, tmp_path):
+    file_out = str(tmp_path / "docs.json")
+    with clean_and_write.JSONWriter(file_out, mode="w", encoder=json.dumps,
+                                    batch_size=7) as writer:
+        for el in docs:
+            writer.write(el)
+    with open(file_out) as fi:
+        assert [ json.loads(line) for line in fi ] == docs
@@ -0,0 +1,93 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pymongo = pytest.importorskip("pymongo")
+
+import clean_and_write
+import mongo_audit
+import osm_fixture
+
+# mongomock is slow; a smaller extract still spans several batches.
+LOAD_NODES = 1000
+
+
+@pytest.fixture(scope="module")
+def osm_xml(tmp_path_factory):
+    file_out = str(tmp_path_factory.mktemp("load") / "load.osm")
+    return osm_fixture.write_osm(file_out, LOAD_NODES)
+
+
+@pytest.fixture
+def coll():
+    return mongomock.MongoClient().db.bham
+
+
+@pytest.fixture(scope="module")
+def docs(osm_xml):
+    return sorted(clean_and_write.iter_docs(osm_xml), key=lambda el: el["_id"])
+
+
+@pytest.mark.parametrize("batch_size, in_flight", [(1000, 2), (97, 1), (97, 4)])
+def test_load_map_loads_shaped_docs(osm_xml, coll, docs, batch_size,
+                                    in_flight):
+    stats = clean_and_write.load_map(osm_xml, coll, batch_size=batch_size,
+                                     in_flight=in_flight)
+    assert stats["docs"] == stats["written"] == len(docs)
+    assert stats["docs_per_sec"] > 0
+    assert list(coll.find().sort("_id")) == docs
+
+
+def test_reload_needs_upsert(osm_xml, coll, docs):
+    clean_and_write.load_map(osm_xml, coll)
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        clean_and_write.load_map(osm_xml, coll)
+
+
+def test_upsert_reload_replaces_docs(osm_xml, coll, docs):
+    clean_and_write.load_map(osm_xml, coll)
+    coll.update_many(dict(), { "$set" : { "stale" : True } })
+    stats = clean_and_write.load_map(osm_xml, coll, upsert=True)
+    assert stats["written"] == len(docs)
+    assert list(coll.find().sort("_id")) == docs
+
+
+def write_osc(file_out, changes):
+    '''Write [(action, tag, id), ...] as osmChange XML.'''
+    with open(file_out, "w", encoding="utf-8") as fo:
+        fo.write('<osmChange version="0.6" generator="test">\n')
+        for action, tag, _id in changes:
+            attrib = { "id" : _id, "version" : "8", "changeset" : "100000",
+                       "timestamp" : "2021-01-01T00:00:00Z", "user" : "u1",
+                       "uid" : "1" }
+            if tag == "node":
+                attrib.update(lat="48.75", lon="-122.45")
+            fo.write(" <{0}><{1} {2}/></{0}>\n".format(
+                action, tag, osm_fixture._format_attrib(attrib)))
+        fo.write("</osmChange>\n")
+    return file_out
+
+
+def test_change_keeps_other_doc_type(osm_xml, coll, tmp_path):
+    clean_and_write.load_map(osm_xml, coll)
+    node = coll.find_one({ "_id" : "1" })
+    assert node["doc_type"] == "node"
+    osc = write_osc(str(tmp_path / "way.osc"), [("create", "way", "1")])
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        clean_and_write.apply_changes(osc, coll)
+    assert coll.find_one({ "_id" : "1" }) == node
+
+
+def test_delete_drops_ref_docs(osm_xml, coll, tmp_path):
+    clean_and_write.load_map(osm_xml, coll)
+    mongo_audit.write_ref_docs(coll.database, coll)
+    ref_docs = coll.database[mongo_audit.REF_DOCS_STR]
+    ref_docs.delete_many(dict())
+    ref_docs.insert_many([ { "_id" : _id, "refers" : ["9"], "refer_count" : 1 }
+                           for _id in ["1", "2", "3"] ])
+    osc = write_osc(str(tmp_path / "delete.osc"),
+                    [("delete", "node", "1"), ("delete", "node", "2"),
+                     ("create", "node", "2")])
+    stats = clean_and_write.apply_changes(osc, coll, batch_size=1)
+    assert stats["deleted"] == 2 and stats["unreferenced"] == 1
+    assert coll.find_one({ "_id" : "1" }) is None
+    assert sorted(doc["_id"] for doc in ref_docs.find()) == ["2", "3"]
@@ -0,0 +1,58 @@
+import pytest
+
+import clean_and_write
+import osm_fixture
+from node_locations import NodeLocations
+
+# Nodes in the extract without ways.
+NODES_ONLY = 50
+
+
+class FinishedLocations(NodeLocations):
+    '''Fails if a lookup would have to finish the index itself.'''
+    def lookup(self, refs):
+        assert self.finished
+        return super().lookup(refs)
+
+
+@pytest.fixture
+def nodes_xml(tmp_path):
+    file_out = str(tmp_path / "nodes.osm")
+    with open(file_out, "w", encoding="utf-8") as fo:
+        fo.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+        for tag, attrib, _ in osm_fixture.iter_elements(NODES_ONLY):
+            if tag == "node":
+                fo.write(" <node {}/>\n".format(
+                    osm_fixture._format_attrib(attrib)))
+        fo.write("</osm>\n")
+    return file_out
+
+
+def test_finished_where_nodes_end(osm_xml, tmp_path):
+    node_locs = FinishedLocations(str(tmp_path / "locs"))
+    docs = list(clean_and_write.iter_docs(osm_xml, node_locs=node_locs))
+    assert any("line" in doc for doc in docs)
+
+
+def test_finished_without_ways(nodes_xml, tmp_path):
+    node_locs = NodeLocations(str(tmp_path / "locs"))
+    docs = list(clean_and_write.iter_docs(nodes_xml, node_locs=node_locs))
+    assert len(docs) == NODES_ONLY
+    assert node_locs.finished and len(node_locs.ids) == NODES_ONLY
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_workers_match_serial(osm_xml, tmp_path, ordered):
+    serial_out = clean_and_write.process_map(
+        osm_xml, str(tmp_path / "serial"),
+        node_locs=NodeLocations(str(tmp_path / "serial_locs")))
+    workers_out = clean_and_write.process_map(
+        osm_xml, str(tmp_path / "workers"), workers=2, ordered=ordered,
+        batch_size=100, node_locs=NodeLocations(str(tmp_path / "workers_locs")))
+    serial = osm_fixture.read_bytes(serial_out)
+    assert b'"line"' in serial
+    if ordered:
+        assert osm_fixture.read_bytes(workers_out) == serial
+    else:
+        assert sorted(osm_fixture.read_bytes(workers_out).splitlines()) == \
+            sorted(serial.splitlines())
@@ -0,0 +1,44 @@
+import copy
+
+import pytest
+
+import clean_and_write
+import osm_fixture
+import osm_parsers
+from conftest import FIXTURE_NODES
+
+# XML backends, lxml only if installed.
+XML_PARSERS_LST = [ pytest.param(parser, marks=pytest.mark.skipif(
+                        parser == "lxml" and osm_parsers.lxml_etree is None,
+                        reason="lxml is not installed"))
+                    for parser in ["etree", "expat", "lxml", "auto"] ]
+
+
+def list_parts(file_in, parser):
+    # etree attrib dicts are only valid until the next element.
+    return [ copy.deepcopy(parts)
+             for parts in osm_parsers.iter_parts(file_in, parser=parser) ]
+
+
+@pytest.mark.parametrize("parser", XML_PARSERS_LST)
+def test_parts_match_generated(osm_xml, parser):
+    assert list_parts(osm_xml, parser) == \
+        list(osm_fixture.iter_elements(FIXTURE_NODES))
+
+
+@pytest.mark.parametrize("parser", XML_PARSERS_LST)
+def test_process_map_matches_etree(osm_xml, tmp_path, parser):
+    outputs = [ osm_fixture.read_bytes(clean_and_write.process_map(
+                    osm_xml, str(tmp_path / str(idx)), parser=name))
+                for idx, name in enumerate(["etree", parser]) ]
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("parser", XML_PARSERS_LST)
+def test_events_match_etree(osm_xml, parser):
+    list_events = lambda name: [ (event, tag, dict(attrib or dict()))
+                                 for event, tag, attrib
+                                 in osm_parsers.iter_events(osm_xml,
+                                                            parser=name) ]
+    assert list_events(parser) == list_events("etree")
+
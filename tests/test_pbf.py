@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+import clean_and_write
+import osm_fixture
+from osm_pbf import iter_data_blobs, iter_pbf_parts
+import osm_structure_audit
+from conftest import FIXTURE_NODES
+
+
+def float_coords(parts_lst):
+    # PBF coordinates read back as the same floats, but not the same strings:
+    # "48.7000000" in XML is "48.7" from PBF.
+    return [ (tag, { k : float(v) if k in ("lat", "lon") else v
+                     for k, v in attrib.items() }, sub_els)
+             for tag, attrib, sub_els in parts_lst ]
+
+
+def test_header(osm_pbf):
+    header, _ = iter_data_blobs(osm_pbf)
+    assert { k : float(v) for k, v in header["bbox"].items() } == \
+        { k : float(v) for k, v in osm_fixture.BOUNDS_MAP.items() }
+    assert header["writingprogram"] == "osm_fixture"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parts_match_xml(osm_pbf, workers):
+    assert float_coords(iter_pbf_parts(osm_pbf, workers=workers)) == \
+        float_coords(osm_fixture.iter_elements(FIXTURE_NODES))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_map_matches_xml(osm_xml, osm_pbf, tmp_path, workers):
+    xml_out = clean_and_write.process_map(osm_xml, str(tmp_path / "xml"))
+    pbf_out = clean_and_write.process_map(osm_pbf, str(tmp_path / "pbf"),
+                                          workers=workers)
+    assert osm_fixture.read_bytes(pbf_out) == osm_fixture.read_bytes(xml_out)
+
+
+def test_structure_audit_matches_xml(osm_xml, osm_pbf):
+    xml_el_df, xml_tag_df = osm_structure_audit.get_eldf_tagdf(osm_xml)
+    pbf_el_df, pbf_tag_df = osm_structure_audit.get_eldf_tagdf(osm_pbf)
+    assert pbf_el_df.equals(xml_el_df)
+    assert pbf_tag_df.equals(xml_tag_df)
+
+
+def test_bench_pbf_vs_xml(osm_xml, osm_pbf, tmp_path):
+    seconds = dict()
+    for name, file_in, workers in [("xml", osm_xml, 1), ("pbf", osm_pbf, 1),
+                                   ("pbf_workers", osm_pbf, 2)]:
+        start = time.perf_counter()
+        clean_and_write.process_map(file_in, str(tmp_path / name),
+                                    workers=workers)
+        seconds[name] = time.perf_counter() - start
+    xml_bytes, pbf_bytes = os.path.getsize(osm_xml), os.path.getsize(osm_pbf)
+    print("{:,} bytes XML, {:,} bytes PBF ({:.1f}x smaller); process_map "
+          "{:.2f} s XML, {:.2f} s PBF, {:.2f} s PBF with 2 workers".format(
+              xml_bytes, pbf_bytes, xml_bytes / pbf_bytes, seconds["xml"],
+              seconds["pbf"], seconds["pbf_workers"]))
+    assert pbf_bytes * 5 < xml_bytes
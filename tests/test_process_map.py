@@ -0,0 +1,56 @@
+import pytest
+
+import clean_and_write
+import osm_fixture
+
+
+@pytest.fixture(scope="module")
+def serial_out(osm_xml, tmp_path_factory):
+    '''Serial output, compact lines, for comparing runs against.'''
+    fo_pre = str(tmp_path_factory.mktemp("serial") / "out")
+    return osm_fixture.read_bytes(
+        clean_and_write.process_map(osm_xml, fo_pre, pretty=False))
+
+
+@pytest.mark.parametrize("batch_size", [1, 333, 1000])
+def test_ordered_workers_match_serial(osm_xml, fo_pre, serial_out,
+                                      batch_size):
+    files_out = clean_and_write.process_map(osm_xml, fo_pre, pretty=False,
+                                            workers=2, batch_size=batch_size)
+    assert osm_fixture.read_bytes(files_out) == serial_out
+
+
+def test_unordered_shards_hold_serial_docs(osm_xml, fo_pre, serial_out):
+    files_out = clean_and_write.process_map(osm_xml, fo_pre, pretty=False,
+                                            workers=2, ordered=False,
+                                            batch_size=500)
+    assert sorted(osm_fixture.read_bytes(files_out).splitlines()) == \
+        sorted(serial_out.splitlines())
+
+
+def test_unordered_rerun_replaces_shards(osm_xml, fo_pre, serial_out):
+    for _ in range(2):
+        files_out = clean_and_write.process_map(osm_xml, fo_pre,
+                                                pretty=False, workers=2,
+                                                ordered=False)
+    assert len(osm_fixture.read_bytes(files_out).splitlines()) == \
+        len(serial_out.splitlines())
+
+
+@pytest.fixture(params=["xml", "pbf"])
+def file_in(request, osm_xml, tmp_path):
+    if request.param == "xml":
+        return osm_xml
+    return osm_fixture.write_pbf(str(tmp_path / "in.osm.pbf"), 1000)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_rerun_matches_single_run(file_in, tmp_path, workers):
+    run = lambda fo_pre, **kw: osm_fixture.read_bytes(
+        clean_and_write.process_map(file_in, str(tmp_path / fo_pre),
+                                    pretty=False, workers=workers, **kw))
+    once = run("once")
+    run("twice")
+    assert run("twice") == once
+    # Unless asked to append.
+    assert run("twice", append=True) == once * 2
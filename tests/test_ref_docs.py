@@ -0,0 +1,78 @@
+import collections
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import clean_and_write
+import mongo_audit
+import osm_fixture
+
+# mongomock is slow; enough nodes for refer_count ties and rare fields.
+LOAD_NODES = 1000
+FIELDS_LST = ["name", "amenity", "addr", "phone", "shop", "highway"]
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    osm_xml = osm_fixture.write_osm(
+        str(tmp_path_factory.mktemp("refs") / "refs.osm"), LOAD_NODES)
+    db = mongomock.MongoClient().db
+    clean_and_write.load_map(osm_xml, db.bham)
+    # mongomock gets the ref_docs pipeline wrong, so build it here.
+    refers = collections.defaultdict(list)
+    for doc in db.bham.find():
+        for ref in doc.get("node_refs", list()) + \
+                [ member["ref"] for member in doc.get("members", list()) ]:
+            refers[ref].append(doc["_id"])
+    db[mongo_audit.REF_DOCS_STR].insert_many(
+        [ { "_id" : _id, "refers" : ids, "refer_count" : len(ids) }
+          for _id, ids in refers.items() ])
+    return db
+
+
+def baseline_most_refd(coll, field, limit):
+    '''get_most_refd as it was: every document with the field joined to
+    ref_docs and sorted on the size of refers.'''
+    ref_docs = { doc["_id"] : doc for doc in
+                 coll.database[mongo_audit.REF_DOCS_STR].find() }
+    rows = [ (len(ref_docs[doc["_id"]]["refers"]), doc["created"]["user"])
+             for doc in coll.find({ field : { "$exists" : 1 } })
+             if doc["_id"] in ref_docs ]
+    return sorted(rows, key=lambda row: row[0], reverse=True)[:limit]
+
+
+@pytest.mark.parametrize("field", FIELDS_LST)
+def test_most_refd_matches_baseline(db, field):
+    got = list(mongo_audit.get_most_refd(db.bham, field, 5))
+    expected = baseline_most_refd(db.bham, field, 5)
+    # Ties can come out in any order.
+    assert [ doc["refer_count"] for doc in got ] == \
+        [ count for count, _ in expected ]
+    for doc in got:
+        full_doc = db.bham.find_one({ "_id" : doc["_id"] })
+        assert field in full_doc
+        assert doc["contributor"] == [full_doc["created"]["user"]]
+
+
+def test_changed_referrers_since_build():
+    db = mongomock.MongoClient().db
+    coll = db.bham
+    # Never built: a refresh has to rebuild.
+    mongo_audit.record_referrers(coll, ["10000001"])
+    assert mongo_audit.get_changed_referrers(coll)[0] is None
+    # Built: nothing changed since, and the log is cleared.
+    mongo_audit.write_ref_docs(db, coll)
+    assert mongo_audit.get_changed_referrers(coll)[0] == list()
+    assert db[mongo_audit.REF_CHANGES_STR].count_documents(dict()) == 0
+    mongo_audit.record_referrers(coll, ["10000002", "10000001"])
+    mongo_audit.record_referrers(coll, ["10000002"])
+    assert mongo_audit.get_changed_referrers(coll)[0] == \
+        ["10000001", "10000002"]
+    # Other collections' changes aren't included.
+    mongo_audit.record_referrers(db.other, ["10000003"])
+    assert mongo_audit.get_changed_referrers(coll)[0] == \
+        ["10000001", "10000002"]
+    # A reload means rebuilding.
+    mongo_audit.reset_ref_build(coll)
+    assert mongo_audit.get_changed_referrers(coll)[0] is None
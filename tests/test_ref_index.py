@@ -0,0 +1,30 @@
+from ref_index import RefIndex
+
+
+def test_duplicate_ids_reported():
+    index = RefIndex()
+    # A way loaded before a node with its id, and a repeated relation.
+    index.add("way", "5", node_refs=["1", "5"])
+    index.add("node", "1")
+    index.add("node", "5")
+    index.add("relation", "7", members=[{ "type" : "way", "ref" : "5",
+                                          "role" : "outer" }])
+    index.add("relation", "7")
+    results = index.audit()
+    assert results["duplicate_ids"] == 2
+    assert results["duplicate_id_examples"] == [("5", ["node", "way"]),
+                                                 ("7", ["relation", "relation"])]
+    # References to "5" resolve to the node, not the way loaded first.
+    assert results["way_mismatches"] == list()
+    assert results["mismatched_members_lst"][0]["refs"] == \
+        { "_id" : "5", "doc_type" : "node" }
+
+
+def test_no_duplicates():
+    index = RefIndex()
+    index.add("node", "1")
+    index.add("way", "2", node_refs=["1", "3"])
+    results = index.audit(max_examples=1)
+    assert results["duplicate_ids"] == 0
+    assert results["duplicate_id_examples"] == list()
+    assert results["dangling_way_examples"] == [("2", "3")]
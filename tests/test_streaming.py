@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import osm_fixture
+from conftest import REPO_DIR
+
+# Nodes in the extracts. Streaming is measured from 100k to a million nodes,
+# or OSM_TEST_STREAM_NODES. Whole trees are only built up to 100k, which is
+# enough to show them growing.
+SMALL_NODES = 20000
+MEDIUM_NODES = 100000
+LARGE_NODES = int(os.environ.get("OSM_TEST_STREAM_NODES", 1000000))
+# Peak RSS growth allowed between extracts when streaming.
+STREAM_GROWTH_MB = 8
+
+# Cleans an extract in a fresh interpreter and prints its peak RSS in MB.
+PEAK_RSS_SCRIPT_STR = """
+import resource, sys
+sys.path.insert(0, {repo_dir!r})
+import clean_and_write
+for el in clean_and_write.iter_docs(sys.argv[1], stream=sys.argv[2] == "1"):
+    pass
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+"""
+
+
+def get_peak_rss(file_in, stream):
+    '''Peak RSS in MB of cleaning an extract, in a fresh interpreter so
+    earlier tests don't raise the peak.'''
+    script = PEAK_RSS_SCRIPT_STR.format(repo_dir=REPO_DIR)
+    output = subprocess.run([sys.executable, "-c", script, file_in,
+                             "1" if stream else "0"],
+                            check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+@pytest.fixture(scope="module")
+def extracts(tmp_path_factory):
+    '''Extracts by node count, written when first asked for.'''
+    tmp_dir = tmp_path_factory.mktemp("streaming")
+    file_map = dict()
+
+    def get_extract(n_nodes):
+        if n_nodes not in file_map:
+            file_map[n_nodes] = osm_fixture.write_osm(
+                str(tmp_dir / "{}.osm".format(n_nodes)), n_nodes)
+        return file_map[n_nodes]
+    return get_extract
+
+
+def test_streaming_peak_rss_stays_flat(extracts):
+    medium_mb = get_peak_rss(extracts(MEDIUM_NODES), stream=True)
+    large_mb = get_peak_rss(extracts(LARGE_NODES), stream=True)
+    print("streaming peak RSS: {:.1f} MB at {:,} nodes, {:.1f} MB at {:,}"
+          .format(medium_mb, MEDIUM_NODES, large_mb, LARGE_NODES))
+    assert large_mb - medium_mb < STREAM_GROWTH_MB
+
+
+def test_tree_mode_peak_rss_grows(extracts):
+    # Shows the streaming test would catch elements being kept: whole trees
+    # outgrow the bound between much smaller extracts.
+    small_mb = get_peak_rss(extracts(SMALL_NODES), stream=False)
+    medium_mb = get_peak_rss(extracts(MEDIUM_NODES), stream=False)
+    print("tree peak RSS: {:.1f} MB at {:,} nodes, {:.1f} MB at {:,}"
+          .format(small_mb, SMALL_NODES, medium_mb, MEDIUM_NODES))
+    assert medium_mb - small_mb > STREAM_GROWTH_MB
+
+
+def test_stream_and_tree_modes_shape_the_same_docs(osm_xml):
+    import clean_and_write
+    assert list(clean_and_write.iter_docs(osm_xml, stream=True)) == \
+        list(clean_and_write.iter_docs(osm_xml, stream=False))
@@ -0,0 +1,104 @@
+import contextlib
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import clean_and_write
+import legacy_clean
+import osm_fixture
+from conftest import time_best
+
+# Tagged elements shaped per timing.
+BENCH_ELEMENTS = 2000
+
+
+def get_tagged_parts():
+    parts_lst = [ parts for parts in osm_fixture.iter_elements(20000, seed=1)
+                  if any(sub_tag == "tag" for sub_tag, _ in parts[2]) ]
+    return parts_lst[:BENCH_ELEMENTS]
+
+
+@pytest.fixture(scope="module")
+def tagged_parts():
+    return get_tagged_parts()
+
+
+def clear_rule_caches():
+    clean_and_write.get_tag_rule.cache_clear()
+    clean_and_write.get_val_edit.cache_clear()
+
+
+def shape_all(parts_lst, compile_each):
+    docs = list()
+    for parts in parts_lst:
+        if compile_each:
+            clear_rule_caches()
+        docs.append(clean_and_write.shape_parts(*parts))
+    return docs
+
+
+def to_element(tag, attrib, sub_els):
+    '''Build the ElementTree element the old shape_element took.'''
+    el = ET.Element(tag, attrib)
+    for sub_tag, sub_attrib in sub_els:
+        ET.SubElement(el, sub_tag, sub_attrib)
+    return el
+
+
+def get_tags_per_sec(shape, args_lst, n_tags):
+    # Both print anomalies; leave the terminal out of the timing.
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, _ = time_best(lambda: [ shape(*args) for args in args_lst ])
+    return n_tags / seconds
+
+
+def test_bench_tags_per_sec(tagged_parts):
+    n_tags = sum(sub_tag == "tag" for parts in tagged_parts
+                 for sub_tag, _ in parts[2])
+    elements = [ (to_element(*parts),) for parts in tagged_parts ]
+    legacy_rate = get_tags_per_sec(legacy_clean.shape_element, elements,
+                                   n_tags)
+    table_rate = get_tags_per_sec(clean_and_write.shape_parts, tagged_parts,
+                                  n_tags)
+    print("tags/sec: {:,.0f} with the old if/elif chains, {:,.0f} from the "
+          "rule table ({:.1f}x)".format(legacy_rate, table_rate,
+                                        table_rate / legacy_rate))
+    assert table_rate > legacy_rate
+
+
+def test_rule_table_matches_legacy(tagged_parts):
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert [ clean_and_write.shape_parts(*parts)
+                 for parts in tagged_parts ] == \
+            [ legacy_clean.shape_element(to_element(*parts))
+              for parts in tagged_parts ]
+
+
+def test_cached_rules_shape_the_same(tagged_parts):
+    assert shape_all(tagged_parts, compile_each=True) == \
+        shape_all(tagged_parts, compile_each=False)
+    # Reused across timings, so shaping mustn't edit them.
+    assert tagged_parts == get_tagged_parts()
+
+
+def test_rules_compile_once_per_key(tagged_parts):
+    clear_rule_caches()
+    shape_all(tagged_parts, compile_each=False)
+    info = clean_and_write.get_tag_rule.cache_info()
+    assert info.misses == len(set(k for k, _ in osm_fixture.TAGS_LST))
+    assert info.hits > info.misses
+
+
+def test_tag_rules():
+    get_tag_rule = clean_and_write.get_tag_rule
+    assert get_tag_rule("bad key") is None
+    assert get_tag_rule("gnis:ST_alph").kind == "skip"
+    assert get_tag_rule("tiger:county").kind == "raw"
+    rule = get_tag_rule("contact:phone")
+    assert (rule.kind, rule.k, rule.list_key, rule.phone) == \
+        ("clean", "phone", True, True)
+    rule = get_tag_rule("addr:street")
+    assert (rule.subdiv, rule.addr_k) == ("addr", "street")
+    assert get_tag_rule("name_1").k == "name"
+    assert get_tag_rule("building:levels").val_edit("3s") == 3